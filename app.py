@@ -1,13 +1,34 @@
+import asyncio
+import atexit
+import base64
+import contextlib
+import contextvars
+import csv
+import functools
+import gzip
+import logging
 import os
+import random
 import re
+import click
 import google.generativeai as genai
-from flask import Flask, request, jsonify, render_template # Added render_template
+from flask import Flask, request, jsonify, render_template, Response # Added render_template
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
 import mysql.connector
 from mysql.connector import Error as MySQLError
 import datetime
 import decimal
+import hashlib
+import hmac
 import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,11 +36,161 @@ load_dotenv()
 # Configure Flask app
 app = Flask(__name__)
 
+# --- Logging and Metrics ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" (one object per line) or "text"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # Share of requests whose INFO/DEBUG events are logged
+LOG_PROMPTS = os.getenv("LOG_PROMPTS", "false").lower() in ("1", "true", "yes")  # Log full Gemini prompts at DEBUG
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "event": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        fields = " ".join(f"{key}={value!r}" for key, value in getattr(record, "fields", {}).items())
+        return f"{self.formatTime(record)} {record.levelname} {record.getMessage()} {fields}".rstrip()
+
+
+logger = logging.getLogger("hr_chat")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+logger.setLevel(LOG_LEVEL)
+
+
+class RequestContext:
+    """Request id, log-sampling decision, per-stage seconds and client session id for one chat request."""
+    def __init__(self, session_id: str = None):
+        self.session_id = session_id
+        self.request_id = secrets.token_hex(6)
+        self.sampled = random.random() < LOG_SAMPLE_RATE
+        self.started = time.perf_counter()
+        self.stages = defaultdict(float)
+
+
+# Set at the start of each chat request; copied into run_db threads, so stage timers there add to the same request.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+def log_event(level: int, event: str, **fields):
+    """
+    Structured log line. Inside a request, INFO/DEBUG events are only kept for the sampled share of requests;
+    warnings and errors are always logged.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    context = current_request.get()
+    if context is not None:
+        if level < logging.WARNING and not context.sampled:
+            return
+        fields["request_id"] = context.request_id
+    logger.log(level, event, extra={"fields": fields})
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    """Prometheus-style counter with labels; rendered by /metrics."""
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value:g}" for key, value in values]
+        return lines
+
+
+class Histogram:
+    """Prometheus-style histogram (cumulative buckets, sum and count per label set)."""
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series_items = sorted((key, list(series)) for key, series in self._series.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in series_items:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', f'{bound:g}'),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+METRICS = []
+stage_seconds = Histogram("hr_chat_stage_seconds", "Time spent per request stage.", ("stage",))
+request_seconds = Histogram("hr_chat_request_seconds", "End-to-end /chat latency by response type.", ("type",))
+responses_total = Counter("hr_chat_responses_total", "/chat responses by type and HTTP status.", ("type", "status"))
+llm_tokens_total = Counter("hr_chat_llm_tokens_total", "Gemini tokens reported in usage metadata.", ("kind",))
+llm_calls_total = Counter("hr_chat_llm_calls_total", "Gemini calls by outcome.", ("outcome",))
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    """Times a block into hr_chat_stage_seconds and the current request's stage breakdown."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        context = current_request.get()
+        if context is not None:
+            context.stages[stage] += elapsed
+
 # --- Gemini API Configuration ---
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GOOGLE_API_KEY not found in environment variables. Please set it in .env file.")
-genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
+else:
+    # Stay importable (benchmark.py and CLI commands supply their own model); /chat cannot reach Gemini until a key is set.
+    log_event(logging.WARNING, "gemini.api_key_missing", detail="GOOGLE_API_KEY not found in environment variables. Please set it in .env file.")
 
 generation_config = {
   "temperature": 0.2,
@@ -34,418 +205,3901 @@ safety_settings = [
   {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
-TUNED_MODEL_NAME = os.getenv("TUNED_GEMINI_MODEL_NAME")
-BASE_MODEL_NAME = "gemini-2.0-flash" # Fallback
-model_to_use = TUNED_MODEL_NAME if TUNED_MODEL_NAME else BASE_MODEL_NAME
-print(f"Using Gemini model: {model_to_use}")
+TUNED_MODEL_NAME = os.getenv("TUNED_GEMINI_MODEL_NAME")
+BASE_MODEL_NAME = "gemini-2.0-flash" # Fallback
+model_to_use = TUNED_MODEL_NAME if TUNED_MODEL_NAME else BASE_MODEL_NAME
+log_event(logging.INFO, "gemini.model", model=model_to_use)
+
+model = genai.GenerativeModel(model_name=model_to_use,
+                              generation_config=generation_config,
+                              safety_settings=safety_settings) if GEMINI_API_KEY else None
+
+# --- MySQL Database Configuration ---
+DB_HOST = os.getenv("DB_HOST")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_NAME = os.getenv("DB_NAME")
+
+ALLOWED_WRITE_OPERATIONS = ["UPDATE", "INSERT"]
+
+# --- MySQL Connection Pool Configuration ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))  # Max open connections per worker process
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))  # Replace connections older than this (seconds)
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))  # Ping connections idle longer than this (seconds)
+DB_POOL_RESET_ON_RETURN = os.getenv("DB_POOL_RESET_ON_RETURN", "true").lower() in ("1", "true", "yes")
+
+
+class PooledConnection:
+    """
+    Proxy around a pooled MySQL connection.
+    Behaves like the underlying connection, except close() hands it back to the pool
+    instead of tearing down the TCP session.
+    """
+
+    def __init__(self, pool, raw_conn, created_at: float):
+        self._pool = pool
+        self._conn = raw_conn
+        self._created_at = created_at
+        self._released = False
+        self.replica = None  # Replica name when checked out from a ReplicaSet
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def is_connected(self) -> bool:
+        return not self._released and self._conn.is_connected()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool._release(self._conn, self._created_at)
+
+    def invalidate(self):
+        """Drops the connection instead of returning it, e.g. when an unbuffered result was abandoned mid-stream."""
+        if not self._released:
+            self._released = True
+            self._pool._release(self._conn, self._created_at, discard=True)
+
+
+class DBConnectionPool:
+    """
+    Thread-safe pool of MySQL connections.
+    - Connections are opened lazily, up to `pool_size`.
+    - Checkout waits up to `timeout` seconds for a free connection, then raises PoolError.
+    - Idle connections are pinged before reuse and replaced after `recycle` seconds.
+    - Returned connections are rolled back and reset so no session state leaks between requests.
+    """
+
+    def __init__(self, pool_size: int, timeout: float, recycle: float, ping_after: float,
+                 reset_on_return: bool = True, connect_factory=None, **connect_args):
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.reset_on_return = reset_on_return
+        self._connect_factory = connect_factory or (lambda: mysql.connector.connect(**connect_args))
+        self._idle = deque()  # (raw_conn, created_at, returned_at)
+        self._open_count = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0, "handshakes": 0, "handshakes_avoided": 0, "waiting": 0,
+            "timeouts": 0, "recycled": 0, "failed_pings": 0, "reset_failures": 0,
+        }
+
+    def get_connection(self, timeout: float = None) -> PooledConnection:
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            reuse = None
+            with self._cond:
+                while not self._idle and self._open_count >= self.pool_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise mysql.connector.errors.PoolError(
+                            f"Timed out after {self.timeout}s waiting for a pooled connection "
+                            f"({self._open_count}/{self.pool_size} in use).")
+                    self._stats["waiting"] += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._stats["waiting"] -= 1
+                if self._idle:
+                    reuse = self._idle.pop()  # LIFO keeps the warmest connections in use
+                else:
+                    self._open_count += 1  # Reserve the slot before connecting outside the lock
+                self._stats["checkouts"] += 1
+
+            if reuse is not None:
+                raw_conn, created_at, returned_at = reuse
+                if self._is_reusable(raw_conn, created_at, returned_at):
+                    with self._cond:
+                        self._stats["handshakes_avoided"] += 1
+                    return PooledConnection(self, raw_conn, created_at)
+                self._close_quietly(raw_conn)  # Keep the slot and fill it with a fresh connection
+
+            try:
+                raw_conn = self._connect_factory()
+            except Exception:
+                with self._cond:
+                    self._open_count -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["handshakes"] += 1
+            return PooledConnection(self, raw_conn, time.monotonic())
+
+    def _is_reusable(self, raw_conn, created_at: float, returned_at: float) -> bool:
+        now = time.monotonic()
+        if self.recycle and now - created_at > self.recycle:
+            with self._cond:
+                self._stats["recycled"] += 1
+            return False
+        if now - returned_at > self.ping_after:
+            try:
+                raw_conn.ping(reconnect=False)
+            except Exception:
+                with self._cond:
+                    self._stats["failed_pings"] += 1
+                return False
+        return True
+
+    def _release(self, raw_conn, created_at: float, discard: bool = False):
+        keep = not discard
+        try:
+            if not keep or not raw_conn.is_connected():
+                keep = False
+            elif self.reset_on_return:
+                if raw_conn.in_transaction:
+                    raw_conn.rollback()
+                raw_conn.cmd_reset_connection()
+        except Exception as e:
+            log_event(logging.WARNING, "db_pool.reset_failed", error=str(e))
+            with self._cond:
+                self._stats["reset_failures"] += 1
+            keep = False
+        if keep and self.recycle and time.monotonic() - created_at > self.recycle:
+            with self._cond:
+                self._stats["recycled"] += 1
+            keep = False
+
+        if not keep:
+            self._close_quietly(raw_conn)
+        with self._cond:
+            if keep:
+                self._idle.append((raw_conn, created_at, time.monotonic()))
+            else:
+                self._open_count -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(raw_conn):
+        try:
+            raw_conn.close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                "pid": os.getpid(),
+                "pool_size": self.pool_size,
+                "open": self._open_count,
+                "idle": idle,
+                "in_use": self._open_count - idle,
+                **self._stats,
+            }
+
+
+db_pool = DBConnectionPool(
+    pool_size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    recycle=DB_POOL_RECYCLE,
+    ping_after=DB_POOL_PING_AFTER,
+    reset_on_return=DB_POOL_RESET_ON_RETURN,
+    host=DB_HOST,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    database=DB_NAME,
+)
+
+def get_db_connection(read_only: bool = False):
+    """
+    A pooled connection to the primary. With `read_only`, a replica connection when replicas are configured,
+    one is usable and the current session has not just written (see the Read Replicas section).
+    """
+    try:
+        with stage_timer("db_connect"):
+            conn = replica_set.get_connection() if read_only and not reads_use_primary() else None
+            conn = conn or db_pool.get_connection()
+        if conn.is_connected():
+            return conn
+        conn.close()
+    except MySQLError as e:
+        log_event(logging.ERROR, "db.connect_failed", error=str(e))
+        return None
+
+# --- Read Replicas ---
+DB_REPLICA_HOSTS = [host.strip() for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()]  # host[:port], comma-separated
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))  # Max open connections per replica per worker process
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))  # Seconds behind the primary before a replica stops taking reads
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))  # Seconds between health/lag checks of a replica
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", str(max(DB_REPLICA_MAX_LAG, 1.0))))  # Seconds a session reads from the primary after it writes
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.:-]{1,128}$")
+
+
+def clean_session_id(*candidates) -> str | None:
+    """First well-formed session id among the candidates (payload field, X-Session-Id header)."""
+    for candidate in candidates:
+        if isinstance(candidate, str) and SESSION_ID_PATTERN.match(candidate):
+            return candidate
+    return None
+
+
+def current_session_id() -> str | None:
+    context = current_request.get()
+    return context.session_id if context else None
+
+
+@contextlib.contextmanager
+def session_context(session_id: str | None):
+    """Request context for routes outside the chat pipeline, so their reads honour read-your-writes."""
+    token = current_request.set(RequestContext(session_id=session_id))
+    try:
+        yield
+    finally:
+        current_request.reset(token)
+
+
+class RecentWrites:
+    """
+    When sessions and tables were last written through this process.
+    A session that wrote within `window` seconds reads from the primary, and results for tables written
+    within `window` are not cached from replica reads (the replica may not have the write yet).
+    Per process: behind a load balancer, route a session to one worker or keep the window above the replica lag.
+    """
+
+    def __init__(self, window: float, max_sessions: int = 10000):
+        self.window = window
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session id -> monotonic time of its last write
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def note(self, session_id: str | None, tables: set):
+        now = time.monotonic()
+        with self._lock:
+            if session_id:
+                self._sessions.pop(session_id, None)
+                self._sessions[session_id] = now
+                while len(self._sessions) > self.max_sessions or (
+                        self._sessions and now - next(iter(self._sessions.values())) > self.window):
+                    self._sessions.popitem(last=False)
+            for table in tables or {"*"}:  # A write we cannot attribute counts for every table
+                self._tables[table] = now
+
+    def session_is_sticky(self, session_id: str | None) -> bool:
+        if not session_id:
+            return False
+        with self._lock:
+            written_at = self._sessions.get(session_id)
+        return written_at is not None and time.monotonic() - written_at <= self.window
+
+    def tables_recently_written(self, tables: set) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any(now - self._tables.get(table, float("-inf")) <= self.window for table in set(tables) | {"*"})
+
+    def last_write_at(self, tables: set) -> float:
+        """Monotonic time of the latest write to any of `tables` (or an unattributed one)."""
+        with self._lock:
+            return max(self._tables.get(table, float("-inf")) for table in set(tables) | {"*"})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"window": self.window, "sticky_sessions": sum(
+                1 for written_at in self._sessions.values() if time.monotonic() - written_at <= self.window)}
+
+
+class ReplicaSet:
+    """
+    Load-balanced read replicas, each with its own DBConnectionPool.
+    A replica takes reads while its last health check succeeded and its lag is within `max_lag`.
+    Checks run at most every `check_interval` seconds per replica, on the thread that asks for a connection;
+    the least busy usable replica is picked.
+    """
+
+    def __init__(self, hosts: list, max_lag: float, check_interval: float, pool_factory):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replicas = [{"name": host, "pool": pool_factory(host), "healthy": True, "lag": None, "checked_at": float("-inf"),
+                          "checking": False, "reads": 0, "error": None} for host in hosts]
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._stats = {"reads": 0, "fallbacks": 0, "checks": 0, "check_failures": 0}
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def get_connection(self) -> PooledConnection | None:
+        """A connection to a usable replica, or None when none is usable (the caller then reads from the primary)."""
+        with self._lock:
+            self._turn += 1
+            start = self._turn % len(self.replicas)
+        rotated = self.replicas[start:] + self.replicas[:start]  # Round robin among equally busy replicas
+        for replica in sorted(rotated, key=lambda r: r["pool"].stats()["in_use"]):
+            if not self._is_usable(replica):
+                continue
+            try:
+                conn = replica["pool"].get_connection()
+            except Exception as e:
+                self._mark(replica, healthy=False, lag=None, error=str(e))
+                log_event(logging.WARNING, "db_replica.connect_failed", replica=replica["name"], error=str(e))
+                continue
+            if not conn.is_connected():
+                conn.close()
+                continue
+            conn.replica = replica["name"]
+            with self._lock:
+                replica["reads"] += 1
+                self._stats["reads"] += 1
+            return conn
+        with self._lock:
+            self._stats["fallbacks"] += 1
+        return None
+
+    def _is_usable(self, replica: dict) -> bool:
+        with self._lock:
+            due = not replica["checking"] and time.monotonic() - replica["checked_at"] >= self.check_interval
+            if due:
+                replica["checking"] = True
+        if due:
+            self._check(replica)
+        return replica["healthy"] and replica["lag"] is not None and replica["lag"] <= self.max_lag
+
+    def _check(self, replica: dict):
+        conn = cursor = None
+        healthy, lag, error = False, None, None
+        try:
+            conn = replica["pool"].get_connection()
+            cursor = conn.cursor(dictionary=True)
+            channels = None
+            for statement in ("SHOW REPLICA STATUS", "SHOW SLAVE STATUS"):  # MySQL 8.0.22+ and older spellings
+                try:
+                    cursor.execute(statement)
+                    channels = cursor.fetchall()
+                    break
+                except MySQLError as e:
+                    error = str(e)
+            if channels is None:
+                raise MySQLError(f"Cannot read replication status: {error}")
+            if not channels:
+                healthy, lag = True, 0.0  # Not a replica (e.g. a read endpoint that is always current)
+            else:
+                lags = [channel.get("Seconds_Behind_Source", channel.get("Seconds_Behind_Master")) for channel in channels]
+                running = all(channel.get("Replica_SQL_Running", channel.get("Slave_SQL_Running")) == "Yes" for channel in channels)
+                healthy = running and None not in lags
+                lag = float(max(lags)) if healthy else None
+                error = None if healthy else "Replication is not running"
+        except Exception as e:
+            error = str(e)
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.close()
+        self._mark(replica, healthy=healthy, lag=lag, error=error)
+        if not healthy or lag > self.max_lag:
+            log_event(logging.WARNING, "db_replica.unusable", replica=replica["name"], lag=lag, error=error)
+
+    def _mark(self, replica: dict, healthy: bool, lag, error):
+        with self._lock:
+            replica.update(healthy=healthy, lag=lag, error=error, checking=False, checked_at=time.monotonic())
+            self._stats["checks"] += 1
+            if not healthy:
+                self._stats["check_failures"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            replicas = {replica["name"]: {"healthy": replica["healthy"], "lag": replica["lag"], "reads": replica["reads"],
+                                          "error": replica["error"], "pool": replica["pool"].stats()} for replica in self.replicas}
+            return {"max_lag": self.max_lag, **self._stats, "replicas": replicas}
+
+
+def _replica_pool(address: str) -> DBConnectionPool:
+    host, _, port = address.partition(":")
+    return DBConnectionPool(
+        pool_size=DB_REPLICA_POOL_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        recycle=DB_POOL_RECYCLE,
+        ping_after=DB_POOL_PING_AFTER,
+        reset_on_return=DB_POOL_RESET_ON_RETURN,
+        host=host,
+        port=int(port or 3306),
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+    )
+
+
+replica_set = ReplicaSet(DB_REPLICA_HOSTS, max_lag=DB_REPLICA_MAX_LAG, check_interval=DB_REPLICA_CHECK_INTERVAL, pool_factory=_replica_pool)
+recent_writes = RecentWrites(window=READ_YOUR_WRITES_WINDOW)
+
+
+def reads_use_primary() -> bool:
+    """True when SELECTs of the current request must go to the primary (no replicas, or read-your-writes)."""
+    return not replica_set or recent_writes.session_is_sticky(current_session_id())
+
+
+# --- Async Execution Pipeline ---
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))  # Gemini calls in flight per process
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))  # Seconds per request for the LLM stage, queueing included
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", str(DB_POOL_SIZE)))  # DB calls in flight (= DB threads)
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "30"))  # Seconds per DB call, queueing included (writes: queueing only)
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"  # Coalesce identical in-flight LLM calls and SELECTs
+
+single_flight_calls_total = Counter("hr_chat_single_flight_calls_total",
+                                    "Coalescable calls by role: leaders run the computation, waiters share its result.",
+                                    ("flight", "role"))
+
+
+class StageTimeout(Exception):
+    def __init__(self, stage: str, timeout: float, started: bool = True):
+        super().__init__(f"{stage} stage timed out after {timeout}s{'' if started else ' waiting for a slot'}")
+        self.stage = stage
+        self.started = started  # False: the call never ran, so retrying it is safe
+
+
+class StageLimiter:
+    """
+    Bounds one pipeline stage: at most `max_concurrency` calls run at once, and each call
+    (including time spent queued for a slot) must finish within `timeout` seconds.
+    With `queue_only`, the timeout covers only the wait for a slot and a started call is awaited to completion.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, timeout: float):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self._semaphore = None
+        self._loop = None
+        self._stats = {"in_flight": 0, "queued": 0, "completed": 0, "timeouts": 0, "cancelled": 0}
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:  # One loop per process in practice; rebind if a new one takes over
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    async def run(self, make_awaitable, queue_only: bool = False):
+        """Awaits `make_awaitable()` once a slot is free; the factory is not called if the wait times out."""
+        semaphore = self._get_semaphore()
+        acquired = False
+        self._stats["queued"] += 1
+
+        async def run_in_slot():
+            nonlocal acquired
+            if queue_only:
+                await asyncio.wait_for(semaphore.acquire(), self.timeout)
+            else:
+                await semaphore.acquire()
+            acquired = True
+            self._stats["queued"] -= 1
+            self._stats["in_flight"] += 1
+            try:
+                return await make_awaitable()
+            finally:
+                self._stats["in_flight"] -= 1
+                semaphore.release()
+
+        try:
+            result = await (run_in_slot() if queue_only else asyncio.wait_for(run_in_slot(), self.timeout))
+            self._stats["completed"] += 1
+            return result
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise StageTimeout(self.name, self.timeout, started=acquired) from None
+        except asyncio.CancelledError:
+            self._stats["cancelled"] += 1
+            raise
+        finally:
+            if not acquired:
+                self._stats["queued"] -= 1
+
+    def stats(self) -> dict:
+        return {"max_concurrency": self.max_concurrency, "timeout": self.timeout, **self._stats}
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first caller for a key runs the computation and later
+    callers with the same key await that same run instead of starting their own.
+    The run is shielded from a caller's cancellation and only cancelled once every caller has gone.
+    The run executes in the leader's context, so its stages are timed for the leader; a waiter's request
+    breakdown shows its wait as a single "<name>_shared" stage instead.
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self._calls = {}  # key -> {"task", "callers"}; only touched from the event loop thread
+        self._stats = {"leaders": 0, "waiters": 0, "max_waiters": 0}
+
+    async def run(self, key: str, make_awaitable, share=None):
+        """
+        Awaits `make_awaitable()` or the in-flight run for `key`.
+        `share(result)` is applied to the result handed to each waiter (e.g. to give it its own tokens).
+        """
+        if not self.enabled:
+            return await make_awaitable()
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = {"task": asyncio.ensure_future(make_awaitable()), "callers": 0}
+            self._calls[key] = call
+            call["task"].add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+            self._stats["leaders"] += 1
+        else:
+            self._stats["waiters"] += 1
+            self._stats["max_waiters"] = max(self._stats["max_waiters"], call["callers"])
+            log_event(logging.INFO, "single_flight.coalesced", flight=self.name, waiting=call["callers"])
+        single_flight_calls_total.inc(flight=self.name, role="leader" if leader else "waiter")
+        call["callers"] += 1
+        try:
+            if leader:
+                result = await asyncio.shield(call["task"])
+            else:
+                with stage_timer(f"{self.name}_shared"):
+                    result = await asyncio.shield(call["task"])
+        except asyncio.CancelledError:
+            if call["callers"] == 1 and not call["task"].done():
+                # Nobody else is waiting: free the stage slot, and keep new callers off the dying run.
+                if self._calls.get(key) is call:
+                    self._calls.pop(key)
+                call["task"].cancel()
+            raise
+        finally:
+            call["callers"] -= 1
+        return result if leader or share is None else share(result)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "waiting": sum(call["callers"] - 1 for call in list(self._calls.values()) if call["callers"] > 1),
+            **self._stats,
+        }
+
+
+class BackgroundEventLoop:
+    """Event loop on a daemon thread so synchronous WSGI views can share one loop (and one set of stage limits)."""
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        # Started lazily so pre-forking servers do not fork a running loop thread.
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="chat-pipeline-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started()).result()
+
+
+llm_stage = StageLimiter("LLM", LLM_MAX_CONCURRENCY, LLM_TIMEOUT)
+db_stage = StageLimiter("database", DB_MAX_CONCURRENCY, DB_TIMEOUT)
+db_executor = ThreadPoolExecutor(max_workers=DB_MAX_CONCURRENCY, thread_name_prefix="db-stage")
+llm_flight = SingleFlight("llm", SINGLE_FLIGHT_ENABLED)
+select_flight = SingleFlight("select", SINGLE_FLIGHT_ENABLED)
+background_loop = BackgroundEventLoop()
+pipeline_stats = {"cancelled_on_disconnect": 0}
+
+async def run_db(func, *args, **kwargs):
+    """Runs a blocking DB helper (execute_query etc.) on the bounded DB executor under the DB stage limits."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await db_stage.run(lambda: loop.run_in_executor(db_executor, call))
+
+async def run_db_write(func, *args, **kwargs):
+    """
+    Like run_db, but DB_TIMEOUT only bounds the wait for a slot. Once a write has started it is awaited to the end:
+    abandoning it would not stop the commit, and a "try again" reply would then apply the write twice.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await db_stage.run(lambda: loop.run_in_executor(db_executor, call), queue_only=True)
+
+# --- Pending Write Confirmations ---
+PENDING_ACTION_TTL = float(os.getenv("PENDING_ACTION_TTL", "300"))  # Seconds a confirmation token stays valid
+
+
+class ExpiringTokenStore:
+    """
+    In-memory map of opaque, single-use tokens to server-side values.
+    Tokens expire after `ttl` seconds; the oldest entries are dropped beyond `max_entries`.
+    Per process: a token is only known to the worker that issued it.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # token -> (expires_at, value); dicts keep insertion order
+        self._lock = threading.Lock()
+
+    def put(self, value) -> str:
+        token = secrets.token_urlsafe(24)
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            while len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[token] = (now + self.ttl, value)
+        return token
+
+    def pop(self, token: str):
+        if not token or not isinstance(token, str):
+            return None
+        with self._lock:
+            entry = self._entries.pop(token, None)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def _purge_expired(self, now: float):
+        expired = [token for token, (expires_at, _) in self._entries.items() if expires_at < now]
+        for token in expired:
+            del self._entries[token]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SignedTokens:
+    """
+    Self-contained tokens: the value and its expiry, JSON-encoded and HMAC-signed with `secret`, so any worker
+    sharing the secret reads them back and nothing is kept server-side. Values round-trip through JSON (tuples come
+    back as lists). Tokens stay valid until they expire, however often they are used, so only issue them where a
+    replay is harmless.
+    """
+
+    def __init__(self, ttl: float, secret: str = None):
+        self.ttl = ttl
+        self._key = (secret or secrets.token_hex(32)).encode()
+        self._stats = {"issued": 0, "rejected": 0, "expired": 0}
+
+    def _sign(self, body: bytes) -> bytes:
+        return base64.urlsafe_b64encode(hmac.new(self._key, body, hashlib.sha256).digest()).rstrip(b"=")
+
+    def put(self, value) -> str:
+        body = base64.urlsafe_b64encode(dumps_json({"expires_at": time.time() + self.ttl, "value": value})).rstrip(b"=")
+        self._stats["issued"] += 1
+        return (body + b"." + self._sign(body)).decode()
+
+    def pop(self, token: str):
+        """The token's value, or None when it is malformed, forged or expired (named like ExpiringTokenStore.pop)."""
+        if not token or not isinstance(token, str) or token.count(".") != 1:
+            return None
+        body, signature = token.encode().split(b".")
+        if not hmac.compare_digest(signature, self._sign(body)):
+            self._stats["rejected"] += 1
+            return None
+        payload = json.loads(base64.urlsafe_b64decode(body + b"=" * (-len(body) % 4)))
+        if payload["expires_at"] < time.time():
+            self._stats["expired"] += 1
+            return None
+        return payload["value"]
+
+    def stats(self) -> dict:
+        return {"ttl": self.ttl, **self._stats}
+
+
+# Writes the user still has to confirm: token -> {"sql", "query_type", "user_message"}.
+# Kept server-side so each confirmation runs at most once; with several workers, route a client's requests
+# to one worker (sticky sessions), or a confirm that reaches another worker is reported as expired.
+pending_actions = ExpiringTokenStore(ttl=PENDING_ACTION_TTL)
+
+# --- Schema Catalog ---
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "3600"))  # Seconds before the schema is re-read regardless
+SCHEMA_CHECK_INTERVAL = float(os.getenv("SCHEMA_CHECK_INTERVAL", "60"))  # Seconds between cheap DDL-change checks
+
+# Hand-written descriptions layered on top of INFORMATION_SCHEMA (column comments are used when no note exists).
+# CRITICAL: Keep these accurate and detailed; the model relies on them to pick tables and columns.
+TABLE_NOTES = {
+    "employees": "Stores information about employees.",
+    "departments": "Stores information about company departments.",
+    "payments": "Tracks salary payments, bonuses, and commissions paid to employees.",
+    "leave_requests": "Tracks employee requests for leave (vacation, sick leave, etc.).",
+    "payroll_summary": "Pre-aggregated payment totals per employee, month and payment type, kept current from 'payments'.",
+    "leave_day_summary": "Pre-aggregated count of employees on leave per calendar day, department and request status, kept current from 'leave_requests'.",
+}
+COLUMN_NOTES = {
+    ("employees", "id"): "Unique identifier for the employee.",
+    ("employees", "first_name"): "First name of the employee.",
+    ("employees", "last_name"): "Last name of the employee.",
+    ("employees", "email"): "Email address of the employee.",
+    ("employees", "phone_number"): "Employee's phone number.",
+    ("employees", "hire_date"): "Date when the employee was hired (YYYY-MM-DD).",
+    ("employees", "job_id"): "Identifier for the employee's job role (e.g., IT_PROG, SA_REP, AD_PRES).",
+    ("employees", "salary"): "Current monthly or annual salary of the employee.",
+    ("employees", "commission_pct"): "Commission percentage for sales staff (e.g., 0.10 for 10%). NULL if not applicable.",
+    ("employees", "manager_id"): "ID of the employee's manager. NULL if no manager (e.g., for CEO).",
+    ("employees", "department_id"): "ID of the department the employee belongs to.",
+    ("employees", "insertion_date"): "Timestamp when the employee record was created.",
+    ("employees", "last_payment_date"): "Date of the most recent payment made to the employee.",
+    ("departments", "department_id"): "Unique identifier for the department.",
+    ("departments", "department_name"): "Name of the department (e.g., 'IT', 'Sales', 'Human Resources').",
+    ("departments", "location"): "Physical location of the department.",
+    ("payments", "payment_id"): "Unique identifier for the payment.",
+    ("payments", "employee_id"): "ID of the employee receiving the payment.",
+    ("payments", "payment_date"): "Date the payment was made.",
+    ("payments", "amount"): "Amount of the payment.",
+    ("payments", "payment_type"): "Type of payment (e.g., 'Salary', 'Bonus', 'Commission').",
+    ("payments", "notes"): "Optional notes about the payment.",
+    ("leave_requests", "leave_id"): "Unique identifier for the leave request.",
+    ("leave_requests", "employee_id"): "ID of the employee requesting leave.",
+    ("leave_requests", "leave_type"): "Type of leave (e.g., 'Vacation', 'Sick', 'Personal').",
+    ("leave_requests", "start_date"): "Start date of the leave period.",
+    ("leave_requests", "end_date"): "End date of the leave period.",
+    ("leave_requests", "status"): "Status of the request ('Pending', 'Approved', 'Rejected', 'Cancelled').",
+    ("leave_requests", "reason"): "Reason for the leave request (optional).",
+    ("leave_requests", "requested_date"): "When the leave was requested.",
+    ("leave_requests", "approved_by"): "ID of the manager who approved/rejected the leave. NULL if pending or self-approved.",
+    ("payroll_summary", "pay_month"): "First day of the month the payments were made in (e.g., '2024-03-01' for March 2024).",
+    ("payroll_summary", "employee_id"): "ID of the employee who was paid.",
+    ("payroll_summary", "department_id"): "Current department of the employee (0 if none).",
+    ("payroll_summary", "payment_type"): "Type of payment (e.g., 'Salary', 'Bonus', 'Commission').",
+    ("payroll_summary", "payment_count"): "Number of payments in this group.",
+    ("payroll_summary", "total_amount"): "Sum of the payment amounts in this group.",
+    ("leave_day_summary", "leave_date"): "A calendar day (weekends included) covered by at least one leave request.",
+    ("leave_day_summary", "department_id"): "Current department of the employees (0 if none).",
+    ("leave_day_summary", "status"): "Status of the leave requests ('Pending', 'Approved', 'Rejected', 'Cancelled').",
+    ("leave_day_summary", "employees_on_leave"): "Distinct employees whose leave covers this day.",
+    ("leave_day_summary", "leave_requests"): "Leave requests covering this day.",
+}
+# Used when INFORMATION_SCHEMA cannot be read: (column, type description) in table order.
+FALLBACK_COLUMNS = {
+    "employees": [
+        ("id", "INT, PRIMARY KEY, AUTO_INCREMENT"), ("first_name", "VARCHAR(50), NOT NULL"),
+        ("last_name", "VARCHAR(50), NOT NULL"), ("email", "VARCHAR(100), UNIQUE"), ("phone_number", "VARCHAR(20)"),
+        ("hire_date", "DATE"), ("job_id", "VARCHAR(10)"), ("salary", "DECIMAL(10, 2)"), ("commission_pct", "DECIMAL(4,2)"),
+        ("manager_id", "INT"), ("department_id", "INT"),
+        ("insertion_date", "TIMESTAMP, DEFAULT CURRENT_TIMESTAMP"), ("last_payment_date", "DATE"),
+    ],
+    "departments": [
+        ("department_id", "INT, PRIMARY KEY"), ("department_name", "VARCHAR(100), NOT NULL, UNIQUE"), ("location", "VARCHAR(100)"),
+    ],
+    "payments": [
+        ("payment_id", "INT, AUTO_INCREMENT, PRIMARY KEY"), ("employee_id", "INT, NOT NULL"), ("payment_date", "DATE, NOT NULL"),
+        ("amount", "DECIMAL(10, 2), NOT NULL"), ("payment_type", "VARCHAR(50), DEFAULT 'Salary'"), ("notes", "TEXT"),
+    ],
+    "leave_requests": [
+        ("leave_id", "INT, AUTO_INCREMENT, PRIMARY KEY"), ("employee_id", "INT, NOT NULL"),
+        ("leave_type", "VARCHAR(50), NOT NULL, DEFAULT 'Vacation'"), ("start_date", "DATE, NOT NULL"), ("end_date", "DATE, NOT NULL"),
+        ("status", "VARCHAR(20), NOT NULL, DEFAULT 'Pending'"), ("reason", "TEXT"),
+        ("requested_date", "TIMESTAMP, DEFAULT CURRENT_TIMESTAMP"), ("approved_by", "INT"),
+    ],
+}
+# Relationships the app relies on even where the database does not declare the FOREIGN KEY constraint.
+DOCUMENTED_FOREIGN_KEYS = [
+    ("employees", "manager_id", "employees", "id"),
+    ("employees", "department_id", "departments", "department_id"),
+    ("payments", "employee_id", "employees", "id"),
+    ("leave_requests", "employee_id", "employees", "id"),
+    ("leave_requests", "approved_by", "employees", "id"),
+    ("payroll_summary", "employee_id", "employees", "id"),
+    ("payroll_summary", "department_id", "departments", "department_id"),
+    ("leave_day_summary", "department_id", "departments", "department_id"),
+]
+# Words users say for a table that do not appear in its table or column names.
+TABLE_KEYWORDS = {
+    "employees": ["employee", "staff", "people", "person", "worker", "who", "hire", "hired", "manager", "earn", "earning", "name"],
+    "departments": ["department", "dept", "team", "division", "location", "office", "based"],
+    "payments": ["payment", "paid", "pay", "payroll", "bonus", "commission", "compensation", "payout", "wage"],
+    "leave_requests": ["leave", "vacation", "holiday", "sick", "absence", "absent", "off", "pto", "approved", "pending", "rejected"],
+    "payroll_summary": ["payroll", "total", "totals", "monthly", "month", "spend", "spent", "cost", "sum"],
+    "leave_day_summary": ["leave", "absence", "absent", "off", "away", "day", "days", "daily"],
+}
+# (tables the note is about, text); a note is included when all of its tables are in the prompt.
+GENERAL_NOTES = [
+    ({"employees", "departments"}, "When asked for information that spans multiple tables, use appropriate JOIN clauses.\n"
+     "  For example, to get employee names and their department names, JOIN employees with departments on department_id."),
+    ({"employees"}, "'insertion_date' in 'employees' is for when the record was created. 'hire_date' is the official start date."),
+    ({"employees", "payments"}, "'last_payment_date' in 'employees' can be used for \"who was paid last\", but for detailed payment history or amounts, query the 'payments' table."),
+    ({"leave_requests"}, "For leave status or history, query the 'leave_requests' table."),
+    ({"payroll_summary"}, "For payment totals or counts by month, department, employee or payment type, aggregate 'payroll_summary' "
+     "(e.g., SUM(total_amount)) instead of scanning 'payments'. Use 'payments' only for individual payments or periods finer than a month."),
+    ({"leave_day_summary"}, "For how many employees are on leave on a given day, by department or status, query 'leave_day_summary' "
+     "instead of expanding 'leave_requests' date ranges. Its counts are per day: for distinct people across several days, "
+     "or leave types and reasons, query 'leave_requests'."),
+]
+ADD_EMPLOYEE_NOTE = """IMPORTANT FOR ADDING EMPLOYEES:
+If the user expresses an intent to "add a new employee", "hire someone", or "insert a new employee record",
+your primary response should be "LOAD_ADD_EMPLOYEE_FORM".
+You can optionally try to extract any mentioned details (like name, department, salary) and provide them as pre_fill_data.
+Example: "Add a new Sales Rep named Alice Wonderland with salary 80000 in the Oxford Sales department."
+Response should be "LOAD_ADD_EMPLOYEE_FORM" with pre_fill_data:
+pre_fill_data: {"first_name": "Alice", "last_name": "Wonderland", "department_id": 80, "job_id": "SA_REP", "salary": 80000}"""
+UPDATE_LIMIT_NOTE = """IMPORTANT NOTE FOR UPDATES WITH LIMIT:
+If you need to update a limited number of rows from the 'employees' table (e.g., "update the first 3 employees"),
+MySQL/MariaDB does not support 'LIMIT' directly in a subquery within an 'IN' clause for an UPDATE on the same table.
+Instead, use a JOIN with a derived table.
+Example: To update the hire_date for the first 3 employees (ordered by id):
+UPDATE employees e
+JOIN (SELECT id FROM employees ORDER BY id ASC LIMIT 3) AS temp_ids ON e.id = temp_ids.id
+SET e.hire_date = 'YYYY-MM-DD';
+ALWAYS include an ORDER BY clause with LIMIT to ensure deterministic results for which rows are selected."""
+ADD_INTENT_WORDS = {"add", "hire", "hiring", "new", "insert", "onboard", "recruit", "create"}
+UPDATE_INTENT_WORDS = {"update", "change", "set", "modify", "raise", "increase", "decrease", "move", "approve", "reject", "limit", "first", "last"}
+NAME_LIKE_COLUMN_PATTERN = re.compile(r"(^|_)(name|title)$")
+
+
+def question_tokens(text: str) -> set:
+    """Lower-cased words of a question plus naive singular forms ("employees" -> "employee")."""
+    tokens = set(re.findall(r"[a-z0-9]+", text.lower()))
+    for token in list(tokens):
+        if len(token) > 3 and token.endswith("ies"):
+            tokens.add(token[:-3] + "y")
+        elif len(token) > 3 and token.endswith("es"):
+            tokens.update((token[:-2], token[:-1]))
+        elif len(token) > 3 and token.endswith("s"):
+            tokens.add(token[:-1])
+    return tokens
+
+
+class SchemaCatalog:
+    """
+    Cached view of the database schema read from INFORMATION_SCHEMA, plus a keyword index for pruning prompts.
+    Re-read when a cheap column checksum changes (checked every `check_interval` seconds) or after `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float, check_interval: float):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+        self._fingerprint = None
+        self._stats = {"refreshes": 0, "ddl_changes": 0, "introspection_failures": 0}
+        self._install(self._fallback_tables(), source="static")
+
+    def is_stale(self) -> bool:
+        now = time.monotonic()
+        if now - self._checked_at > self.check_interval:
+            return True
+        # An expired TTL forces a re-read, but a failed re-read is only retried after check_interval.
+        return now - self._loaded_at > self.ttl and self._checked_at < self._loaded_at + self.ttl
+
+    def invalidate(self):
+        """Forces a re-read on the next request, e.g. after an 'unknown column' error."""
+        with self._lock:
+            self._checked_at = self._loaded_at = 0.0
+            self._fingerprint = None
+
+    def refresh(self):
+        """Blocking: re-reads the schema if the checksum changed or the TTL expired. Run it on the DB stage."""
+        if not self.is_stale():
+            return
+        with self._lock:
+            if not self.is_stale():  # Another request refreshed while we waited
+                return
+            now = time.monotonic()
+            self._checked_at = now
+            conn = get_db_connection()
+            if not conn:
+                self._stats["introspection_failures"] += 1
+                return
+            cursor = None
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(
+                    "SELECT COUNT(*) AS column_count, COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, "
+                    "IS_NULLABLE, COLUMN_KEY, COLUMN_COMMENT))), 0) AS checksum "
+                    "FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = DATABASE()")
+                row = cursor.fetchone()
+                fingerprint = f"{row['column_count']}:{row['checksum']}"
+                if fingerprint == self._fingerprint and now - self._loaded_at <= self.ttl:
+                    return
+                if self._fingerprint is not None and fingerprint != self._fingerprint:
+                    self._stats["ddl_changes"] += 1
+                tables = self._introspect(cursor)
+                if tables:
+                    self._install(tables, source="information_schema")
+                    self._fingerprint = fingerprint
+                    self._loaded_at = now
+                    self._stats["refreshes"] += 1
+                    log_event(logging.INFO, "schema_catalog.refreshed", tables=len(tables))
+            except Exception as e:  # Best effort: a failed introspection must never fail the chat request
+                log_event(logging.WARNING, "schema_catalog.introspection_failed", error=str(e))
+                self._stats["introspection_failures"] += 1
+            finally:
+                if cursor:
+                    cursor.close()
+                conn.close()
+
+    @staticmethod
+    def _introspect(cursor) -> dict:
+        tables = {}
+        cursor.execute("SELECT TABLE_NAME, TABLE_COMMENT FROM INFORMATION_SCHEMA.TABLES "
+                       "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'")
+        for row in cursor.fetchall():
+            tables[row["TABLE_NAME"]] = {"comment": row["TABLE_COMMENT"], "columns": [], "primary_key": [], "foreign_keys": []}
+        cursor.execute("SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY, COLUMN_DEFAULT, EXTRA, COLUMN_COMMENT "
+                       "FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION")
+        for row in cursor.fetchall():
+            table = tables.get(row["TABLE_NAME"])
+            if table is None:
+                continue  # Views
+            attributes = [row["COLUMN_TYPE"].upper()]
+            if row["COLUMN_KEY"] == "PRI":
+                attributes.append("PRIMARY KEY")
+                table["primary_key"].append(row["COLUMN_NAME"])
+            elif row["COLUMN_KEY"] == "UNI":
+                attributes.append("UNIQUE")
+            if "auto_increment" in (row["EXTRA"] or "").lower():
+                attributes.append("AUTO_INCREMENT")
+            if row["IS_NULLABLE"] == "NO" and row["COLUMN_KEY"] != "PRI":
+                attributes.append("NOT NULL")
+            if row["COLUMN_DEFAULT"] is not None:
+                attributes.append(f"DEFAULT {row['COLUMN_DEFAULT']}")
+            table["columns"].append({"name": row["COLUMN_NAME"], "type": ", ".join(attributes), "comment": row["COLUMN_COMMENT"]})
+        cursor.execute("SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+                       "FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE "
+                       "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL")
+        for row in cursor.fetchall():
+            if row["TABLE_NAME"] in tables:
+                tables[row["TABLE_NAME"]]["foreign_keys"].append(
+                    (row["COLUMN_NAME"], row["REFERENCED_TABLE_NAME"], row["REFERENCED_COLUMN_NAME"]))
+        return tables
+
+    @staticmethod
+    def _fallback_tables() -> dict:
+        tables = {}
+        for table, columns in FALLBACK_COLUMNS.items():
+            tables[table] = {
+                "comment": "",
+                "columns": [{"name": name, "type": type_desc, "comment": ""} for name, type_desc in columns],
+                "primary_key": [name for name, type_desc in columns if "PRIMARY KEY" in type_desc],
+                "foreign_keys": [],
+            }
+        return tables
+
+    def _install(self, tables: dict, source: str):
+        for table, column, ref_table, ref_column in DOCUMENTED_FOREIGN_KEYS:
+            if table in tables and ref_table in tables and (column, ref_table, ref_column) not in tables[table]["foreign_keys"]:
+                if any(c["name"] == column for c in tables[table]["columns"]):
+                    tables[table]["foreign_keys"].append((column, ref_table, ref_column))
+
+        # Keyword index: word -> tables, and (table, word) -> columns whose name contains that word.
+        table_index, column_index = {}, {}
+        neighbours = {table: set() for table in tables}
+        for table, info in tables.items():
+            words = question_tokens(table.replace("_", " ")) | set(TABLE_KEYWORDS.get(table, []))
+            for word in words:
+                table_index.setdefault(word, set()).add(table)
+            fk_columns = {fk[0] for fk in info["foreign_keys"]}
+            for column in info["columns"]:
+                for word in question_tokens(column["name"].replace("_", " ")):
+                    # Generic words and FK columns (payments.employee_id says "employee") would point at the wrong table.
+                    if word not in ("id", "date", "type") and column["name"] not in fk_columns:
+                        table_index.setdefault(word, set()).add(table)
+                    column_index.setdefault((table, word), set()).add(column["name"])
+            for column, ref_table, _ in info["foreign_keys"]:
+                if ref_table in neighbours and ref_table != table:
+                    neighbours[table].add(ref_table)
+                    neighbours[ref_table].add(table)
+        self._tables = tables
+        self._table_index = table_index
+        self._column_index = column_index
+        self._neighbours = neighbours
+        self.source = source
+
+    @property
+    def table_names(self) -> tuple:
+        return tuple(self._tables)
+
+    def primary_key(self, table: str) -> list:
+        info = self._tables.get(table)
+        return list(info["primary_key"]) if info else []
+
+    def column_names(self, table: str) -> list:
+        info = self._tables.get(table)
+        return [column["name"] for column in info["columns"]] if info else []
+
+    def relevant_tables(self, user_message: str) -> dict:
+        """
+        Tables (and columns) a question needs: tables matched by keyword, every table on the FK path
+        between them, and the tables their foreign keys point at. Returns {table: columns or None for all}.
+        An empty dict means nothing matched and the whole schema should be used.
+        """
+        tokens = question_tokens(user_message)
+        matched = set()
+        for token in tokens:
+            matched |= self._table_index.get(token, set())
+        if not matched:
+            return {}
+
+        selected = set(matched)
+        ordered = sorted(matched)
+        for i, start in enumerate(ordered):
+            for end in ordered[i + 1:]:
+                selected.update(self._join_path(start, end))
+        for table in matched:
+            selected.update(ref_table for _, ref_table, _ in self._tables[table]["foreign_keys"])
+
+        relevant = {}
+        for table in selected:
+            if table in matched:
+                relevant[table] = None
+                continue
+            # Tables pulled in only to join through keep their keys, name-like columns and any column the question names.
+            info = self._tables[table]
+            columns = set(info["primary_key"]) | {fk[0] for fk in info["foreign_keys"]}
+            columns |= {c["name"] for c in info["columns"] if NAME_LIKE_COLUMN_PATTERN.search(c["name"])}
+            for token in tokens:
+                columns |= self._column_index.get((table, token), set())
+            relevant[table] = columns
+        return relevant
+
+    def _join_path(self, start: str, end: str) -> list:
+        previous = {start: None}
+        frontier = deque([start])
+        while frontier:
+            table = frontier.popleft()
+            if table == end:
+                path = []
+                while table is not None:
+                    path.append(table)
+                    table = previous[table]
+                return path
+            for neighbour in self._neighbours.get(table, ()):
+                if neighbour not in previous:
+                    previous[neighbour] = table
+                    frontier.append(neighbour)
+        return []
+
+    def describe(self, relevant: dict = None, user_message: str = "") -> str:
+        relevant = relevant or {table: None for table in self._tables}
+        tokens = question_tokens(user_message)
+        lines = ["You have access to a MySQL database with the following tables for an HR Management system:", ""]
+        for number, table in enumerate([t for t in self._tables if t in relevant], start=1):
+            info = self._tables[table]
+            wanted = relevant[table]
+            lines.append(f"{number}. Table: {table}")
+            description = TABLE_NOTES.get(table) or info["comment"]
+            if description:
+                lines.append(f"   Description: {description}")
+            lines.append("   Columns:")
+            fk_targets = {column: f"{ref_table}.{ref_column}" for column, ref_table, ref_column in info["foreign_keys"]}
+            for column in info["columns"]:
+                if wanted is not None and column["name"] not in wanted:
+                    continue
+                type_desc = column["type"]
+                if column["name"] in fk_targets:
+                    type_desc += f", FOREIGN KEY to {fk_targets[column['name']]}"
+                note = COLUMN_NOTES.get((table, column["name"])) or column["comment"]
+                lines.append(f"     - {column['name']} ({type_desc})" + (f" - {note}" if note else ""))
+            if info["foreign_keys"]:
+                lines.append("   Relationships:")
+                for column, ref_table, ref_column in info["foreign_keys"]:
+                    lines.append(f"     - {table}.{column} references {ref_table}.{ref_column}")
+            lines.append("")
+
+        notes = [text for tables, text in GENERAL_NOTES if tables <= set(relevant)]
+        if notes:
+            lines.append("General Querying Notes:")
+            lines.extend(f"- {text}" for text in notes)
+            lines.append("")
+        if not user_message or tokens & ADD_INTENT_WORDS:
+            lines.extend([ADD_EMPLOYEE_NOTE, ""])
+        if not user_message or tokens & UPDATE_INTENT_WORDS:
+            lines.extend([UPDATE_LIMIT_NOTE, ""])
+        lines.append(f"Today's date is {datetime.date.today().isoformat()}.")
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {"source": self.source, "tables": len(self._tables), **self._stats}
+
+
+schema_catalog = SchemaCatalog(ttl=SCHEMA_CACHE_TTL, check_interval=SCHEMA_CHECK_INTERVAL)
+
+def get_database_schema_description(user_message: str = None) -> str:
+    """
+    Schema text for the prompt, built from the cached catalog.
+    With `user_message`, only the tables and columns relevant to that question are described.
+    """
+    relevant = schema_catalog.relevant_tables(user_message) if user_message else {}
+    return schema_catalog.describe(relevant, user_message or "")
+
+def build_sql_prompt(user_message: str, schema_description: str, allow_writes: bool = False) -> str:
+    allowed_operations_str = "SELECT"
+    if allow_writes:
+        allowed_operations_str += ", " + ", ".join(ALLOWED_WRITE_OPERATIONS)
+
+    prompt = f"""
+    Given the following database schema:
+    {schema_description}
+
+    And the user's question/command:
+    "{user_message}"
+
+    Analyze the user's intent.
+    1. If the user wants to query data (e.g., "show me", "find", "list", "what is"), generate a MySQL SELECT query.
+    2. If the user wants to modify existing data (e.g., "update salary", "change department"), generate a MySQL UPDATE query.
+    3. If the user explicitly wants to "add a new employee", "hire someone", or "insert a new employee record":
+       Respond with the exact text "LOAD_ADD_EMPLOYEE_FORM".
+       Optionally, if you can extract details like name, department, salary, etc., from the user's message,
+       provide them in a JSON string format after "LOAD_ADD_EMPLOYEE_FORM" on a new line, like this:
+       LOAD_ADD_EMPLOYEE_FORM
+       pre_fill_data: {{"first_name": "example", "salary": "50000"}}
+       (Only include pre_fill_data if details are clearly mentioned for a new employee).
+    4. If the question cannot be answered or the command cannot be fulfilled with the allowed SQL types or actions, respond with "CANNOT_ANSWER".
+    5. If the question is a greeting, farewell, or general chit-chat not related to data, respond with "GENERAL_CHAT".
+
+    Response (SQL Query, or "LOAD_ADD_EMPLOYEE_FORM" potentially with pre_fill_data, or "CANNOT_ANSWER", or "GENERAL_CHAT"):
+    """
+    return prompt
+
+def parse_gemini_response(response, allow_writes: bool = False) -> tuple[str | None, str | None, dict | None]:
+    pre_fill_data = None
+    if response.parts:
+        generated_text_full = response.text.strip()
+        log_event(logging.INFO, "gemini.response", text=generated_text_full)
+
+        lines = generated_text_full.split('\n')
+        main_response_line = lines[0].strip()
+
+        if main_response_line == "LOAD_ADD_EMPLOYEE_FORM":
+            if len(lines) > 1 and lines[1].strip().startswith("pre_fill_data:"):
+                try:
+                    json_str = lines[1].strip().replace("pre_fill_data:", "").strip()
+                    pre_fill_data = json.loads(json_str)
+                except json.JSONDecodeError as e:
+                    log_event(logging.WARNING, "gemini.pre_fill_invalid", error=str(e), json=json_str)
+                    pre_fill_data = {}
+                except Exception as e_gen:
+                    log_event(logging.WARNING, "gemini.pre_fill_invalid", error=str(e_gen))
+                    pre_fill_data = {}
+            return "LOAD_ADD_EMPLOYEE_FORM", "LOAD_ADD_EMPLOYEE_FORM", pre_fill_data
+
+        if main_response_line == "CANNOT_ANSWER" or main_response_line == "GENERAL_CHAT":
+            return main_response_line, main_response_line.upper(), None
+
+         # Use generated_text_full for SQL extraction, not just the first line
+        potential_sql = generated_text_full 
+        
+        # Remove markdown backticks and any "sql" language specifier
+        cleaned_sql = re.sub(r"^```(?:sql)?\s*", "", potential_sql, flags=re.IGNORECASE | re.MULTILINE)
+        cleaned_sql = re.sub(r"\s*```$", "", cleaned_sql, flags=re.MULTILINE)
+        cleaned_sql = cleaned_sql.strip() # This should now be the pure SQL
+
+        query_upper = cleaned_sql.upper() # Use the cleaned version for type checking
+        query_type = None
+        if query_upper.startswith("SELECT"):
+            query_type = "SELECT"
+        elif allow_writes:
+            for op_type in ALLOWED_WRITE_OPERATIONS:
+                if query_upper.startswith(op_type):
+                    query_type = op_type
+                    break
+        
+        if query_type:
+            return cleaned_sql, query_type, None # Return the fully cleaned SQL
+        else:
+            # This 'else' block is being hit because query_upper (from the cleaned full text)
+            # doesn't start with a recognized command.
+            log_event(logging.WARNING, "gemini.unsupported_query_type", raw=generated_text_full, cleaned=cleaned_sql)
+            return "CANNOT_ANSWER", "CANNOT_ANSWER", None
+    else:
+        log_event(logging.WARNING, "gemini.empty_response", block_reason=getattr(response.prompt_feedback, "block_reason", None))
+        return "CANNOT_ANSWER", "CANNOT_ANSWER", None
+
+def _prepare_gemini_prompt(user_message: str, schema_description: str, allow_writes: bool) -> str:
+    with stage_timer("prompt_build"):
+        prompt = build_sql_prompt(user_message, schema_description, allow_writes)
+    if LOG_PROMPTS:
+        log_event(logging.DEBUG, "gemini.prompt", prompt=prompt)
+    log_event(logging.INFO, "gemini.request", user_message=user_message, prompt_chars=len(prompt), allow_writes=allow_writes)
+    return prompt
+
+def record_llm_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    llm_tokens_total.inc(getattr(usage, "prompt_token_count", 0) or 0, kind="prompt")
+    llm_tokens_total.inc(getattr(usage, "candidates_token_count", 0) or 0, kind="completion")
+
+def generate_sql_with_gemini(user_message: str, schema_description: str, allow_writes: bool = False) -> tuple[str | None, str | None, dict | None]:
+    prompt = _prepare_gemini_prompt(user_message, schema_description, allow_writes)
+    if model is None:
+        log_event(logging.ERROR, "gemini.not_configured")
+        return None, None, None
+    try:
+        with stage_timer("llm"):
+            response = model.generate_content(prompt)
+        llm_calls_total.inc(outcome="ok")
+        record_llm_usage(response)
+        return parse_gemini_response(response, allow_writes)
+    except Exception as e:
+        llm_calls_total.inc(outcome="error")
+        log_event(logging.ERROR, "gemini.failed", error=str(e))
+        return None, None, None
+
+async def generate_sql_with_gemini_async(user_message: str, schema_description: str, allow_writes: bool = False) -> tuple[str | None, str | None, dict | None]:
+    """Same as generate_sql_with_gemini, but awaits the model without holding a thread."""
+    prompt = _prepare_gemini_prompt(user_message, schema_description, allow_writes)
+    if model is None:
+        log_event(logging.ERROR, "gemini.not_configured")
+        return None, None, None
+    try:
+        with stage_timer("llm"):
+            response = await model.generate_content_async(prompt)
+        llm_calls_total.inc(outcome="ok")
+        record_llm_usage(response)
+        return parse_gemini_response(response, allow_writes)
+    except Exception as e:
+        llm_calls_total.inc(outcome="error")
+        log_event(logging.ERROR, "gemini.failed", error=str(e))
+        return None, None, None
+
+# --- Generated SQL Cache ---
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", "512"))  # Entries kept in memory (LRU)
+SQL_CACHE_TTL = float(os.getenv("SQL_CACHE_TTL", "21600"))  # Seconds before a cached generation is re-asked
+SQL_CACHE_PATH = os.getenv("SQL_CACHE_PATH")  # Optional SQLite file so the cache survives restarts
+
+# Questions with relative dates get the literal date baked into the SQL (the prompt embeds today's date),
+# so their entries are only valid for the day they were generated.
+DATE_DEPENDENT_PATTERN = re.compile(
+    r"\b(today|tonight|tomorrow|yesterday|now|current(ly)?|recent(ly)?|ago|upcoming|so far|"
+    r"(this|last|next|past|previous) (\d+ )?(days?|weeks?|months?|quarters?|years?))\b",
+    re.IGNORECASE,
+)
+# A date literal in the generated SQL may have been computed from today ("last 30 days" -> '2024-05-02'),
+# so such entries are day-scoped too even when the question itself did not look relative.
+SQL_DATE_LITERAL_PATTERN = re.compile(r"'\d{4}-\d{2}-\d{2}")
+# Result types worth caching; CANNOT_ANSWER can stem from transient blocks, so it is always re-asked.
+CACHEABLE_COMMAND_TYPES = {"SELECT", "UPDATE", "INSERT", "LOAD_ADD_EMPLOYEE_FORM", "GENERAL_CHAT"}
+
+
+def normalize_user_message(user_message: str) -> str:
+    normalized = re.sub(r"\s+", " ", user_message.strip().lower())
+    return normalized.rstrip("?!. ")
+
+
+class SQLGenerationCache:
+    """
+    LRU + TTL cache of Gemini generations keyed on the normalized question, the schema description
+    and the model name. With `path` set, entries are also written through to a SQLite file.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, path: str = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> {"value", "created_at", "day"}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "disk_hits": 0, "expired": 0, "evictions": 0}
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS sql_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, day TEXT)")
+                self._db.execute("DELETE FROM sql_cache WHERE created_at < ?", (time.time() - ttl,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                log_event(logging.WARNING, "sql_cache.open_failed", path=path, error=str(e))
+                self._db = None
+
+    @staticmethod
+    def make_key(user_message: str, schema_description: str, allow_writes: bool) -> str:
+        # The date line in the schema changes daily; date-dependent entries are handled by their `day` tag instead.
+        schema_fingerprint = schema_description.replace(datetime.date.today().isoformat(), "")
+        raw_key = "\0".join([model_to_use, str(allow_writes), hashlib.sha256(schema_fingerprint.encode()).hexdigest(), normalize_user_message(user_message)])
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    def get(self, key: str):
+        today = datetime.date.today().isoformat()
+        with self._lock:
+            entry = self._entries.get(key)
+            from_disk = False
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT value, created_at, day FROM sql_cache WHERE key = ?", (key,)).fetchone()
+                if row:
+                    entry = {"value": tuple(json.loads(row[0])), "created_at": row[1], "day": row[2]}
+                    from_disk = True
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if time.time() - entry["created_at"] > self.ttl or (entry["day"] and entry["day"] != today):
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                self._delete_locked(key)
+                return None
+            if from_disk:
+                self._stats["disk_hits"] += 1
+                self._store_locked(key, entry)
+            else:
+                self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry["value"]
+
+    def put(self, key: str, value: tuple, user_message: str):
+        generated_command, command_type, _ = value
+        if command_type not in CACHEABLE_COMMAND_TYPES:
+            return
+        today = datetime.date.today().isoformat()
+        date_dependent = bool(DATE_DEPENDENT_PATTERN.search(user_message) or SQL_DATE_LITERAL_PATTERN.search(generated_command or ""))
+        entry = {"value": value, "created_at": time.time(), "day": today if date_dependent else None}
+        with self._lock:
+            self._store_locked(key, entry)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO sql_cache (key, value, created_at, day) VALUES (?, ?, ?, ?)",
+                                     (key, json.dumps(list(value)), entry["created_at"], entry["day"]))
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    log_event(logging.WARNING, "sql_cache.write_failed", error=str(e))
+
+    def _store_locked(self, key: str, entry: dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _delete_locked(self, key: str):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            try:
+                self._db.execute("DELETE FROM sql_cache WHERE key = ?", (key,))
+                self._db.commit()
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "persistent": self._db is not None,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+                **self._stats,
+            }
+
+
+sql_cache = SQLGenerationCache(max_entries=SQL_CACHE_SIZE, ttl=SQL_CACHE_TTL, path=SQL_CACHE_PATH)
+
+async def generate_sql_cached(user_message: str, schema_description: str, allow_writes: bool = False) -> tuple[str | None, str | None, dict | None]:
+    """
+    generate_sql_with_gemini_async with the normalized question -> SQL cache in front of it, under the LLM stage limits.
+    Identical questions already in flight are coalesced onto one call.
+    """
+    cache_key = sql_cache.make_key(user_message, schema_description, allow_writes)
+    cached = sql_cache.get(cache_key)
+    if cached is not None:
+        log_event(logging.INFO, "sql_cache.hit", user_message=user_message)
+        return cached
+
+    async def generate():
+        result = await llm_stage.run(lambda: generate_sql_with_gemini_async(user_message, schema_description, allow_writes=allow_writes))
+        if result[0] is not None:
+            sql_cache.put(cache_key, result, user_message)
+        return result
+
+    # The cache key is the normalized question, so concurrent askers of the same question share one Gemini call.
+    return await llm_flight.run(cache_key, generate)
+
+# --- Response Encoding ---
+# orjson and brotli are optional: without them responses use the stdlib json encoder and gzip only.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "2048"))  # Smaller bodies are sent as is
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "5"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "4"))
+# DATA_RESULT/DATA_PAGE layouts a client can ask for with "result_format":
+# rows (default) - a list of {column: value} objects
+# compact - {"columns": [...], "rows": [[...], ...]}, column names sent once
+# columnar - {"columns": [...], "values": [[...], ...]}, one array per column
+RESULT_FORMATS = ("rows", "compact", "columnar")
+
+response_bytes_total = Counter("hr_chat_response_bytes_total", "JSON response bytes before and after compression.", ("encoding", "stage"))
+
+
+def encode_json_value(value):
+    """Encoder fallback for values the JSON encoder does not know: dates as ISO strings, Decimals as floats."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    return str(value)  # e.g. timedelta for TIME columns
+
+
+def dumps_json(payload) -> bytes:
+    """Serializes a response in one pass; database values are converted by the encoder, not beforehand."""
+    if orjson is not None:
+        return orjson.dumps(payload, default=encode_json_value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=encode_json_value, separators=(",", ":")).encode()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() through dumps_json, keeping column order as selected instead of sorting keys."""
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps_json(obj).decode()
+
+    def response(self, *args, **kwargs):
+        return self._app.response_class(dumps_json(self._prepare_response_obj(args, kwargs)), mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+
+def requested_result_format(data: dict) -> str:
+    result_format = data.get("result_format") if isinstance(data, dict) else None
+    return result_format if result_format in RESULT_FORMATS else "rows"
+
+
+def format_result_data(rows: list, columns: list = None, result_format: str = "rows"):
+    """Lays out SELECT rows (dicts) in the requested format; the reshaping runs in C via itemgetter/zip."""
+    if result_format == "rows" or rows is None:
+        return rows
+    columns = list(columns or (rows[0].keys() if rows else []))
+    column_values = [map(itemgetter(column), rows) for column in columns]
+    if result_format == "columnar":
+        return {"columns": columns, "values": [list(values) for values in column_values]}
+    return {"columns": columns, "rows": list(zip(*column_values))}
+
+
+def apply_result_format(payload: dict, result_format: str) -> dict:
+    """Re-lays a DATA_RESULT/DATA_PAGE payload's rows for the client; `data_format` tells it which layout it got."""
+    columns = payload.pop("columns", None)
+    if result_format != "rows" and payload.get("data") is not None:
+        payload["data"] = format_result_data(payload["data"], columns, result_format)
+        payload["data_format"] = result_format
+    return payload
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Best of br/gzip the client accepts (q > 0), preferring br when both are equally acceptable."""
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    candidates = [name for name in candidates if accepted.get(name, accepted.get("*", 0)) > 0]
+    return max(candidates, key=lambda name: accepted.get(name, accepted.get("*", 0)), default=None)
+
+
+def compress_body(body: bytes, accept_encoding: str) -> tuple[bytes, str | None]:
+    """(body, Content-Encoding): bodies under RESPONSE_COMPRESS_MIN_BYTES or without a usable encoding stay as they are."""
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= RESPONSE_COMPRESS_MIN_BYTES else None
+    response_bytes_total.inc(len(body), encoding=encoding or "identity", stage="raw")
+    if encoding == "br":
+        body = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL)
+    response_bytes_total.inc(len(body), encoding=encoding or "identity", stage="sent")
+    return body, encoding
+
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers):
+        return response
+    body, encoding = compress_body(response.get_data(), request.headers.get("Accept-Encoding", ""))
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+# --- SELECT Result Cache ---
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # Memory budget for cached rows
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(RESULT_CACHE_MAX_BYTES // 8)))  # Larger results are not cached
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "30"))  # Bounds staleness from writes made by other workers or outside this app
+
+HR_TABLES = ("employees", "departments", "payments", "leave_requests")
+SQL_STRING_LITERAL_PATTERN = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\")")
+# Results of these depend on when they run, not only on table contents.
+NON_DETERMINISTIC_SQL_PATTERN = re.compile(
+    r"\b(now|curdate|curtime|current_date|current_time|current_timestamp|sysdate|utc_date|utc_timestamp|rand|uuid|unix_timestamp)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_sql(sql_query: str) -> str:
+    """Collapses whitespace and case outside string literals so trivially different SQL shares a cache key."""
+    parts = SQL_STRING_LITERAL_PATTERN.split(sql_query.strip().rstrip(";").strip())
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part).lower() for i, part in enumerate(parts))
+
+
+def referenced_tables(sql_query: str) -> set:
+    """Known tables mentioned in a statement, ignoring string literals."""
+    code = SQL_STRING_LITERAL_PATTERN.sub("''", sql_query).lower()
+    known_tables = set(HR_TABLES) | {table.lower() for table in schema_catalog.table_names}
+    return {table for table in known_tables if re.search(rf"\b`?{re.escape(table)}`?\b", code)}
+
+
+class QueryResultCache:
+    """
+    Size-aware LRU cache of SELECT results keyed by normalized SQL and parameters.
+    Entries are tagged with the tables they read, and writes evict every entry tagged with a table they touched.
+    Per process: a write only evicts this worker's entries, so other workers may serve pre-write rows for up to `ttl`
+    seconds. Keep the TTL short with several workers, or run a single worker when reads must follow writes exactly.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> {"result", "tables", "size", "created_at"}
+        self._by_table = defaultdict(set)
+        self._generations = defaultdict(int)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "skipped_too_large": 0}
+
+    @staticmethod
+    def make_key(sql_query: str, params: tuple = None) -> str:
+        raw_key = normalize_sql(sql_query) + "\0" + json.dumps(list(params or ()), default=str)
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    @staticmethod
+    def is_cacheable(sql_query: str) -> bool:
+        return bool(referenced_tables(sql_query)) and not NON_DETERMINISTIC_SQL_PATTERN.search(SQL_STRING_LITERAL_PATTERN.sub("''", sql_query))
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry["created_at"] > self.ttl:
+                if entry is not None:
+                    self._remove_locked(key)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry["result"]
+
+    def generation(self, tables: set) -> tuple:
+        """Snapshot taken before running a SELECT; put() refuses results that a write may have made stale meanwhile."""
+        with self._lock:
+            return tuple(self._generations[table] for table in sorted(tables))
+
+    def put(self, key: str, result: dict, tables: set, generation: tuple):
+        size = len(dumps_json(result["data"]))
+        with self._lock:
+            if generation != tuple(self._generations[table] for table in sorted(tables)):
+                return
+            if size > self.max_entry_bytes:
+                self._stats["skipped_too_large"] += 1
+                return
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = {"result": result, "tables": tables, "size": size, "created_at": time.monotonic()}
+            self._bytes += size
+            for table in tables:
+                self._by_table[table].add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove_locked(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate_tables(self, tables: set):
+        tables = tables or set(HR_TABLES) | set(self._by_table)  # A write we cannot attribute invalidates everything
+        with self._lock:
+            for table in tables:
+                self._generations[table] += 1
+                for key in list(self._by_table[table]):
+                    self._remove_locked(key)
+                    self._stats["invalidations"] += 1
+
+    def _remove_locked(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry["size"]
+        for table in entry["tables"]:
+            self._by_table[table].discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, **self._stats}
+
+
+result_cache = QueryResultCache(max_bytes=RESULT_CACHE_MAX_BYTES, max_entry_bytes=RESULT_CACHE_MAX_ENTRY_BYTES, ttl=RESULT_CACHE_TTL)
+
+def execute_query(sql_query: str, query_type: str, params: tuple = None) -> dict:
+    """
+    Executes the SQL query.
+    For SELECT, returns data.
+    For INSERT/UPDATE/DELETE, returns affected_rows and success message.
+    `params` is a tuple of values for parameterized queries.
+    SELECT results are served from `result_cache` when possible; writes evict the tables they touch.
+    Rows keep their database types (Decimal, date); dumps_json converts them when the response is encoded.
+    """
+    cache_key = cache_tables = cache_generation = None
+    if query_type == "SELECT" and QueryResultCache.is_cacheable(sql_query):
+        cache_key = QueryResultCache.make_key(sql_query, params)
+        cached_result = result_cache.get(cache_key)
+        if cached_result is not None:
+            log_event(logging.INFO, "result_cache.hit", sql=sql_query)
+            return {**cached_result, "cached": True}
+        cache_tables = referenced_tables(sql_query)
+        cache_generation = result_cache.generation(cache_tables)
+
+    conn = get_db_connection(read_only=(query_type == "SELECT"))
+    if not conn:
+        return {"error": "Database connection failed."}
+
+    cursor = None
+    started = None
+    try:
+        # Use dictionary=True only for SELECT to get column names in results
+        cursor = conn.cursor(dictionary=(query_type == "SELECT"))
+        
+        log_event(logging.INFO, "query.execute", query_type=query_type, sql=sql_query, params=params, replica=conn.replica)
+        statement = with_execution_time_limit(sql_query, is_mariadb(conn)) if query_type == "SELECT" else sql_query
+        maintenance = plan_summary_maintenance(sql_query, query_type, params, cursor) if query_type in ALLOWED_WRITE_OPERATIONS else None
+        if maintenance:
+            begin_summary_maintenance(cursor, maintenance)
+        started = time.perf_counter()
+        with stage_timer("db_execute"):
+            if params:
+                cursor.execute(statement, params)
+            else:
+                cursor.execute(statement)
+            results = cursor.fetchall() if query_type == "SELECT" else None
+        query_log.record(sql_query, params, query_type, time.perf_counter() - started,
+                         len(results) if results is not None else cursor.rowcount)
+
+        if query_type == "SELECT":
+            log_event(logging.INFO, "query.fetched", rows=len(results))
+            result = {"data": results, "columns": list(dict.fromkeys(cursor.column_names)), "rows_affected": len(results)}
+            # A lagging replica may not have a just-written row yet; do not cache what it returned for those tables.
+            if cache_key and not (conn.replica and recent_writes.tables_recently_written(cache_tables)):
+                result_cache.put(cache_key, result, cache_tables, cache_generation)
+            return result
+        elif query_type in ALLOWED_WRITE_OPERATIONS:
+            affected_rows = cursor.rowcount
+            last_row_id = cursor.lastrowid if query_type == "INSERT" else None
+            touched_tables = referenced_tables(sql_query)
+            if maintenance:
+                with stage_timer("summary_maintenance"):
+                    finish_summary_maintenance(cursor, maintenance, affected_rows, last_row_id)
+                touched_tables |= set(maintenance["summaries"])
+            conn.commit()
+            result_cache.invalidate_tables(touched_tables)
+            recent_writes.note(current_session_id(), touched_tables)
+            log_event(logging.INFO, "query.write_committed", query_type=query_type, rows_affected=affected_rows, last_row_id=last_row_id)
+            response = {"message": f"{query_type} successful. {affected_rows} row(s) affected.", "rows_affected": affected_rows}
+            if last_row_id is not None:
+                response["new_employee_id"] = last_row_id
+            return response
+        else:
+            # This case should ideally not be reached if query_type is validated before calling
+            return {"error": "Unsupported query type for execution."}
+
+    except MySQLError as e:
+        log_event(logging.ERROR, "query.failed", query_type=query_type, sql=sql_query, errno=e.errno, error=str(e))
+        if started is not None:
+            query_log.record(sql_query, params, query_type, time.perf_counter() - started, error=True)
+        if e.errno in (1054, 1146):  # Unknown column / table: the cached schema may be out of date
+            schema_catalog.invalidate()
+        if e.errno == 3024:  # ER_QUERY_TIMEOUT from the MAX_EXECUTION_TIME hint
+            return {"error": f"The query was stopped after {QUERY_MAX_EXECUTION_MS / 1000:g} seconds. Try a narrower question.", "query_attempted": sql_query}
+        if conn:
+            try:
+                conn.rollback()
+            except MySQLError as rb_err:
+                log_event(logging.ERROR, "query.rollback_failed", error=str(rb_err))
+        return {"error": str(e), "query_attempted": sql_query}
+    except ValueError as ve:
+         return {"error": str(ve), "query_attempted": sql_query}
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()  # Returns the connection to the pool (broken ones are discarded there)
+
+# --- Summary Tables ---
+SUMMARY_MAX_DELTA_ROWS = int(os.getenv("SUMMARY_MAX_DELTA_ROWS", "5000"))  # Writes touching more source rows rebuild the summary instead
+SUMMARY_REBUILD_CHUNK_DAYS = 366  # Calendar days per leave_day_summary statement (stays under cte_max_recursion_depth)
+SUMMARY_PRESENCE_TTL = float(os.getenv("SUMMARY_PRESENCE_TTL", "300"))  # Seconds a summary table found in the database is trusted to exist
+
+SUMMARY_TABLE_DDL = {
+    "payroll_summary": """CREATE TABLE IF NOT EXISTS payroll_summary (
+        pay_month DATE NOT NULL COMMENT 'First day of the month the payments were made in',
+        employee_id INT NOT NULL,
+        department_id INT NOT NULL DEFAULT 0 COMMENT 'Current department of the employee (0 if none)',
+        payment_type VARCHAR(50) NOT NULL,
+        payment_count INT NOT NULL,
+        total_amount DECIMAL(14, 2) NOT NULL,
+        PRIMARY KEY (pay_month, employee_id, payment_type),
+        KEY idx_payroll_summary_employee (employee_id, pay_month),
+        KEY idx_payroll_summary_department (department_id, pay_month)
+    ) COMMENT 'Payment totals per employee, month and payment type, maintained from payments'""",
+    "leave_day_summary": """CREATE TABLE IF NOT EXISTS leave_day_summary (
+        leave_date DATE NOT NULL,
+        department_id INT NOT NULL DEFAULT 0 COMMENT 'Current department of the employees (0 if none)',
+        status VARCHAR(20) NOT NULL,
+        employees_on_leave INT NOT NULL,
+        leave_requests INT NOT NULL,
+        PRIMARY KEY (leave_date, department_id, status),
+        KEY idx_leave_day_summary_status (status, leave_date)
+    ) COMMENT 'Employees on leave per calendar day, department and request status, maintained from leave_requests'""",
+}
+# Source table -> summaries derived from it. Employees only matter through department_id.
+SUMMARY_SOURCES = {
+    "payments": ("payroll_summary",),
+    "leave_requests": ("leave_day_summary",),
+    "employees": ("payroll_summary", "leave_day_summary"),
+}
+SUMMARY_SOURCE_KEYS = {"payments": "payment_id", "leave_requests": "leave_id", "employees": "id"}
+PAY_MONTH_EXPR = "DATE_SUB(p.payment_date, INTERVAL DAYOFMONTH(p.payment_date) - 1 DAY)"
+PAYROLL_SUMMARY_SELECT = (
+    f"SELECT {PAY_MONTH_EXPR}, p.employee_id, COALESCE(e.department_id, 0), COALESCE(p.payment_type, 'Other'), "
+    "COUNT(*), SUM(p.amount) FROM payments p LEFT JOIN employees e ON e.id = p.employee_id {where} "
+    f"GROUP BY {PAY_MONTH_EXPR}, p.employee_id, COALESCE(e.department_id, 0), COALESCE(p.payment_type, 'Other')"
+)
+LEAVE_DAY_SUMMARY_INSERT = (
+    "INSERT INTO leave_day_summary (leave_date, department_id, status, employees_on_leave, leave_requests) "
+    "WITH RECURSIVE days (day) AS (SELECT CAST(%s AS DATE) UNION ALL SELECT day + INTERVAL 1 DAY FROM days WHERE day < %s) "
+    "SELECT days.day, COALESCE(e.department_id, 0), lr.status, COUNT(DISTINCT lr.employee_id), COUNT(*) "
+    "FROM days JOIN leave_requests lr ON lr.start_date <= days.day AND lr.end_date >= days.day "
+    "LEFT JOIN employees e ON e.id = lr.employee_id "
+    "GROUP BY days.day, COALESCE(e.department_id, 0), lr.status"
+)
+WRITE_TARGET_PATTERN = re.compile(r"^\s*(?:insert\s+(?:ignore\s+)?into|update)\s+`?(\w+)`?", re.IGNORECASE)
+# Single-table UPDATE: table, optional alias, then everything up to the top-level WHERE.
+SINGLE_TABLE_UPDATE_PATTERN = re.compile(r"^\s*update\s+`?(\w+)`?(?:\s+(?:as\s+)?`?(?!set\b)(\w+)`?)?\s+set\s", re.IGNORECASE)
+
+summary_stats = defaultdict(int)
+summary_tables_seen = {}  # summary table -> monotonic time it was last found in the database
+
+
+def active_summary_tables(cursor=None, candidates=SUMMARY_TABLE_DDL) -> set:
+    """
+    Summary tables that exist in the database (created by `flask rebuild-summaries`, possibly in another process).
+    With a cursor, each candidate not seen within SUMMARY_PRESENCE_TTL is probed on that connection, so a write never
+    skips maintenance because this process has not noticed the tables yet. Without one, the tables last seen are returned.
+    """
+    now = time.monotonic()
+    active = {summary for summary in candidates if now - summary_tables_seen.get(summary, float("-inf")) <= SUMMARY_PRESENCE_TTL}
+    if cursor is None:
+        return active
+    for summary in set(candidates) - active:
+        try:
+            cursor.execute(f"SELECT 1 FROM {summary} LIMIT 0")
+            cursor.fetchall()
+        except MySQLError as e:
+            if e.errno != 1146:  # Unknown table: not created yet
+                raise
+            continue
+        summary_tables_seen[summary] = now
+        active.add(summary)
+    return active
+
+
+def _mask_sql(sql_query: str, parentheses: bool = True) -> str:
+    """Lower-cased statement with literals (and parenthesized text) masked, keeping every character's position."""
+    code = SQL_STRING_LITERAL_PATTERN.sub(lambda m: "'" + "x" * (len(m.group(0)) - 2) + "'", sql_query).lower()
+    if not parentheses:
+        return code
+    previous = None
+    while previous != code:
+        previous = code
+        code = re.sub(r"\([^()]*\)", lambda m: "[" + " " * (len(m.group(0)) - 2) + "]", code)
+    return code
+
+
+def _employee_update_keeps_departments(masked: str) -> bool:
+    """
+    True for an UPDATE of employees that cannot change anyone's department: it assigns no department_id and every
+    column it assigns belongs to employees (qualified by its name or alias, or unqualified with no other base table
+    in the statement). Covers single-table, WHERE-less and multi-table (JOIN) forms; `masked` comes from _mask_sql.
+    """
+    set_match = re.search(r"\sset\s", masked)
+    if not set_match:
+        return False
+    clause_end = re.search(r"\s(?:where|order\s+by|limit)\s", masked[set_match.end():])
+    set_clause = masked[set_match.end():set_match.end() + clause_end.start()] if clause_end else masked[set_match.end():]
+    names, other_tables = set(), False
+    for match in re.finditer(r"(?:^\s*update|\bjoin|,)\s+`?(\w+)`?(?:\s+(?:as\s+)?`?(\w+)`?)?", masked[:set_match.start() + 1]):
+        if match.group(1) != "employees":
+            other_tables = True
+            continue
+        names.add("employees")
+        if match.group(2) and match.group(2) not in NON_ALIAS_WORDS:
+            names.add(match.group(2))
+    for assignment in set_clause.split(","):
+        target = re.match(r"\s*(?:`?(\w+)`?\s*\.\s*)?`?(\w+)`?\s*=", assignment)
+        if not target or target.group(2) == "department_id":
+            return False
+        if (target.group(1) not in names) if target.group(1) else other_tables:
+            return False
+    return True
+
+
+def plan_summary_maintenance(sql_query: str, query_type: str, params: tuple = None, cursor=None) -> dict | None:
+    """
+    How a write keeps the summary tables current, or None when it cannot affect them:
+    - id_range: an INSERT; the new rows are found from lastrowid and rowcount after it runs.
+    - capture: a single-table UPDATE; the rows it matches are read before and after it runs.
+    - rebuild: anything else touching a source table rebuilds the affected summaries.
+    Raises ValueError for writes aimed at a summary table itself.
+    With `cursor` (the write's own connection), whether the summary tables exist is checked against the database.
+    """
+    target = WRITE_TARGET_PATTERN.match(sql_query)
+    if not target:
+        return None
+    table = target.group(1).lower()
+    if table in SUMMARY_TABLE_DDL:
+        raise ValueError(f"'{table}' is maintained automatically and cannot be modified directly.")
+    if not SUMMARY_SOURCES.get(table) or (query_type == "INSERT" and table == "employees"):
+        return None  # A new employee has no payments or leave yet
+
+    masked = _mask_sql(sql_query.strip().rstrip(";"))
+    if table == "employees" and _employee_update_keeps_departments(masked):
+        return None
+    update = SINGLE_TABLE_UPDATE_PATTERN.match(masked) if query_type != "INSERT" else None
+    where = re.search(r"\swhere\s", masked) if update else None
+
+    active = active_summary_tables(cursor, SUMMARY_SOURCES[table])
+    summaries = [summary for summary in SUMMARY_SOURCES[table] if summary in active]
+    if not summaries:
+        return None
+    plan = {"table": table, "summaries": summaries, "strategy": "rebuild"}
+    if query_type == "INSERT":
+        return {**plan, "strategy": "id_range"}
+    if not update:
+        return plan  # Multi-table UPDATE
+    if not where:
+        return plan  # Whole-table updates are as expensive as a rebuild anyway
+    # Placeholders inside SET expressions such as ROUND(%s, 2) count too, so only string literals are masked here.
+    set_param_count = _mask_sql(sql_query.strip().rstrip(";"), parentheses=False)[update.end():where.start()].count("%s")
+    alias = f" {update.group(2)}" if update.group(2) else ""
+    plan.update(
+        strategy="capture",
+        select_sql=f"SELECT {SUMMARY_SOURCE_KEYS[table]} FROM {table}{alias} WHERE {sql_query.strip().rstrip(';')[where.end():]}",
+        select_params=tuple(params[set_param_count:]) if params else None,
+    )
+    return plan
+
+
+def _id_condition(column: str, ids) -> tuple[str, tuple]:
+    if isinstance(ids, range):
+        return f"{column} BETWEEN %s AND %s", (ids.start, ids.stop - 1)
+    ids = tuple(ids)
+    return f"{column} IN ({', '.join(['%s'] * len(ids))})", ids
+
+
+def _summary_keys(cursor, plan: dict, ids) -> dict:
+    """Summary rows that depend on the given source rows: payroll (employee_id, pay_month) pairs and leave date ranges."""
+    keys = {"payroll": set(), "leave": set()}
+    if not ids:
+        return keys
+    table = plan["table"]
+    if table == "payments":
+        condition, params = _id_condition("payment_id", ids)
+        cursor.execute(f"SELECT DISTINCT p.employee_id, {PAY_MONTH_EXPR} FROM payments p WHERE {condition}", params)
+        keys["payroll"].update(tuple(row) for row in cursor.fetchall())
+    elif table == "leave_requests":
+        condition, params = _id_condition("leave_id", ids)
+        cursor.execute(f"SELECT start_date, end_date FROM leave_requests WHERE {condition}", params)
+        keys["leave"].update(tuple(row) for row in cursor.fetchall())
+    elif table == "employees":
+        if "payroll_summary" in plan["summaries"]:
+            condition, params = _id_condition("p.employee_id", ids)
+            cursor.execute(f"SELECT DISTINCT p.employee_id, {PAY_MONTH_EXPR} FROM payments p WHERE {condition}", params)
+            keys["payroll"].update(tuple(row) for row in cursor.fetchall())
+        if "leave_day_summary" in plan["summaries"]:
+            condition, params = _id_condition("employee_id", ids)
+            cursor.execute(f"SELECT start_date, end_date FROM leave_requests WHERE {condition}", params)
+            keys["leave"].update(tuple(row) for row in cursor.fetchall())
+    return keys
+
+
+def refresh_payroll_summary(cursor, keys: set):
+    """Recomputes the payroll_summary rows for (employee_id, pay_month) pairs from payments."""
+    keys = sorted(keys)
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        params = tuple(value for key in batch for value in key)
+        cursor.execute("DELETE FROM payroll_summary WHERE "
+                       + " OR ".join(["(employee_id = %s AND pay_month = %s)"] * len(batch)), params)
+        where = "WHERE " + " OR ".join(
+            ["(p.employee_id = %s AND p.payment_date >= %s AND p.payment_date < %s + INTERVAL 1 MONTH)"] * len(batch))
+        cursor.execute("INSERT INTO payroll_summary (pay_month, employee_id, department_id, payment_type, payment_count, total_amount) "
+                       + PAYROLL_SUMMARY_SELECT.format(where=where),
+                       tuple(value for employee_id, month in batch for value in (employee_id, month, month)))
+
+
+def _merge_date_ranges(ranges: set) -> list:
+    merged = []
+    for start, end in sorted((start, end) for start, end in ranges if start and end and start <= end):
+        if merged and start <= merged[-1][1] + datetime.timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def refresh_leave_day_summary(cursor, ranges: set):
+    """Recomputes leave_day_summary for every day in the given (start_date, end_date) ranges."""
+    for start, end in _merge_date_ranges(ranges):
+        while start <= end:
+            chunk_end = min(end, start + datetime.timedelta(days=SUMMARY_REBUILD_CHUNK_DAYS - 1))
+            cursor.execute("DELETE FROM leave_day_summary WHERE leave_date BETWEEN %s AND %s", (start, chunk_end))
+            cursor.execute(LEAVE_DAY_SUMMARY_INSERT, (start, chunk_end))
+            start = chunk_end + datetime.timedelta(days=1)
+
+
+def rebuild_summary(cursor, summary: str):
+    """Recomputes a whole summary table from the source tables (inside the caller's transaction)."""
+    if summary == "payroll_summary":
+        cursor.execute("DELETE FROM payroll_summary")
+        cursor.execute("INSERT INTO payroll_summary (pay_month, employee_id, department_id, payment_type, payment_count, total_amount) "
+                       + PAYROLL_SUMMARY_SELECT.format(where=""))
+    elif summary == "leave_day_summary":
+        cursor.execute("DELETE FROM leave_day_summary")
+        cursor.execute("SELECT MIN(start_date), MAX(end_date) FROM leave_requests")
+        start, end = cursor.fetchone()
+        if start and end:
+            refresh_leave_day_summary(cursor, {(start, end)})
+    summary_stats["rebuilds"] += 1
+
+
+def begin_summary_maintenance(cursor, plan: dict):
+    """Before the write: remembers which summary rows the matched source rows feed today."""
+    if plan["strategy"] != "capture":
+        return
+    cursor.execute(plan["select_sql"], plan["select_params"])
+    ids = [row[0] for row in cursor.fetchall()]
+    if len(ids) > SUMMARY_MAX_DELTA_ROWS:
+        plan["strategy"] = "rebuild"
+        return
+    plan["ids"] = ids
+    plan["keys_before"] = _summary_keys(cursor, plan, ids)
+
+
+def finish_summary_maintenance(cursor, plan: dict, affected_rows: int, last_row_id):
+    """After the write, before commit: refreshes exactly the summary rows whose inputs changed."""
+    if affected_rows == 0:
+        return
+    if plan["strategy"] == "id_range" and last_row_id and affected_rows <= SUMMARY_MAX_DELTA_ROWS:
+        keys = _summary_keys(cursor, plan, range(last_row_id, last_row_id + affected_rows))
+    elif plan["strategy"] == "capture":
+        keys = _summary_keys(cursor, plan, plan["ids"])
+        keys = {kind: keys[kind] | plan["keys_before"][kind] for kind in keys}
+    else:
+        for summary in plan["summaries"]:
+            rebuild_summary(cursor, summary)
+        return
+    if keys["payroll"] and "payroll_summary" in plan["summaries"]:
+        refresh_payroll_summary(cursor, keys["payroll"])
+    if keys["leave"] and "leave_day_summary" in plan["summaries"]:
+        refresh_leave_day_summary(cursor, keys["leave"])
+    summary_stats["incremental_refreshes"] += 1
+
+
+@app.cli.command("rebuild-summaries")
+@click.option("--table", "tables", multiple=True, type=click.Choice(sorted(SUMMARY_TABLE_DDL)),
+              help="Summary table to rebuild (repeatable; default all).")
+def rebuild_summaries_command(tables):
+    """Create the payroll and leave summary tables if needed and recompute them from the source tables."""
+    conn = get_db_connection()
+    if not conn:
+        raise click.ClickException("Database connection failed.")
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        for summary in tables or sorted(SUMMARY_TABLE_DDL):
+            started = time.perf_counter()
+            cursor.execute(SUMMARY_TABLE_DDL[summary])
+            rebuild_summary(cursor, summary)
+            conn.commit()
+            cursor.execute(f"SELECT COUNT(*) FROM {summary}")
+            click.echo(f"{summary}: {cursor.fetchone()[0]} rows in {time.perf_counter() - started:.2f}s")
+    except MySQLError as e:
+        conn.rollback()
+        raise click.ClickException(str(e))
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
+    schema_catalog.invalidate()
+    result_cache.invalidate_tables(set(tables or SUMMARY_TABLE_DDL))
+
+
+# --- Paginated and Streamed SELECT Results ---
+RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "200"))  # Rows per DATA_RESULT page
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "500"))  # Rows fetched per round-trip when streaming
+# Execution time limit for /chat/stream; the server counts the time a slow client takes to read rows too. 0 = off
+STREAM_MAX_EXECUTION_MS = int(os.getenv("STREAM_MAX_EXECUTION_MS", "0"))
+PAGE_TOKEN_TTL = float(os.getenv("PAGE_TOKEN_TTL", "900"))  # Seconds a next-page token stays valid
+PAGE_TOKEN_SECRET = os.getenv("PAGE_TOKEN_SECRET")  # Shared by all workers so any of them serves "Load more"; unset = per-process key
+
+# Primary key per table, used as the keyset when a query reads from that table without its own ORDER BY
+# (the schema catalog's single-column primary keys take precedence).
+KEYSET_COLUMNS = {"employees": "id", "departments": "department_id", "payments": "payment_id", "leave_requests": "leave_id"}
+
+# Next-page cursors, signed rather than stored: {"sql", "params", "plan", "position", "page_size", "max_rows", "rows_served"}.
+# The signature is what makes the embedded SQL safe to take back from the client.
+page_tokens = SignedTokens(ttl=PAGE_TOKEN_TTL, secret=PAGE_TOKEN_SECRET)
+if not PAGE_TOKEN_SECRET:
+    log_event(logging.WARNING, "page_tokens.secret_missing",
+              detail="PAGE_TOKEN_SECRET is not set: next-page tokens are only accepted by the worker that issued them.")
+
+
+def top_level_sql(sql_query: str) -> str:
+    """Lower-cased statement with string literals and parenthesized subqueries blanked out."""
+    code = SQL_STRING_LITERAL_PATTERN.sub("''", sql_query).lower()
+    previous = None
+    while previous != code:
+        previous = code
+        code = re.sub(r"\([^()]*\)", "()", code)
+    return code
+
+
+def _primary_key_column(table: str) -> str | None:
+    primary_key = schema_catalog.primary_key(table)
+    return primary_key[0] if len(primary_key) == 1 else KEYSET_COLUMNS.get(table)
+
+
+def _joins_keep_key_unique(top: str) -> bool:
+    """
+    True when every JOIN is N:1, i.e. its ON clause matches the joined table's own primary key, so the driving
+    table's key stays unique in the result. Comma joins, USING/NATURAL joins and conditions we cannot read are not.
+    """
+    clauses = re.split(r"\bjoin\b", re.split(r"\b(where|group\s+by|having|order\s+by|limit)\b", top, maxsplit=1)[0])
+    if "," in re.split(r"\bfrom\b", clauses[0], maxsplit=1)[-1]:
+        return False
+    for clause in clauses[1:]:
+        match = re.match(r"\s+`?(\w+)`?(?:\s+(?:as\s+)?(?!on\b)`?(\w+)`?)?\s+on\s+(.*)", clause, re.DOTALL)
+        key = _primary_key_column(match.group(1)) if match else None
+        if not key:
+            return False
+        names = "|".join(re.escape(name) for name in {match.group(1), match.group(2) or match.group(1)})
+        reference = rf"`?(?:{names})`?\.`?{re.escape(key)}`?"
+        if not re.search(rf"(?:^|[\s(]){reference}\s*=|=\s*{reference}\b", match.group(3)):
+            return False
+    return True
+
+
+def deterministic_order(sql_query: str) -> str | None:
+    """
+    Sort keys that make a statement's row order repeatable: MySQL gives no stable order between separate
+    LIMIT/OFFSET statements otherwise, so pages could repeat or skip rows. Grouped results use their GROUP BY list,
+    DISTINCT ones every selected column, and everything else the primary key of each table in FROM/JOIN.
+    None when no such key can be derived (derived tables, tables without a known primary key, SELECT DISTINCT *).
+    """
+    base_sql = sql_query.strip().rstrip(";").strip()
+    masked = _mask_sql(base_sql)
+    clause_end = r"(?=\s+(?:with\s+rollup|where|group\s+by|having|window|order\s+by)\b|$)"
+    group_by = re.search(rf"\bgroup\s+by\s+(.*?){clause_end}", masked, re.DOTALL)
+    if group_by:
+        return base_sql[group_by.start(1):group_by.end(1)].strip()
+    distinct = re.match(r"\s*select\s+distinct\s+(.*?)\s+from\b", masked, re.DOTALL)
+    if distinct:
+        if "*" in distinct.group(1):
+            return None
+        return ", ".join(str(position) for position in range(1, distinct.group(1).count(",") + 2))
+    from_clause = re.search(rf"\bfrom\s+(.*?){clause_end}", masked, re.DOTALL)
+    if not from_clause or "[" in from_clause.group(1):
+        return None
+    keys = []
+    offset = from_clause.start(1)
+    for match in re.finditer(r"(?:^|\bjoin\s+|,\s*)`?(\w+)`?(?:\s+(?:as\s+)?`?(\w+)`?)?", from_clause.group(1)):
+        key = _primary_key_column(match.group(1))
+        if not key:
+            return None
+        name_group = 2 if match.group(2) and match.group(2) not in NON_ALIAS_WORDS else 1
+        name = base_sql[offset + match.start(name_group):offset + match.end(name_group)]
+        keys.append(f"`{name}`.`{key}`")
+    return ", ".join(keys) or None
+
+
+def plan_pagination(sql_query: str) -> dict | None:
+    """
+    Decides how a SELECT is paged:
+    - keyset: no ORDER BY of its own and the driving table's primary key is selected, so pages seek on that key.
+      Only for single-table reads and N:1 joins; under a 1:N join the key repeats and seeking past it would skip rows.
+    - offset: the query's own ORDER BY must be preserved, so pages use LIMIT/OFFSET on the original statement.
+      `order_by` (from deterministic_order) is appended as the ORDER BY, or as tie-breakers after the query's own.
+    - None: the query already has a LIMIT (or is otherwise unsuitable) and is returned in one piece.
+    """
+    top = top_level_sql(sql_query)
+    if re.search(r"\b(limit|union|into|for\s+update|lock\s+in\s+share\s+mode)\b", top):
+        return None
+    from_match = re.search(r"\bfrom\s+`?(\w+)`?", top)
+    if from_match and not re.search(r"\b(order\s+by|group\s+by|distinct)\b", top) and _joins_keep_key_unique(top):
+        key = _primary_key_column(from_match.group(1))
+        select_list = top[:from_match.start()]
+        if key and (re.search(r"(^|[\s,])(\w+\.)?\*", select_list.replace("select", " ", 1)) or re.search(rf"\b{key}\b", select_list)):
+            return {"mode": "keyset", "key": key}
+    return {"mode": "offset", "order_by": deterministic_order(sql_query)}
+
+
+def build_page_sql(sql_query: str, plan: dict, page_size: int = None, position=None) -> str:
+    """Wraps a SELECT for one page (or, with page_size=None, for everything after `position`)."""
+    base_sql = sql_query.strip().rstrip(";").strip()
+    if plan["mode"] == "keyset":
+        key = plan["key"]
+        # Primary keys are INTs; inlining them keeps '%' in LIKE patterns away from parameter substitution.
+        where = f" WHERE page_src.`{key}` > {int(position)}" if position is not None else ""
+        limit = f" LIMIT {int(page_size) + 1}" if page_size else ""
+        return f"SELECT * FROM ({base_sql}) AS page_src{where} ORDER BY page_src.`{key}`{limit}"
+    offset = int(position or 0)
+    if plan.get("order_by"):
+        own_order = re.search(r"\border\s+by\b", top_level_sql(base_sql))
+        base_sql = f"{base_sql}{', ' if own_order else ' ORDER BY '}{plan['order_by']}"
+    if page_size:
+        return f"{base_sql} LIMIT {int(page_size) + 1} OFFSET {offset}"
+    return f"{base_sql} LIMIT 18446744073709551615 OFFSET {offset}" if offset else base_sql
+
+
+def execute_select_page(sql_query: str, params: tuple = None, page_size: int = RESULT_PAGE_SIZE, plan: dict = None, position=None,
+                        max_rows: int = None, rows_served: int = 0) -> dict:
+    """
+    Runs one page of a SELECT through execute_query (so pages share the result cache).
+    Fetches one extra row to learn whether another page exists; if so, the result carries a `next_page_token`.
+    With `max_rows`, paging stops after that many rows in total and the last page is flagged `truncated`.
+    """
+    if plan is None:
+        plan = plan_pagination(sql_query)
+        if plan is None:
+            if not max_rows:
+                return execute_query(sql_query, "SELECT", params)
+            result = execute_query(cap_statement_rows(sql_query, max_rows), "SELECT", params)
+            if "error" in result or len(result["data"]) <= max_rows:
+                return result
+            return {**result, "data": result["data"][:max_rows], "rows_affected": max_rows, "truncated": True}
+
+    fetch_size = min(page_size, max_rows - rows_served) if max_rows else page_size
+    result = execute_query(build_page_sql(sql_query, plan, fetch_size, position), "SELECT", params)
+    if "error" in result and plan["mode"] == "keyset" and position is None:
+        # e.g. duplicate column names from a JOIN cannot live in a derived table; page the original statement instead.
+        log_event(logging.INFO, "pagination.keyset_fallback", error=result["error"])
+        plan = {"mode": "offset", "order_by": deterministic_order(sql_query)}
+        result = execute_query(build_page_sql(sql_query, plan, fetch_size, position), "SELECT", params)
+    if "error" in result:
+        return result
+
+    rows = result["data"]
+    more_rows = len(rows) > fetch_size
+    rows_served += min(len(rows), fetch_size)
+    page = {**result, "data": rows[:fetch_size], "rows_affected": min(len(rows), fetch_size), "has_more": more_rows}
+    if more_rows and max_rows and rows_served >= max_rows:
+        page["has_more"], page["truncated"] = False, True
+    if page["has_more"]:
+        next_position = rows[fetch_size - 1][plan["key"]] if plan["mode"] == "keyset" else int(position or 0) + fetch_size
+        page["next_page_token"] = page_tokens.put({
+            "sql": sql_query, "params": params, "plan": plan, "position": next_position, "page_size": page_size,
+            "max_rows": max_rows, "rows_served": rows_served,
+        })
+    return page
+
+
+def iter_select_rows(sql_query: str, params: tuple = None, chunk_size: int = STREAM_CHUNK_SIZE, read_only: bool = True):
+    """
+    Yields rows of a SELECT from an unbuffered cursor, `chunk_size` rows per fetch,
+    so memory stays flat no matter how many rows the query returns.
+    Reads from a replica when one is usable, unless `read_only` is False.
+    Bounded by STREAM_MAX_EXECUTION_MS rather than QUERY_MAX_EXECUTION_MS: an unbuffered statement runs until its last
+    row is read, so the usual limit would cut off clients that simply read slowly.
+    """
+    conn = get_db_connection(read_only=read_only)
+    if not conn:
+        raise MySQLError("Database connection failed.")
+    cursor = None
+    exhausted = False
+    try:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        log_event(logging.INFO, "query.stream", sql=sql_query)
+        cursor.execute(with_execution_time_limit(sql_query, is_mariadb(conn), STREAM_MAX_EXECUTION_MS), params or ())
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                exhausted = True
+                break
+            yield from rows
+    finally:
+        if exhausted:
+            cursor.close()
+            conn.close()
+        else:
+            # Unread rows are still on the wire; dropping the connection is cheaper than draining them.
+            conn.invalidate()
+
+# --- Query Cost Guard ---
+QUERY_GUARD_ENABLED = os.getenv("QUERY_GUARD_ENABLED", "true").lower() in ("1", "true", "yes")
+QUERY_MAX_EXAMINED_ROWS = int(os.getenv("QUERY_MAX_EXAMINED_ROWS", "1000000"))  # EXPLAIN row-estimate budget per generated SELECT
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "1000"))  # Rows a generated SELECT may return across all its pages
+QUERY_MAX_EXECUTION_MS = int(os.getenv("QUERY_MAX_EXECUTION_MS", "10000"))  # Execution time limit on every SELECT (hint on MySQL, max_statement_time on MariaDB); 0 = off
+QUERY_GUARD_DECISION_TTL = float(os.getenv("QUERY_GUARD_DECISION_TTL", "300"))  # Seconds an EXPLAIN verdict is reused
+
+# Shapes that must read every qualifying row before returning the first one, so a row cap does not make them cheaper.
+NEEDS_FULL_INPUT_PATTERN = re.compile(
+    r"\b(order\s+by|group\s+by|distinct|having|union)\b|\b(count|sum|avg|min|max|group_concat)\s*\(")
+HINTED_SELECT_PATTERN = re.compile(r"^\s*select\s*/\*\+", re.IGNORECASE)
+LEADING_SELECT_PATTERN = re.compile(r"^\s*select\b", re.IGNORECASE)
+TRAILING_LIMIT_PATTERN = re.compile(r"\blimit\s+(\d+)(?:\s*,\s*(\d+))?(\s+offset\s+\d+)?\s*;?\s*$", re.IGNORECASE)
+
+
+def is_mariadb(conn) -> bool:
+    """Whether a connection talks to MariaDB, which ignores the MAX_EXECUTION_TIME hint."""
+    try:
+        return "mariadb" in (conn.get_server_info() or "").lower()
+    except (AttributeError, MySQLError):
+        return False
+
+
+def with_execution_time_limit(sql_query: str, mariadb: bool = False, limit_ms: int = None) -> str:
+    """
+    Bounds a SELECT to `limit_ms` (default QUERY_MAX_EXECUTION_MS; 0 = unbounded): the MAX_EXECUTION_TIME
+    optimizer hint on MySQL, SET STATEMENT max_statement_time=... FOR on MariaDB.
+    """
+    limit_ms = QUERY_MAX_EXECUTION_MS if limit_ms is None else limit_ms
+    lowered = sql_query.lower()
+    if limit_ms <= 0 or "max_execution_time" in lowered or "max_statement_time" in lowered:
+        return sql_query
+    if mariadb:
+        return f"SET STATEMENT max_statement_time={limit_ms / 1000:g} FOR {sql_query.lstrip()}"
+    hint = f"MAX_EXECUTION_TIME({limit_ms})"
+    if HINTED_SELECT_PATTERN.match(sql_query):  # Only the first hint comment of a query block is honoured
+        return HINTED_SELECT_PATTERN.sub(lambda m: f"{m.group(0)} {hint}", sql_query, count=1)
+    return LEADING_SELECT_PATTERN.sub(lambda m: f"{m.group(0)} /*+ {hint} */", sql_query, count=1)
+
+
+def cap_statement_rows(sql_query: str, max_rows: int) -> str:
+    """LIMITs a statement that is not paged (own LIMIT, UNION, ...) to max_rows + 1 rows, so truncation is detectable."""
+    base_sql = sql_query.strip().rstrip(";").strip()
+    match = TRAILING_LIMIT_PATTERN.search(base_sql)
+    if match:
+        count_group = 2 if match.group(2) else 1  # LIMIT offset, count
+        if int(match.group(count_group)) <= max_rows:
+            return base_sql
+        return base_sql[:match.start(count_group)] + str(max_rows + 1) + base_sql[match.end(count_group):]
+    if re.search(r"\blimit\b", top_level_sql(base_sql)):
+        return base_sql  # LIMIT followed by FOR UPDATE etc.; leave it alone
+    return f"{base_sql} LIMIT {max_rows + 1}"
+
+
+def truncation_notice(max_rows: int) -> str:
+    return f"Result truncated to {max_rows:,} rows. Narrow your question (for example, add a filter) to see specific records."
+
+
+class QueryCostGuard:
+    """
+    Scores generated SELECTs with EXPLAIN before they run. The estimate is the nested-loop row count
+    (rows x filtered fan-out per table, summed over query blocks). Over QUERY_MAX_EXAMINED_ROWS, a query that can stop
+    early runs as is under the QUERY_MAX_ROWS cap every guarded SELECT gets ("cap", flagged to the user with a notice);
+    one that must read all of its input first, or that full-scans more than one table (e.g. an unconstrained join,
+    where the cap does not bound the rows examined before the first match), is rejected.
+    """
+    def __init__(self, max_examined_rows: int, decision_ttl: float, max_entries: int = 1024):
+        self.max_examined_rows = max_examined_rows
+        self.decision_ttl = decision_ttl
+        self.max_entries = max_entries
+        self._decisions = OrderedDict()  # result-cache style key -> (expires_at, decision)
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def assess(self, sql_query: str, params: tuple = None) -> dict:
+        """Blocking (runs EXPLAIN on a pooled connection); returns {"action", "estimated_rows", "full_scans"}."""
+        key = QueryResultCache.make_key(sql_query, params)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._decisions.get(key)
+            if entry and entry[0] > now:
+                self._decisions.move_to_end(key)
+                self._stats["cached"] += 1
+                return entry[1]
+
+        plan_rows = self._explain(sql_query, params)
+        estimated_rows = self.estimate_examined_rows(plan_rows) if plan_rows else None
+        full_scans = sorted({row.get("table") for row in plan_rows or [] if row.get("type") == "ALL" and row.get("table")})
+        if estimated_rows is None or estimated_rows <= self.max_examined_rows:
+            action = "allow"
+        elif len(full_scans) < 2 and not NEEDS_FULL_INPUT_PATTERN.search(top_level_sql(sql_query)):
+            action = "cap"
+        else:
+            action = "reject"
+        decision = {"action": action, "estimated_rows": estimated_rows, "full_scans": full_scans}
+        log_event(logging.INFO if action == "allow" else logging.WARNING, "query_guard.decision", sql=sql_query, **decision)
+
+        with self._lock:
+            self._stats[action] += 1
+            self._decisions[key] = (now + self.decision_ttl, decision)
+            while len(self._decisions) > self.max_entries:
+                self._decisions.popitem(last=False)
+        return decision
+
+    def _explain(self, sql_query: str, params: tuple = None) -> list | None:
+        conn = get_db_connection(read_only=True)
+        if not conn:
+            return None
+        cursor = None
+        try:
+            cursor = conn.cursor(dictionary=True)
+            with stage_timer("db_explain"):
+                cursor.execute("EXPLAIN " + sql_query.strip().rstrip(";"), params or ())
+                return cursor.fetchall()
+        except MySQLError as e:
+            # The statement itself will fail the same way; let execution report the error.
+            self._stats["explain_failures"] += 1
+            log_event(logging.INFO, "query_guard.explain_failed", error=str(e))
+            return None
+        finally:
+            if cursor:
+                cursor.close()
+            conn.close()
+
+    @staticmethod
+    def estimate_examined_rows(plan_rows: list) -> int | None:
+        totals, fan_out = defaultdict(float), defaultdict(lambda: 1.0)
+        known = False
+        for row in plan_rows:
+            if not isinstance(row, dict) or row.get("rows") is None:
+                continue
+            known = True
+            select_id = row.get("id")
+            rows = float(row["rows"])
+            totals[select_id] += fan_out[select_id] * rows
+            fan_out[select_id] *= max(1.0, rows * float(row.get("filtered") or 100) / 100)
+        return int(sum(totals.values())) if known else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"decisions_cached": len(self._decisions), "max_examined_rows": self.max_examined_rows, **self._stats}
+
+
+query_guard = QueryCostGuard(max_examined_rows=QUERY_MAX_EXAMINED_ROWS, decision_ttl=QUERY_GUARD_DECISION_TTL)
+
+# --- Query Log and Index Advisor ---
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH", "")  # SQLite file for the query log (e.g. instance/query_log.sqlite3); unset = off
+QUERY_LOG_FLUSH_INTERVAL = float(os.getenv("QUERY_LOG_FLUSH_INTERVAL", "30"))  # Seconds between writes of buffered aggregates
+
+SQL_COMMENT_PATTERN = re.compile(r"/\*.*?\*/", re.DOTALL)
+SQL_NUMBER_PATTERN = re.compile(r"\b\d+(?:\.\d+)?\b")
+# Words that can follow a table name where an alias would otherwise be.
+NON_ALIAS_WORDS = {"where", "join", "inner", "left", "right", "cross", "natural", "straight_join", "on", "using",
+                   "group", "order", "limit", "having", "union", "for", "lock", "window"}
+
+
+def query_fingerprint(sql_query: str) -> tuple[str, str]:
+    """(fingerprint, normalized text): literals, numbers and IN lists become placeholders; comments and hints are dropped."""
+    code = SQL_COMMENT_PATTERN.sub(" ", SQL_STRING_LITERAL_PATTERN.sub("?", sql_query.strip().rstrip(";")))
+    code = SQL_NUMBER_PATTERN.sub("?", code.replace("%s", "?"))
+    code = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?+)", code)
+    normalized = re.sub(r"\s+", " ", code).strip().lower()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16], normalized
+
+
+class QueryLog:
+    """
+    Per-fingerprint aggregates of executed statements (calls, errors, time, rows and the latest sample statement
+    for replay), buffered in memory and upserted into a small SQLite file every `flush_interval` seconds.
+    Only SELECTs keep their literal text and parameters as the sample; writes carry employee data (names, emails,
+    salaries), so their sample is the normalized statement with placeholders and no parameters.
+    """
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path or None
+        self.flush_interval = flush_interval
+        self._pending = {}  # fingerprint -> aggregate since the last flush
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._stats = defaultdict(int)
+        if self.path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                with contextlib.closing(sqlite3.connect(self.path, timeout=5)) as db:
+                    db.execute("CREATE TABLE IF NOT EXISTS query_fingerprints (fingerprint TEXT PRIMARY KEY, query_type TEXT, "
+                               "normalized_sql TEXT, sample_sql TEXT, sample_params TEXT, calls INTEGER, errors INTEGER, "
+                               "total_ms REAL, max_ms REAL, total_rows INTEGER, first_seen REAL, last_seen REAL)")
+                    db.commit()
+            except (OSError, sqlite3.Error) as e:
+                log_event(logging.WARNING, "query_log.open_failed", path=self.path, error=str(e))
+                self.path = None
+
+    def record(self, sql_query: str, params: tuple, query_type: str, elapsed: float, rows: int = 0, error: bool = False):
+        if not self.path:
+            return
+        fingerprint, normalized = query_fingerprint(sql_query)
+        now = time.time()
+        with self._lock:
+            entry = self._pending.get(fingerprint)
+            if entry is None:
+                entry = self._pending[fingerprint] = {
+                    "query_type": query_type, "normalized_sql": normalized, "calls": 0, "errors": 0,
+                    "total_ms": 0.0, "max_ms": 0.0, "total_rows": 0, "first_seen": now,
+                }
+            if query_type == "SELECT":
+                entry["sample_sql"], entry["sample_params"] = sql_query, params
+            else:
+                entry["sample_sql"], entry["sample_params"] = normalized, None
+            entry["last_seen"] = now
+            entry["calls"] += 1
+            entry["errors"] += int(error)
+            entry["total_ms"] += elapsed * 1000
+            entry["max_ms"] = max(entry["max_ms"], elapsed * 1000)
+            entry["total_rows"] += rows or 0
+            self._stats["recorded"] += 1
+            due = time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        if not pending or not self.path:
+            return
+        try:
+            with contextlib.closing(sqlite3.connect(self.path, timeout=5)) as db:
+                db.executemany(
+                    "INSERT INTO query_fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(fingerprint) DO UPDATE SET sample_sql = excluded.sample_sql, sample_params = excluded.sample_params, "
+                    "calls = calls + excluded.calls, errors = errors + excluded.errors, total_ms = total_ms + excluded.total_ms, "
+                    "max_ms = MAX(max_ms, excluded.max_ms), total_rows = total_rows + excluded.total_rows, last_seen = excluded.last_seen",
+                    [(fingerprint, e["query_type"], e["normalized_sql"], e["sample_sql"], json.dumps(e["sample_params"], default=str),
+                      e["calls"], e["errors"], e["total_ms"], e["max_ms"], e["total_rows"], e["first_seen"], e["last_seen"])
+                     for fingerprint, e in pending.items()])
+                db.commit()
+            self._stats["flushes"] += 1
+        except sqlite3.Error as e:
+            self._stats["flush_failures"] += 1
+            log_event(logging.WARNING, "query_log.flush_failed", path=self.path, error=str(e))
+
+    def load(self) -> list[dict]:
+        """Every logged fingerprint (pending aggregates flushed first), slowest total time first."""
+        self.flush()
+        if not self.path:
+            return []
+        with contextlib.closing(sqlite3.connect(self.path, timeout=5)) as db:
+            db.row_factory = sqlite3.Row
+            rows = [dict(row) for row in db.execute("SELECT * FROM query_fingerprints ORDER BY total_ms DESC")]
+        for row in rows:
+            row["sample_params"] = json.loads(row["sample_params"]) if row["sample_params"] else None
+            row["avg_ms"] = row["total_ms"] / row["calls"] if row["calls"] else 0.0
+        return rows
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"path": self.path, "pending_fingerprints": len(self._pending), **self._stats}
+
+
+query_log = QueryLog(path=QUERY_LOG_PATH, flush_interval=QUERY_LOG_FLUSH_INTERVAL)
+atexit.register(query_log.flush)
+
+
+def index_candidates(sql_query: str) -> list[tuple[str, tuple]]:
+    """
+    Composite index suggestions [(table, columns)] for one statement: its equality and join columns per table,
+    followed by one range or ORDER BY column. Leading primary-key columns are skipped (already indexed).
+    """
+    code = SQL_COMMENT_PATTERN.sub(" ", SQL_STRING_LITERAL_PATTERN.sub("?", sql_query)).replace("`", "").replace("%s", "?").lower()
+    known_tables = set(schema_catalog.table_names) | set(HR_TABLES)
+    aliases = {}
+    for match in re.finditer(r"(?:\bfrom|\bjoin|,)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?", code):
+        table, alias = match.group(1), match.group(2)
+        if table in known_tables:
+            aliases[table] = table
+            if alias and alias not in NON_ALIAS_WORDS:
+                aliases[alias] = table
+    tables = set(aliases.values())
+
+    def resolve(qualifier, column):
+        if qualifier:
+            table = aliases.get(qualifier)
+        else:
+            owners = [t for t in tables if column in schema_catalog.column_names(t)]
+            table = owners[0] if len(owners) == 1 else None
+        return (table, column) if table and column in schema_catalog.column_names(table) else None
+
+    column = r"(?:(\w+)\.)?(\w+)"
+    equality, ranges = [], []
+    for match in re.finditer(rf"{column}\s*=\s*{column}\b(?!\s*\()", code):  # join conditions
+        equality += [resolve(match.group(1), match.group(2)), resolve(match.group(3), match.group(4))]
+    for match in re.finditer(rf"{column}\s*(?:=|<=>)\s*(?:\?|-?\d)|{column}\s+in\s*\(", code):
+        equality.append(resolve(match.group(1), match.group(2)) or resolve(match.group(3), match.group(4)))
+    for match in re.finditer(rf"{column}\s*(?:<=|>=|<(?![>=])|>(?!=)|\bbetween\b|\blike\b)", code):
+        ranges.append(resolve(match.group(1), match.group(2)))
+    order_match = re.search(rf"\border\s+by\s+{column}", code)
+    if order_match:
+        ranges.append(resolve(order_match.group(1), order_match.group(2)))
+
+    candidates = []
+    for table in sorted(tables):
+        columns = []
+        for table_column in equality:
+            if table_column and table_column[0] == table and table_column[1] not in columns:
+                columns.append(table_column[1])
+        primary_key = schema_catalog.primary_key(table) or [KEYSET_COLUMNS.get(table)]
+        columns = [c for c in columns if c not in primary_key]
+        for table_column in ranges:
+            if table_column and table_column[0] == table and table_column[1] not in columns and table_column[1] not in primary_key:
+                columns.append(table_column[1])
+                break
+        if columns:
+            candidates.append((table, tuple(columns[:3])))
+    return candidates
+
+
+def existing_indexes() -> dict:
+    """{table: [column tuples]} for every index in the database (empty if INFORMATION_SCHEMA cannot be read)."""
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    cursor = None
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.STATISTICS "
+                       "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX")
+        indexes = defaultdict(list)
+        for row in cursor.fetchall():
+            indexes[(row["TABLE_NAME"], row["INDEX_NAME"])].append(row["COLUMN_NAME"])
+        by_table = defaultdict(list)
+        for (table, _), columns in indexes.items():
+            by_table[table].append(tuple(columns))
+        return dict(by_table)
+    except MySQLError as e:
+        log_event(logging.WARNING, "index_advisor.introspection_failed", error=str(e))
+        return {}
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
 
-model = genai.GenerativeModel(model_name=model_to_use,
-                              generation_config=generation_config,
-                              safety_settings=safety_settings)
 
-# --- MySQL Database Configuration ---
-DB_HOST = os.getenv("DB_HOST")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_NAME = os.getenv("DB_NAME")
+def replay_query(sql_query: str, params, runs: int) -> float | None:
+    """Median milliseconds over `runs` executions of a logged SELECT (rows fetched), or None if it fails."""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    cursor = None
+    timings = []
+    try:
+        cursor = conn.cursor()
+        for _ in range(runs):
+            started = time.perf_counter()
+            cursor.execute(with_execution_time_limit(sql_query, is_mariadb(conn)), tuple(params) if params else ())
+            cursor.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        return sorted(timings)[len(timings) // 2]
+    except MySQLError as e:
+        click.echo(f"  replay failed: {e}")
+        return None
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
 
-ALLOWED_WRITE_OPERATIONS = ["UPDATE", "INSERT"]
 
-def get_db_connection():
+def run_ddl(statement: str) -> bool:
+    conn = get_db_connection()
+    if not conn:
+        return False
+    cursor = None
     try:
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
-        if conn.is_connected():
-            return conn
+        cursor = conn.cursor()
+        cursor.execute(statement)
+        conn.commit()
+        return True
     except MySQLError as e:
-        print(f"Error connecting to MySQL database: {e}")
+        click.echo(f"  failed: {e}")
+        return False
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
+
+
+@app.cli.command("advise-indexes")
+@click.option("--top", default=10, show_default=True, help="Slow fingerprints to analyse.")
+@click.option("--min-calls", default=1, show_default=True, help="Ignore fingerprints seen fewer times.")
+@click.option("--slow-ms", default=50.0, show_default=True, help="Average execution time that makes a fingerprint slow.")
+@click.option("--replay", "replay_runs", default=3, show_default=True, help="Timed runs per sample SELECT (0 skips replay).")
+@click.option("--apply", "mode", flag_value="apply", help="Create the proposed indexes and keep them.")
+@click.option("--trial", "mode", flag_value="trial", help="Create the proposed indexes, replay, then drop them.")
+def advise_indexes_command(top, min_calls, slow_ms, replay_runs, mode):
+    """Proposes composite indexes for the slowest fingerprints in the query log, with before/after replay timings."""
+    if schema_catalog.is_stale():
+        schema_catalog.refresh()
+    entries = [e for e in query_log.load() if e["calls"] >= min_calls and e["avg_ms"] >= slow_ms][:top]
+    if not entries:
+        click.echo(f"No logged fingerprints averaging {slow_ms:g} ms or more (log: {query_log.path or 'off, set QUERY_LOG_PATH'}).")
+        return
+
+    click.echo(f"{'calls':>7} {'avg ms':>9} {'max ms':>9} {'avg rows':>9}  fingerprint")
+    for entry in entries:
+        click.echo(f"{entry['calls']:>7} {entry['avg_ms']:>9.1f} {entry['max_ms']:>9.1f} {entry['total_rows'] / entry['calls']:>9.1f}  "
+                   f"{entry['fingerprint']} {entry['normalized_sql'][:120]}")
+
+    indexes = existing_indexes()
+    proposals = {}  # (table, columns) -> {"weight_ms", "entries"}
+    for entry in entries:
+        for table, columns in index_candidates(entry["sample_sql"]):
+            if any(existing[:len(columns)] == columns for existing in indexes.get(table, [])):
+                continue
+            proposal = proposals.setdefault((table, columns), {"weight_ms": 0.0, "entries": []})
+            proposal["weight_ms"] += entry["total_ms"]
+            proposal["entries"].append(entry)
+    if not proposals:
+        click.echo("\nNo new indexes to propose: the slow fingerprints are already covered or have no indexable predicates.")
+        return
+
+    click.echo("\nProposed indexes (by logged time they could save):")
+    ranked = sorted(proposals.items(), key=lambda item: -item[1]["weight_ms"])
+    for (table, columns), proposal in ranked:
+        proposal["name"] = f"idx_{table}_{'_'.join(columns)}"[:64]
+        proposal["ddl"] = f"CREATE INDEX {proposal['name']} ON {table} ({', '.join(columns)})"
+        click.echo(f"  {proposal['ddl']};  -- {len(proposal['entries'])} fingerprint(s), {proposal['weight_ms']:.0f} ms logged")
+
+    replayable = {e["fingerprint"]: e for _, p in ranked for e in p["entries"] if e["query_type"] == "SELECT"}
+    before = {}
+    if replay_runs > 0:
+        before = {fp: replay_query(e["sample_sql"], e["sample_params"], replay_runs) for fp, e in replayable.items()}
+    if not mode:
+        for fp, ms in before.items():
+            click.echo(f"  replay {fp}: {ms:.1f} ms" if ms is not None else f"  replay {fp}: failed")
+        click.echo("\nDry run. Re-run with --trial to measure the indexes, or --apply to create them.")
+        return
+
+    created = []
+    for _, proposal in ranked:
+        click.echo(f"Creating {proposal['name']} ...")
+        if run_ddl(proposal["ddl"]):
+            created.append(proposal)
+    if replay_runs > 0:
+        click.echo(f"\n{'fingerprint':<18}{'before ms':>11}{'after ms':>11}{'speed-up':>10}")
+        for fp, entry in replayable.items():
+            after = replay_query(entry["sample_sql"], entry["sample_params"], replay_runs)
+            if before.get(fp) is None or after is None:
+                click.echo(f"{fp:<18}{'-':>11}{'-':>11}{'-':>10}")
+                continue
+            click.echo(f"{fp:<18}{before[fp]:>11.1f}{after:>11.1f}{before[fp] / after if after else float('inf'):>9.1f}x")
+    if mode == "trial":
+        for proposal in created:
+            table = proposal["ddl"].split(" ON ")[1].split(" ")[0]
+            run_ddl(f"DROP INDEX {proposal['name']} ON {table}")
+        click.echo("Trial indexes dropped.")
+    else:
+        schema_catalog.invalidate()
+        click.echo(f"Created {len(created)} index(es).")
+
+# --- Local Intent Fast Path ---
+# Deterministic rules that answer chit-chat, open the add-employee form and serve common SELECTs
+# without a Gemini round-trip. Anything they are not sure about falls through to the model.
+LOCAL_INTENT_MIN_CONFIDENCE = float(os.getenv("LOCAL_INTENT_MIN_CONFIDENCE", "0.9"))
+DEPARTMENT_DIRECTORY_TTL = float(os.getenv("DEPARTMENT_DIRECTORY_TTL", "300"))
+
+GREETING_PATTERN = re.compile(
+    r"^(hi|hello|hey|hiya|howdy|greetings|good (morning|afternoon|evening)|yo)\b[\s,!.]*"
+    r"(there|team|all|everyone|bot|assistant)?[\s!.?]*(how are you( doing)?)?[\s!.?]*$", re.IGNORECASE)
+FAREWELL_PATTERN = re.compile(
+    r"^((thanks|thank you|thx|ty|cheers)( (so|very) much| a lot)?|bye|goodbye|see (you|ya)( later)?|"
+    r"(ok|okay|great|perfect|cool|awesome),? (thanks|thank you|bye))[\s,!.]*(bye|goodbye)?[\s!.]*$", re.IGNORECASE)
+# Words after "employee" that make the request about something else: "create employee report", "add employee 5 to Sales".
+NOT_A_NEW_EMPLOYEE = r"(?!\s*(?:#?\d|to\b|into\b|report|list|summary|table|data|details|count|stats|statistics|directory|ids?\b))"
+ADD_EMPLOYEE_PATTERN = re.compile(
+    r"\b(add|hire|onboard|register|create|insert)\s+(a\s+|an\s+)?(new\s+)?"
+    r"(employee|staff member|team member|hire|person|worker|employee record)\b" + NOT_A_NEW_EMPLOYEE +
+    r"|\b(add|hire|onboard|register)\s+(a\s+|an\s+)?new\s+([a-z]+\s+){0,3}(named|called)\b"
+    r"|\bhire\s+(someone|somebody|(a|an)\s+([a-z]+\s+){1,3}(named|called)\b)"
+    r"|\bnew (employee|hire) record\b" + NOT_A_NEW_EMPLOYEE, re.IGNORECASE)
+JOB_TITLE_IDS = {
+    "sales rep": "SA_REP", "sales representative": "SA_REP", "sales manager": "SA_MAN",
+    "programmer": "IT_PROG", "developer": "IT_PROG", "president": "AD_PRES", "accountant": "FI_ACCOUNT",
+}
+MONTH_NUMBERS = {name: number for number, name in enumerate(
+    ["january", "february", "march", "april", "may", "june", "july", "august", "september", "october", "november", "december"], start=1)}
+LEAVE_STATUSES = {"pending": "Pending", "approved": "Approved", "rejected": "Rejected", "cancelled": "Cancelled", "canceled": "Cancelled"}
+
+intent_stats = defaultdict(int)
+
+
+class DepartmentDirectory:
+    """Lower-cased department name -> (department_id, department_name), refreshed every `ttl` seconds."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._departments = {}
+        self._loaded_at = 0.0
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def refresh(self):
+        # Goes through execute_query, so it shares the result cache and its invalidation on department writes.
+        result = execute_query("SELECT department_id, department_name FROM departments", "SELECT")
+        if "error" not in result:
+            self._departments = {row["department_name"].lower(): (row["department_id"], row["department_name"])
+                                 for row in result["data"] if row.get("department_name")}
+        self._loaded_at = time.monotonic()
+
+    def find_in(self, text: str):
+        """
+        The longest department name mentioned in `text`, as (department_id, department_name), or None.
+        Short or all-caps names ("IT", "HR") must match case-sensitively so the pronoun "it" is not a department.
+        """
+        lowered = text.lower()
+        for name in sorted(self._departments, key=len, reverse=True):
+            display_name = self._departments[name][1]
+            if len(name) <= 3 or display_name.isupper():
+                found = re.search(rf"\b{re.escape(display_name)}\b", text)
+            else:
+                found = re.search(rf"\b{re.escape(name)}\b", lowered)
+            if found:
+                return self._departments[name]
         return None
 
-def get_database_schema_description():
-    # In a real application, you might fetch this dynamically using INFORMATION_SCHEMA
-    # For now, we hardcode a detailed description.
-    # CRITICAL: Keep this accurate and detailed.
-    schema = f"""
-    You have access to a MySQL database with the following tables for an HR Management system:
-
-    1. Table: employees
-       Description: Stores information about employees.
-       Columns:
-         - id (INT, PRIMARY KEY, AUTO_INCREMENT) - Unique identifier for the employee.
-         - first_name (VARCHAR(50), NOT NULL) - First name of the employee.
-         - last_name (VARCHAR(50), NOT NULL) - Last name of the employee.
-         - email (VARCHAR(100), UNIQUE) - Email address of the employee.
-         - phone_number (VARCHAR(20)) - Employee's phone number.
-         - hire_date (DATE) - Date when the employee was hired (YYYY-MM-DD).
-         - job_id (VARCHAR(10)) - Identifier for the employee's job role (e.g., IT_PROG, SA_REP, AD_PRES).
-         - salary (DECIMAL(10, 2)) - Current monthly or annual salary of the employee.
-         - commission_pct (DECIMAL(4,2)) - Commission percentage for sales staff (e.g., 0.10 for 10%). NULL if not applicable.
-         - manager_id (INT, FOREIGN KEY to employees.id) - ID of the employee's manager. NULL if no manager (e.g., for CEO).
-         - department_id (INT, FOREIGN KEY to departments.department_id) - ID of the department the employee belongs to.
-         - insertion_date (TIMESTAMP, DEFAULT CURRENT_TIMESTAMP) - Timestamp when the employee record was created.
-         - last_payment_date (DATE) - Date of the most recent payment made to the employee.
-
-    2. Table: departments
-       Description: Stores information about company departments.
-       Columns:
-         - department_id (INT, PRIMARY KEY) - Unique identifier for the department.
-         - department_name (VARCHAR(100), NOT NULL, UNIQUE) - Name of the department (e.g., 'IT', 'Sales', 'Human Resources').
-         - location (VARCHAR(100)) - Physical location of the department.
-       Relationships:
-         - employees.department_id references departments.department_id
-
-    3. Table: payments
-       Description: Tracks salary payments, bonuses, and commissions paid to employees.
-       Columns:
-         - payment_id (INT, AUTO_INCREMENT, PRIMARY KEY) - Unique identifier for the payment.
-         - employee_id (INT, NOT NULL, FOREIGN KEY to employees.id) - ID of the employee receiving the payment.
-         - payment_date (DATE, NOT NULL) - Date the payment was made.
-         - amount (DECIMAL(10, 2), NOT NULL) - Amount of the payment.
-         - payment_type (VARCHAR(50), DEFAULT 'Salary') - Type of payment (e.g., 'Salary', 'Bonus', 'Commission').
-         - notes (TEXT) - Optional notes about the payment.
-       Relationships:
-         - payments.employee_id references employees.id
-
-    4. Table: leave_requests
-       Description: Tracks employee requests for leave (vacation, sick leave, etc.).
-       Columns:
-         - leave_id (INT, AUTO_INCREMENT, PRIMARY KEY) - Unique identifier for the leave request.
-         - employee_id (INT, NOT NULL, FOREIGN KEY to employees.id) - ID of the employee requesting leave.
-         - leave_type (VARCHAR(50), NOT NULL, DEFAULT 'Vacation') - Type of leave (e.g., 'Vacation', 'Sick', 'Personal').
-         - start_date (DATE, NOT NULL) - Start date of the leave period.
-         - end_date (DATE, NOT NULL) - End date of the leave period.
-         - status (VARCHAR(20), NOT NULL, DEFAULT 'Pending') - Status of the request ('Pending', 'Approved', 'Rejected', 'Cancelled').
-         - reason (TEXT) - Reason for the leave request (optional).
-         - requested_date (TIMESTAMP, DEFAULT CURRENT_TIMESTAMP) - When the leave was requested.
-         - approved_by (INT, FOREIGN KEY to employees.id) - ID of the manager who approved/rejected the leave. NULL if pending or self-approved.
-       Relationships:
-         - leave_requests.employee_id references employees.id
-         - leave_requests.approved_by references employees.id
-
-    General Querying Notes:
-    - When asked for information that spans multiple tables, use appropriate JOIN clauses.
-      For example, to get employee names and their department names, JOIN employees with departments on department_id.
-    - 'insertion_date' in 'employees' is for when the record was created. 'hire_date' is the official start date.
-    - 'last_payment_date' in 'employees' can be used for "who was paid last", but for detailed payment history or amounts, query the 'payments' table.
-    - For leave status or history, query the 'leave_requests' table.
-
-    IMPORTANT FOR ADDING EMPLOYEES:
-    If the user expresses an intent to "add a new employee", "hire someone", or "insert a new employee record",
-    your primary response should be "LOAD_ADD_EMPLOYEE_FORM".
-    You can optionally try to extract any mentioned details (like name, department, salary) and provide them as pre_fill_data.
-    Example: "Add a new Sales Rep named Alice Wonderland with salary 80000 in the Oxford Sales department."
-    Response should be "LOAD_ADD_EMPLOYEE_FORM" with pre_fill_data:
-    pre_fill_data: {{"first_name": "Alice", "last_name": "Wonderland", "department_id": 80, "job_id": "SA_REP", "salary": 80000}}
-
-    IMPORTANT NOTE FOR UPDATES WITH LIMIT:
-    If you need to update a limited number of rows from the 'employees' table (e.g., "update the first 3 employees"),
-    MySQL/MariaDB does not support 'LIMIT' directly in a subquery within an 'IN' clause for an UPDATE on the same table.
-    Instead, use a JOIN with a derived table.
-    Example: To update the hire_date for the first 3 employees (ordered by id):
-    UPDATE employees e
-    JOIN (SELECT id FROM employees ORDER BY id ASC LIMIT 3) AS temp_ids ON e.id = temp_ids.id
-    SET e.hire_date = 'YYYY-MM-DD';
-    ALWAYS include an ORDER BY clause with LIMIT to ensure deterministic results for which rows are selected.
-    Today's date is {datetime.date.today().isoformat()}.
-    """
-    return schema.strip()
 
-def generate_sql_with_gemini(user_message: str, schema_description: str, allow_writes: bool = False) -> tuple[str | None, str | None, dict | None]:
-    allowed_operations_str = "SELECT"
-    if allow_writes:
-        allowed_operations_str += ", " + ", ".join(ALLOWED_WRITE_OPERATIONS)
+department_directory = DepartmentDirectory(ttl=DEPARTMENT_DIRECTORY_TTL)
 
-    prompt = f"""
-    Given the following database schema:
-    {schema_description}
+def general_chat_response(user_message: str) -> dict:
+    lowered = user_message.lower()
+    if "hello" in lowered or "hi" in lowered:
+         return {"response_text": "Hello! How can I help you with HR data today?", "type": "CHAT"}
+    elif "bye" in lowered or "thanks" in lowered:
+         return {"response_text": "You're welcome! Goodbye.", "type": "CHAT"}
+    return {"response_text": "I can help with questions about employee data. What would you like to know?", "type": "CHAT"}
 
-    And the user's question/command:
-    "{user_message}"
+def extract_employee_pre_fill(user_message: str) -> dict:
+    """Pulls new-employee details out of a free-text request, mirroring what the model used to return as pre_fill_data."""
+    pre_fill = {}
+    name_match = re.search(r"\b(?:named|called)\s+([A-Z][\w'-]*)(?:\s+([A-Z][\w'-]*))?", user_message)
+    if name_match:
+        pre_fill["first_name"] = name_match.group(1)
+        if name_match.group(2):
+            pre_fill["last_name"] = name_match.group(2)
+    email_match = re.search(r"[\w.+-]+@[\w-]+\.[\w.-]+", user_message)
+    if email_match:
+        pre_fill["email"] = email_match.group(0)
+    phone_match = re.search(r"\bphone(?: number)?(?: is| of|:)?\s+(\+?\d[\d\s().-]{5,}\d)", user_message, re.IGNORECASE)
+    if phone_match:
+        pre_fill["phone_number"] = phone_match.group(1).strip()
+    salary_match = re.search(r"\b(?:salary|earning|paid|pay)(?: of| is|:)?\s+\$?(\d[\d,]*(?:\.\d+)?)\s*(k\b)?", user_message, re.IGNORECASE)
+    if salary_match:
+        salary = float(salary_match.group(1).replace(",", "")) * (1000 if salary_match.group(2) else 1)
+        pre_fill["salary"] = int(salary) if salary.is_integer() else salary
+    commission_match = re.search(r"(\d+(?:\.\d+)?)\s*%\s*commission|commission(?: of| pct| percentage)?\s+(\d+(?:\.\d+)?)\s*%", user_message, re.IGNORECASE)
+    if commission_match:
+        pre_fill["commission_pct"] = round(float(commission_match.group(1) or commission_match.group(2)) / 100, 4)
+    date_match = re.search(r"\b(?:start(?:ing|s)?|hired?|from|on)\s+(?:on\s+)?(\d{4}-\d{2}-\d{2})\b", user_message, re.IGNORECASE)
+    if date_match:
+        pre_fill["hire_date"] = date_match.group(1)
+    manager_match = re.search(r"\b(?:manager(?: id)?|reporting to(?: employee)?(?: id)?)\s*#?(\d+)\b", user_message, re.IGNORECASE)
+    if manager_match:
+        pre_fill["manager_id"] = int(manager_match.group(1))
+    job_match = re.search(r"\b([A-Z]{2}_[A-Z]{2,10})\b", user_message)
+    if job_match:
+        pre_fill["job_id"] = job_match.group(1)
+    else:
+        lowered = user_message.lower()
+        for title in sorted(JOB_TITLE_IDS, key=len, reverse=True):
+            if re.search(rf"\b{title}\b", lowered):
+                pre_fill["job_id"] = JOB_TITLE_IDS[title]
+                break
+    department = department_directory.find_in(user_message)
+    if department:
+        pre_fill["department_id"] = department[0]
+    return pre_fill
 
-    Analyze the user's intent.
-    1. If the user wants to query data (e.g., "show me", "find", "list", "what is"), generate a MySQL SELECT query.
-    2. If the user wants to modify existing data (e.g., "update salary", "change department"), generate a MySQL UPDATE query.
-    3. If the user explicitly wants to "add a new employee", "hire someone", or "insert a new employee record":
-       Respond with the exact text "LOAD_ADD_EMPLOYEE_FORM".
-       Optionally, if you can extract details like name, department, salary, etc., from the user's message,
-       provide them in a JSON string format after "LOAD_ADD_EMPLOYEE_FORM" on a new line, like this:
-       LOAD_ADD_EMPLOYEE_FORM
-       pre_fill_data: {{"first_name": "example", "salary": "50000"}}
-       (Only include pre_fill_data if details are clearly mentioned for a new employee).
-    4. If the question cannot be answered or the command cannot be fulfilled with the allowed SQL types or actions, respond with "CANNOT_ANSWER".
-    5. If the question is a greeting, farewell, or general chit-chat not related to data, respond with "GENERAL_CHAT".
+def _month_range(user_message: str):
+    """(first day, first day of next month) for "this month", "last month" or "<month name> [year]", else None."""
+    lowered = user_message.lower()
+    today = datetime.date.today()
+    if re.search(r"\bthis month\b", lowered):
+        start = today.replace(day=1)
+    elif re.search(r"\b(last|previous) month\b", lowered):
+        start = (today.replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+    else:
+        match = re.search(r"\b(" + "|".join(MONTH_NUMBERS) + r")\b(?:\s+(\d{4}))?", lowered)
+        if not match:
+            return None
+        start = datetime.date(int(match.group(2) or today.year), MONTH_NUMBERS[match.group(1)], 1)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start, end
 
-    Response (SQL Query, or "LOAD_ADD_EMPLOYEE_FORM" potentially with pre_fill_data, or "CANNOT_ANSWER", or "GENERAL_CHAT"):
+def _leave_date_range(user_message: str):
+    """(first day, last day) a leave must overlap: today/tomorrow/yesterday/this week/next week/an ISO date, else None."""
+    lowered = user_message.lower()
+    today = datetime.date.today()
+    if re.search(r"\btoday\b|\bright now\b|\bcurrently\b", lowered):
+        return today, today
+    if re.search(r"\btomorrow\b", lowered):
+        day = today + datetime.timedelta(days=1)
+        return day, day
+    if re.search(r"\byesterday\b", lowered):
+        day = today - datetime.timedelta(days=1)
+        return day, day
+    week_match = re.search(r"\b(this|next) week\b", lowered)
+    if week_match:
+        monday = today - datetime.timedelta(days=today.weekday()) + datetime.timedelta(weeks=1 if week_match.group(1) == "next" else 0)
+        return monday, monday + datetime.timedelta(days=6)
+    date_match = re.search(r"\b(\d{4}-\d{2}-\d{2})\b", lowered)
+    if date_match:
+        day = datetime.date.fromisoformat(date_match.group(1))
+        return day, day
+    return None
+
+# Words each template understands; a question using any other word is left to the model.
+COMMON_QUERY_WORDS = {"show", "list", "get", "find", "display", "give", "me", "all", "the", "a", "please", "who", "is", "are", "s", "which", "what"}
+EMPLOYEES_BY_DEPARTMENT_WORDS = COMMON_QUERY_WORDS | {"employees", "employee", "staff", "people", "works", "work", "working", "in", "from", "of", "at", "department", "dept", "team"}
+LEAVE_BY_STATUS_WORDS = COMMON_QUERY_WORDS | {
+    "employees", "employee", "people", "any", "on", "leave", "leaves", "request", "requests", "status", "with", "for", "there",
+    "off", "today", "tomorrow", "yesterday", "this", "next", "week", "right", "now", "currently", *LEAVE_STATUSES}
+PAYMENTS_BY_EMPLOYEE_WORDS = COMMON_QUERY_WORDS | {
+    "payments", "payment", "made", "for", "to", "of", "employee", "emp", "id", "in", "during", "this", "last", "previous", "month", *MONTH_NUMBERS}
+
+
+def _uses_only(tokens: list, allowed: set, extra: set = frozenset()) -> bool:
+    return all(token in allowed or token in extra or token.isdigit() for token in tokens)
+
+def match_select_template(user_message: str):
     """
-    print(f"\n--- Gemini Prompt for SQL/Action Generation ---\n{prompt}\n---------------------------------------\n")
-    pre_fill_data = None
-    try:
-        response = model.generate_content(prompt)
-        if response.parts:
-            generated_text_full = response.text.strip()
-            print(f"Gemini Raw Response: '{generated_text_full}'")
+    Parameterized SELECTs for the most common questions, as (sql, params) or None.
+    Only phrasings made entirely of a template's vocabulary match; everything else goes to the model.
+    """
+    lowered = user_message.lower().strip().rstrip("?!. ")
+    tokens = re.findall(r"[a-z0-9]+", re.sub(r"\b\d{4}-\d{2}-\d{2}\b", " 0 ", lowered))
 
-            lines = generated_text_full.split('\n')
-            main_response_line = lines[0].strip()
+    # 1. Employees by department: "list employees in IT", "who works in the Sales department"
+    if re.search(r"\b(employees?|staff|people|works?|working)\s+(in|from|of|at)\b", lowered):
+        department = department_directory.find_in(user_message)
+        if department and _uses_only(tokens, EMPLOYEES_BY_DEPARTMENT_WORDS, set(re.findall(r"[a-z0-9]+", department[1].lower()))):
+            return ("SELECT e.*, d.department_name FROM employees e "
+                    "JOIN departments d ON e.department_id = d.department_id WHERE d.department_id = %s"), (department[0],)
 
-            if main_response_line == "LOAD_ADD_EMPLOYEE_FORM":
-                if len(lines) > 1 and lines[1].strip().startswith("pre_fill_data:"):
-                    try:
-                        json_str = lines[1].strip().replace("pre_fill_data:", "").strip()
-                        pre_fill_data = json.loads(json_str)
-                    except json.JSONDecodeError as e:
-                        print(f"Warning: Could not parse pre_fill_data JSON: {e}. JSON string was: {json_str}")
-                        pre_fill_data = {}
-                    except Exception as e_gen:
-                        print(f"Warning: General error processing pre_fill_data: {e_gen}")
-                        pre_fill_data = {}
-                return "LOAD_ADD_EMPLOYEE_FORM", "LOAD_ADD_EMPLOYEE_FORM", pre_fill_data
-
-            if main_response_line == "CANNOT_ANSWER" or main_response_line == "GENERAL_CHAT":
-                return main_response_line, main_response_line.upper(), None
-
-             # Use generated_text_full for SQL extraction, not just the first line
-            potential_sql = generated_text_full 
-            
-            # Remove markdown backticks and any "sql" language specifier
-            cleaned_sql = re.sub(r"^```(?:sql)?\s*", "", potential_sql, flags=re.IGNORECASE | re.MULTILINE)
-            cleaned_sql = re.sub(r"\s*```$", "", cleaned_sql, flags=re.MULTILINE)
-            cleaned_sql = cleaned_sql.strip() # This should now be the pure SQL
-
-            query_upper = cleaned_sql.upper() # Use the cleaned version for type checking
-            query_type = None
-            if query_upper.startswith("SELECT"):
-                query_type = "SELECT"
-            elif allow_writes:
-                for op_type in ALLOWED_WRITE_OPERATIONS:
-                    if query_upper.startswith(op_type):
-                        query_type = op_type
-                        break
-            
-            if query_type:
-                return cleaned_sql, query_type, None # Return the fully cleaned SQL
-            else:
-                # This 'else' block is being hit because query_upper (from the cleaned full text)
-                # doesn't start with a recognized command.
-                print(f"Warning: Gemini returned an unsupported or disallowed query type after cleaning. Original Raw: '{generated_text_full}', Cleaned attempt: '{cleaned_sql}'")
-                return "CANNOT_ANSWER", "CANNOT_ANSWER", None
+    # 2. Leave by status and date: "who is on leave today", "pending leave requests", "approved leave this week"
+    if "leave" in tokens and _uses_only(tokens, LEAVE_BY_STATUS_WORDS):
+        status_words = [word for word in LEAVE_STATUSES if word in tokens]
+        if len(status_words) > 1:
+            return None
+        status = LEAVE_STATUSES[status_words[0]] if status_words else ("Approved" if re.search(r"\bon leave\b", lowered) else None)
+        date_range = _leave_date_range(user_message)
+        if date_range is None and re.search(r"\bon leave\b", lowered):
+            date_range = (datetime.date.today(), datetime.date.today())  # "who is on leave" means now, not ever
+        if status is None and date_range is None:
+            return None
+        conditions, params = [], []
+        if status:
+            conditions.append("lr.status = %s")
+            params.append(status)
+        if date_range:
+            conditions.append("lr.start_date <= %s AND lr.end_date >= %s")
+            params.extend([date_range[1].isoformat(), date_range[0].isoformat()])
+        return ("SELECT lr.*, e.first_name, e.last_name FROM leave_requests lr "
+                "JOIN employees e ON lr.employee_id = e.id WHERE " + " AND ".join(conditions)), tuple(params)
+
+    # 3. Payments by employee and month: "payments for John Smith in March 2024", "show payments to employee 12 last month"
+    if {"payments", "payment"} & set(tokens):
+        conditions, params, name_words = [], [], set()
+        id_match = re.search(r"\b(?:employee|emp)(?: id)?\s*#?(\d+)\b", lowered)
+        name_match = re.search(r"\b(?:for|to|of)\s+([A-Z][\w'-]*)\s+([A-Z][\w'-]*)\b", user_message)
+        if id_match:
+            conditions.append("p.employee_id = %s")
+            params.append(int(id_match.group(1)))
+        elif name_match and name_match.group(1).lower() not in MONTH_NUMBERS:
+            conditions.append("e.first_name = %s AND e.last_name = %s")
+            params.extend([name_match.group(1), name_match.group(2)])
+            name_words = set(re.findall(r"[a-z0-9]+", (name_match.group(1) + " " + name_match.group(2)).lower()))
         else:
-            print("Warning: Gemini response has no parts. Content might be blocked.")
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 print(f"Block reason: {response.prompt_feedback.block_reason}")
-            return "CANNOT_ANSWER", "CANNOT_ANSWER", None
-    except Exception as e:
-        print(f"Error calling Gemini API for SQL generation: {e}")
-        return None, None, None
+            return None
+        if not _uses_only(tokens, PAYMENTS_BY_EMPLOYEE_WORDS, name_words):
+            return None
+        month_range = _month_range(user_message)
+        if month_range:
+            conditions.append("p.payment_date >= %s AND p.payment_date < %s")
+            params.extend([month_range[0].isoformat(), month_range[1].isoformat()])
+        return ("SELECT p.*, e.first_name, e.last_name FROM payments p "
+                "JOIN employees e ON p.employee_id = e.id WHERE " + " AND ".join(conditions)), tuple(params)
+    return None
 
-def execute_query(sql_query: str, query_type: str, params: tuple = None) -> dict:
+def classify_intent(user_message: str) -> tuple[str | None, float, dict]:
     """
-    Executes the SQL query.
-    For SELECT, returns data.
-    For INSERT/UPDATE/DELETE, returns affected_rows and success message.
-    `params` is a tuple of values for parameterized queries.
+    Local intent classifier: (intent, confidence, details).
+    Intents: GENERAL_CHAT, LOAD_ADD_EMPLOYEE_FORM (details: pre_fill_data) and TEMPLATE_SELECT (details: sql, params).
     """
-    conn = get_db_connection()
-    if not conn:
-        return {"error": "Database connection failed."}
+    message = user_message.strip()
+    if GREETING_PATTERN.match(message) or FAREWELL_PATTERN.match(message):
+        return "GENERAL_CHAT", 1.0, {}
+    if ADD_EMPLOYEE_PATTERN.search(message):
+        return "LOAD_ADD_EMPLOYEE_FORM", 0.95, {"pre_fill_data": extract_employee_pre_fill(message)}
+    template = match_select_template(message)
+    if template:
+        return "TEMPLATE_SELECT", 0.95, {"sql": template[0], "params": template[1]}
+    return None, 0.0, {}
 
-    cursor = None
+async def answer_locally(user_message: str) -> tuple[dict, int] | None:
+    """Handles a message without the model when the local classifier is confident, else returns None."""
+    if department_directory.is_stale() and re.search(r"\b(in|from|of|at|department|dept)\b", user_message, re.IGNORECASE):
+        await run_db(department_directory.refresh)
+    intent, confidence, details = classify_intent(user_message)
+    if intent is None or confidence < LOCAL_INTENT_MIN_CONFIDENCE:
+        intent_stats["model"] += 1
+        return None
+    intent_stats[intent.lower()] += 1
+    log_event(logging.INFO, "local_intent.answered", intent=intent, confidence=confidence)
+    if intent == "GENERAL_CHAT":
+        return general_chat_response(user_message), 200
+    if intent == "LOAD_ADD_EMPLOYEE_FORM":
+        return {
+            "response_text": "Okay, let's add a new employee. Please fill out the form.",
+            "type": "LOAD_COMPONENT",
+            "component_name": "add_employee_form",
+            "pre_fill_data": details["pre_fill_data"]
+        }, 200
+    return await execute_and_respond(details["sql"], "SELECT", details["params"])
+
+def render_sql_for_display(sql_query: str, params: tuple = None) -> str:
+    """Inlines parameters into a statement for display only; never execute the result."""
+    if not params:
+        return sql_query
+    rendered = sql_query
+    for value in params:
+        literal = str(value) if isinstance(value, (int, float, decimal.Decimal)) else "'" + str(value).replace("'", "''") + "'"
+        rendered = rendered.replace("%s", literal, 1)
+    return rendered
+
+# --- Conversation State and Local Refinements ---
+# The last DATA_RESULT of each client session is kept so follow-ups such as "now only those earning over 5000,
+# sorted by hire date" are answered from it without Gemini or the database. Only complete results are refined,
+# and only when every word of the follow-up is accounted for; anything else goes to the model with the previous
+# question as context.
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "1800"))  # Seconds a session's last result is kept
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(32 * 1024 * 1024)))  # Memory budget across all sessions
+CONVERSATION_MAX_RESULT_BYTES = int(os.getenv("CONVERSATION_MAX_RESULT_BYTES", str(2 * 1024 * 1024)))  # Larger results are not kept
+
+FOLLOW_UP_PATTERN = re.compile(
+    r"^(?:ok(?:ay)?,?\s+)?(?:now|and|then|also|but|only|just)\b|\b(?:those|these|them|ones|that list|this list)\b", re.IGNORECASE)
+PREVIOUS_RESULT_REFERENCE_PATTERN = re.compile(r"\b(?:those|these|them|that list|this list)\b", re.IGNORECASE)
+# Opening words of a refinement that has no pronoun: "sort by salary", "top 5 by amount".
+REFINEMENT_START_PATTERN = re.compile(
+    r"^(?:sort|sorted|order|ordered|filter|top|bottom|first|last|group|count|break|(?:show|display|list|give|keep)\s+(?:me\s+)?(?:only|just))\b",
+    re.IGNORECASE)
+# Words a user says for a column, in order of preference; column names (or their parts) always work.
+COLUMN_SYNONYMS = {
+    "earning": ["salary", "amount"], "earnings": ["salary", "amount"], "earn": ["salary", "amount"], "earns": ["salary", "amount"],
+    "making": ["salary"], "makes": ["salary"], "paid": ["amount", "salary"], "pay": ["salary", "amount"],
+    "hired": ["hire_date"], "started": ["hire_date", "start_date"], "department": ["department_name", "department_id"],
+    "dept": ["department_name", "department_id"], "job": ["job_id"], "role": ["job_id"], "manager": ["manager_id"],
+    "name": ["first_name", "last_name"], "names": ["first_name", "last_name"], "type": ["payment_type", "leave_type"],
+}
+COMPARISON_OPERATORS = {
+    "over": ">", "above": ">", "more than": ">", "greater than": ">", "higher than": ">", "after": ">", "later than": ">",
+    "at least": ">=", "since": ">=", "under": "<", "below": "<", "less than": "<", "lower than": "<", "before": "<",
+    "earlier than": "<", "at most": "<=", "up to": "<=", "is not": "!=", "not": "!=", "other than": "!=", "except": "!=",
+    "is": "=", "equals": "=", "equal to": "=", ">=": ">=", "<=": "<=", "!=": "!=", ">": ">", "<": "<", "=": "=",
+}
+REFINEMENT_FILLER_WORDS = {
+    "ok", "okay", "now", "and", "then", "also", "but", "only", "just", "those", "these", "them", "ones", "one", "it", "the", "their",
+    "of", "among", "show", "me", "display", "list", "give", "keep", "filter", "please", "who", "that", "which", "are", "is", "with",
+    "where", "whose", "having", "rows", "results", "records", "entries", "in", "by", "a",
+}  # No entity nouns: "now list the employees in Sales" must leave words unexplained and go to the model
+_CLAUSE_END = r"(?=\s*(?:,|;|$|\band\b|\bthen\b|\bsorted\b|\bordered\b|\bsort\b|\border\b))"
+_OPERATOR_ALTERNATION = "|".join(re.escape(word) for word in sorted(COMPARISON_OPERATORS, key=len, reverse=True))
+REFINEMENT_CLAUSES = [
+    ("group_count", re.compile(
+        r"\b(?:(?:count|how many)(?:\s+(?:of\s+)?(?:them|those|these|are there|rows))?\s+(?:per|by|for each|in each)"
+        r"|(?:group(?:ed)?|break\s+(?:(?:them|those|it)\s+)?down|breakdown)\s+(?:(?:them|those|these|it)\s+)?by)"
+        r"\s+(?:the\s+)?(?P<column>[a-z_ ]+?)" + _CLAUSE_END)),
+    ("sort", re.compile(
+        r"\b(?:sort(?:ed)?|order(?:ed)?)\s+(?:(?:them|those|these|it)\s+)?by\s+(?:the\s+|their\s+)?(?P<column>[a-z_ ]+?)"
+        r"(?:\s+(?P<direction>asc|ascending|desc|descending|(?:highest|largest|biggest|most|newest|latest|most recent)\s+first"
+        r"|(?:lowest|smallest|least|oldest|earliest)\s+first))?" + _CLAUSE_END)),
+    ("top", re.compile(
+        r"\b(?P<which>top|first|bottom|last)\s+(?P<count>\d+)(?:\s+(?:rows|results|records|ones|of them))?"
+        r"(?:\s+(?:by|on)\s+(?:the\s+|their\s+)?(?P<column>[a-z_ ]+?))?" + _CLAUSE_END)),
+    ("between", re.compile(
+        r"(?P<column>[a-z_ ]+?)\s+between\s+(?P<low>[\w$.,:-]+)\s+and\s+(?P<high>[\w$.,:-]+)" + _CLAUSE_END)),
+    ("compare", re.compile(
+        rf"(?P<column>[a-z_ ]+?)\s+(?P<operator>{_OPERATOR_ALTERNATION})\s+(?P<value>'[^']*'|\"[^\"]*\"|[\w$.,:&' -]+?)" + _CLAUSE_END)),
+    ("in", re.compile(r"\b(?:in|from|at)\s+(?:the\s+)?(?P<value>[a-z0-9&' -]+?)(?:\s+(?:department|dept|team))?" + _CLAUSE_END)),
+    ("project", re.compile(
+        r"(?:\b(?:show|display|list|give me|keep)\s+(?:me\s+)?(?:only|just)\s+(?:the\s+|their\s+)?|^(?:only|just)\s+(?:the\s+|their\s+))"
+        r"(?P<columns>[a-z_ ,]+?)(?:\s+columns?)?(?=\s*(?:;|$|\bsorted\b|\bordered\b|\bsort\b|\border\b|\bthen\b))")),
+]
+ISO_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+
+class ConversationStore:
+    """
+    Last DATA_RESULT per client session: rows only for complete results, LRU-evicted to stay within `max_bytes`.
+    An entry expires after `ttl` seconds or once a write touches one of the tables it was read from.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, max_entry_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()  # session id -> {"question", "sql", "rows", "columns", "tables", "size", "stored_at"}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"stored": 0, "skipped_too_large": 0, "evictions": 0, "refined_locally": 0, "follow_ups_to_model": 0}
+
+    def remember(self, session_id: str, question: str, payload: dict, previous: dict = None):
+        """Keeps a DATA_RESULT payload; `previous` is the entry a local refinement was computed from."""
+        complete = not payload.get("has_more") and not payload.get("truncated")
+        rows = payload.get("data") if complete else None
+        size = len(dumps_json(rows)) if rows else 0
+        if size > self.max_entry_bytes:
+            rows, size = None, 0
+            self._stats["skipped_too_large"] += 1
+        entry = {
+            "question": f"{previous['question']}; then: {question}" if previous else question,
+            "sql": previous["sql"] if previous else payload.get("query_executed"),
+            "rows": rows,
+            "columns": list(payload.get("columns") or (rows[0].keys() if rows else [])),
+            "tables": previous["tables"] if previous else referenced_tables(payload.get("query_executed") or ""),
+            "size": size,
+            "stored_at": time.monotonic(),
+        }
+        with self._lock:
+            self._remove_locked(session_id)
+            self._entries[session_id] = entry
+            self._bytes += size
+            self._stats["stored"] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove_locked(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def get(self, session_id: str | None) -> dict | None:
+        if not session_id:
+            return None
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["stored_at"] > self.ttl:
+                self._remove_locked(session_id)
+                return None
+            self._entries.move_to_end(session_id)
+        if entry["rows"] is not None and recent_writes.last_write_at(entry["tables"]) >= entry["stored_at"]:
+            entry = {**entry, "rows": None}  # Written since: still useful as context, no longer as data
+        return entry
+
+    def count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _remove_locked(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry["size"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, **self._stats}
+
+
+conversations = ConversationStore(ttl=CONVERSATION_TTL, max_bytes=CONVERSATION_MAX_BYTES, max_entry_bytes=CONVERSATION_MAX_RESULT_BYTES)
+
+
+def _singular(word: str) -> str:
+    if len(word) > 3 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def resolve_columns(phrase: str, columns: list) -> list | None:
+    """Columns a phrase names ("hire date" -> hire_date, "earning" -> salary, "names" -> first/last name), or None."""
+    words = [word for word in re.findall(r"[a-z0-9_]+", phrase.lower()) if word not in REFINEMENT_FILLER_WORDS]
+    if not words:
+        return None
+    for key in ("_".join(words), "_".join(_singular(word) for word in words)):
+        if key in columns:
+            return [key]
+    if len(words) == 1 and words[0] in COLUMN_SYNONYMS:
+        candidates = [column for column in COLUMN_SYNONYMS[words[0]] if column in columns]
+        if words[0] in ("name", "names"):
+            return candidates or None
+        return candidates[:1] or None
+    parts = {_singular(word) for word in words}
+    matches = [column for column in columns if parts <= {_singular(part) for part in column.lower().split("_")}]
+    return matches if len(matches) == 1 else None
+
+
+def _column_kind(rows: list, column: str) -> str:
+    for row in rows:
+        value = row.get(column)
+        if value is None:
+            continue
+        if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+            return "number"
+        if isinstance(value, (datetime.date, datetime.datetime)) or (isinstance(value, str) and ISO_DATE_PATTERN.match(value)):
+            return "date"
+        return "text"
+    return "text"
+
+
+def _comparable(value, kind: str):
+    if value is None:
+        return None
+    if kind == "number":
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    if kind == "date":
+        return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else str(value)
+    return str(value).lower()
+
+
+def _parse_value(text: str, kind: str, operator: str):
+    """The user's value as (operator, comparable) for a column kind, or None when it does not fit the column."""
+    text = text.strip().strip("'\"").strip()
+    if kind == "number":
+        match = re.fullmatch(r"\$?(\d[\d,]*(?:\.\d+)?)\s*(k)?", text)
+        return (operator, float(match.group(1).replace(",", "")) * (1000 if match.group(2) else 1)) if match else None
+    if kind == "date":
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", text):
+            return operator, text
+        if re.fullmatch(r"\d{4}", text):  # A year: "after 2020" means from 2021-01-01
+            return {">": (">=", f"{int(text) + 1}-01-01"), ">=": (">=", f"{text}-01-01"), "<": ("<", f"{text}-01-01"),
+                    "<=": ("<", f"{int(text) + 1}-01-01"), "=": ("year", text), "!=": ("not_year", text)}[operator]
+        return None
+    return (operator, text.lower()) if operator in ("=", "!=") else None
+
+
+def _matches(value, operator: str, target) -> bool:
+    if value is None:
+        return False
+    if operator == "year":
+        return value[:4] == target
+    if operator == "not_year":
+        return value[:4] != target
+    return {"=": value == target, "!=": value != target, ">": value > target, ">=": value >= target,
+            "<": value < target, "<=": value <= target}[operator]
+
+
+def parse_refinement(user_message: str) -> list | None:
+    """Clauses of a follow-up as [(kind, match groups)], or None when words are left that no clause explains."""
+    text = re.sub(r"[?!.]+$", "", user_message.lower().strip())
+    clauses = []
+    for kind, pattern in REFINEMENT_CLAUSES:
+        while True:
+            match = pattern.search(text)
+            if not match:
+                break
+            clauses.append((kind, match.groupdict()))
+            text = text[:match.start()] + " ; " + text[match.end():]
+    leftover = [word for word in re.findall(r"[a-z0-9_']+", text) if word not in REFINEMENT_FILLER_WORDS]
+    if leftover:
+        clauses.append(("value", {"value": " ".join(leftover)}))  # e.g. "only the approved ones"
+    return clauses or None
+
+
+def apply_refinement(clauses: list, rows: list, columns: list) -> tuple[list, list, list] | None:
+    """Evaluates parsed clauses on a previous result: filters, then group-count, sort, top-N and projection."""
+    order = {"between": 0, "compare": 0, "in": 0, "value": 0, "group_count": 1, "sort": 2, "top": 3, "project": 4}
+    described = []
+    for kind, groups in sorted(clauses, key=lambda clause: order[clause[0]]):
+        if kind in ("compare", "between"):
+            resolved = resolve_columns(groups["column"], columns)
+            if not resolved or len(resolved) != 1:
+                return None
+            column, column_kind = resolved[0], _column_kind(rows, resolved[0])
+            bounds = ([_parse_value(groups["low"], column_kind, ">="), _parse_value(groups["high"], column_kind, "<=")]
+                      if kind == "between" else [_parse_value(groups["value"], column_kind, COMPARISON_OPERATORS[groups["operator"]])])
+            if None in bounds:
+                return None
+            rows = [row for row in rows if all(_matches(_comparable(row.get(column), column_kind), operator, target)
+                                                for operator, target in bounds)]
+            described.append(f"{column} {' and '.join(f'{operator} {target}' for operator, target in bounds)}")
+        elif kind in ("in", "value"):
+            # A bare value ("in Sales", "approved ones") filters the one text column that contains it.
+            value = groups["value"].strip().strip("'\"")
+            holders = [column for column in columns if _column_kind(rows, column) == "text"
+                       and any(_comparable(row.get(column), "text") == value for row in rows)]
+            if len(holders) != 1:
+                return None
+            rows = [row for row in rows if _comparable(row.get(holders[0]), "text") == value]
+            described.append(f"{holders[0]} = {value}")
+        elif kind == "group_count":
+            resolved = resolve_columns(groups["column"], columns)
+            if not resolved or len(resolved) != 1:
+                return None
+            counts = defaultdict(int)
+            for row in rows:
+                counts[row.get(resolved[0])] += 1
+            columns = [resolved[0], "count"]
+            rows = [{resolved[0]: value, "count": count} for value, count in sorted(counts.items(), key=itemgetter(1), reverse=True)]
+            described.append(f"count by {resolved[0]}")
+        elif kind == "sort" or (kind == "top" and groups.get("column")):
+            resolved = resolve_columns(groups["column"], columns)
+            if not resolved or len(resolved) != 1:
+                return None
+            column = resolved[0]
+            if kind == "sort":
+                descending = bool(groups.get("direction")) and not re.match(r"asc|lowest|smallest|least|oldest|earliest", groups["direction"])
+            else:
+                descending = groups["which"] in ("top", "first")
+            column_kind = _column_kind(rows, column)
+            present = [row for row in rows if row.get(column) is not None]
+            present.sort(key=lambda row: _comparable(row[column], column_kind), reverse=descending)
+            rows = present + [row for row in rows if row.get(column) is None]
+            described.append(f"sorted by {column}{' desc' if descending else ''}")
+            if kind == "top":
+                rows = rows[:int(groups["count"])]
+                described.append(f"{groups['which']} {groups['count']}")
+        elif kind == "top":
+            count = int(groups["count"])
+            rows = rows[-count:] if groups["which"] in ("bottom", "last") else rows[:count]
+            described.append(f"{groups['which']} {count}")
+        elif kind == "project":
+            selected = []
+            for phrase in re.split(r",|\band\b", groups["columns"]):
+                if not set(re.findall(r"[a-z0-9_]+", phrase)) - REFINEMENT_FILLER_WORDS:
+                    continue  # "only the ones in Sales": nothing to project
+                resolved = resolve_columns(phrase, columns)
+                if resolved is None:
+                    return None
+                selected += [column for column in resolved if column not in selected]
+            if not selected:
+                continue
+            columns = [column for column in columns if column in selected]
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+            described.append(f"columns {', '.join(columns)}")
+    return rows, columns, described
+
+
+def is_follow_up(user_message: str) -> bool:
+    """A follow-up to the previous result; one naming a table ("now count employees by department") is a new question."""
+    text = user_message.strip()
+    return bool(FOLLOW_UP_PATTERN.search(text) or REFINEMENT_START_PATTERN.match(text)) and not question_tokens(text) & set(TABLE_KEYWORDS)
+
+
+def refers_to_previous(user_message: str) -> bool:
+    """A follow-up, or a new question that still points back at the last result ("which of those employees...")."""
+    return is_follow_up(user_message) or bool(PREVIOUS_RESULT_REFERENCE_PATTERN.search(user_message))
+
+
+def refine_previous_result(user_message: str) -> tuple[dict, int] | None:
+    """Answers a follow-up from the session's last complete result, or returns None to use the normal path."""
+    previous = conversations.get(current_session_id())
+    if not previous or previous["rows"] is None or not is_follow_up(user_message):
+        return None
+    clauses = parse_refinement(user_message)
+    refined = apply_refinement(clauses, previous["rows"], previous["columns"]) if clauses else None
+    if refined is None:
+        return None
+    rows, columns, described = refined
+    conversations.count("refined_locally")
+    log_event(logging.INFO, "conversation.refined_locally", refinement=described, rows=len(rows))
+    return {
+        "response_text": "Here's the data I found:",
+        "type": "DATA_RESULT",
+        "data": rows,
+        "columns": columns,
+        "has_more": False,
+        "next_page_token": None,
+        "truncated": False,
+        "guard": None,
+        "notice": None,
+        "refinement": described,
+        "query_executed": f"{previous['sql']} -- refined from the previous result: {'; '.join(described)}",
+    }, 200
+
+
+def with_follow_up_context(user_message: str) -> str:
+    """The message for the model: a follow-up carries the previous question and its SQL so "those" can be resolved."""
+    previous = conversations.get(current_session_id())
+    if not previous or not refers_to_previous(user_message):
+        return user_message
+    conversations.count("follow_ups_to_model")
+    return f"{user_message} (follow-up to the previous question \"{previous['question']}\", answered with: {previous['sql']})"
+
+
+# --- Employee Records (form and bulk import) ---
+EMPLOYEE_REQUIRED_FIELDS = ["first_name", "last_name", "email", "hire_date", "salary"]
+EMPLOYEE_FIELD_TO_COLUMN = {
+    "first_name": "first_name", "last_name": "last_name", "email": "email",
+    "phone_number": "phone_number", "hire_date": "hire_date", "job_id": "job_id",
+    "salary": "salary", "commission_pct": "commission_pct",
+    "manager_id": "manager_id", "department_id": "department_id"
+}
+BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "500"))  # Rows per executemany / transaction
+BULK_IMPORT_MAX_ERRORS = int(os.getenv("BULK_IMPORT_MAX_ERRORS", "1000"))  # Per-row errors listed in the response
+
+
+def missing_employee_field(record: dict) -> str | None:
+    for field in EMPLOYEE_REQUIRED_FIELDS:
+        if not record.get(field): # Check if field exists and is not empty
+            return field
+    return None
+
+def coerce_employee_value(db_col: str, value):
     try:
-        # Use dictionary=True only for SELECT to get column names in results
-        cursor = conn.cursor(dictionary=(query_type == "SELECT"))
-        
-        print(f"Executing {query_type} SQL: {sql_query}")
-        if params:
-            print(f"With parameters: {params}")
-            cursor.execute(sql_query, params)
-        else:
-            cursor.execute(sql_query)
+        if db_col in ["salary", "commission_pct"]:
+            return decimal.Decimal(str(value).strip())
+        elif db_col in ["manager_id", "department_id"]:
+            return int(value)
+        return value
+    except decimal.InvalidOperation:
+        raise ValueError(f"{db_col} must be a number, got {value!r}") from None
 
-        if query_type == "SELECT":
-            results = cursor.fetchall()
-            print(f"Query executed successfully. Fetched {len(results)} rows.")
-            for row in results: # Ensure results are dictionary for SELECT before processing
-                if isinstance(row, dict): # Should be true if dictionary=True was set
-                    for key, value in row.items():
-                        if isinstance(value, (datetime.date, datetime.datetime)):
-                            row[key] = value.isoformat()
-                        elif isinstance(value, decimal.Decimal):
-                            row[key] = float(value)
-            return {"data": results, "rows_affected": len(results)}
-        elif query_type in ALLOWED_WRITE_OPERATIONS:
+def employee_columns_and_values(record: dict) -> tuple[list, list]:
+    """Columns and coerced values for the fields present (non-empty) in a form submission or import row."""
+    columns, values_data = [], []
+    for field, db_col in EMPLOYEE_FIELD_TO_COLUMN.items():
+        value = record.get(field)
+        if value is not None and value != '': # Process if value exists and is not an empty string
+            columns.append(db_col)
+            values_data.append(coerce_employee_value(db_col, value))
+    return columns, values_data
+
+def employee_import_row(record: dict) -> tuple:
+    """Validated values for every mapped column (NULL for empty ones), so a whole batch shares one INSERT."""
+    missing_field = missing_employee_field(record)
+    if missing_field:
+        raise ValueError(f"Missing required field: {missing_field}")
+    return tuple(
+        coerce_employee_value(db_col, record[field]) if record.get(field) not in (None, '') else None
+        for field, db_col in EMPLOYEE_FIELD_TO_COLUMN.items()
+    )
+
+def iter_import_records(stream, file_format: str):
+    """Yields (row_number, record or ValueError) from a CSV or JSON Lines byte stream, one line at a time."""
+    lines = (raw_line.decode("utf-8-sig") if isinstance(raw_line, bytes) else raw_line for raw_line in stream)
+    if file_format == "csv":
+        for row_number, record in enumerate(csv.DictReader(lines), start=1):
+            yield row_number, {(key or "").strip(): value.strip() if isinstance(value, str) else value for key, value in record.items()}
+        return
+    row_number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+            yield row_number, record if isinstance(record, dict) else ValueError("Each line must be a JSON object")
+        except json.JSONDecodeError as e:
+            yield row_number, ValueError(f"Invalid JSON: {e}")
+
+def insert_employee_batch(conn, batch: list) -> list:
+    """
+    Inserts one batch in one transaction with executemany. If the batch fails (e.g. a duplicate email),
+    it is retried row by row in a single transaction so only the offending rows are reported.
+    Returns [(row_number, error message)] for rows that were not inserted.
+    """
+    insert_sql = (f"INSERT INTO employees ({', '.join(EMPLOYEE_FIELD_TO_COLUMN.values())}) "
+                  f"VALUES ({', '.join(['%s'] * len(EMPLOYEE_FIELD_TO_COLUMN))})")
+    cursor = conn.cursor()
+    try:
+        try:
+            cursor.executemany(insert_sql, [values for _, values in batch])
             conn.commit()
-            affected_rows = cursor.rowcount
-            last_row_id = cursor.lastrowid if query_type == "INSERT" else None
-            print(f"{query_type} executed successfully. {affected_rows} rows affected. Last ID: {last_row_id}")
-            response = {"message": f"{query_type} successful. {affected_rows} row(s) affected.", "rows_affected": affected_rows}
-            if last_row_id is not None:
-                response["new_employee_id"] = last_row_id
-            return response
-        else:
-            # This case should ideally not be reached if query_type is validated before calling
-            return {"error": "Unsupported query type for execution."}
+            return []
+        except MySQLError as batch_error:
+            conn.rollback()
+            log_event(logging.WARNING, "bulk_import.batch_failed", error=str(batch_error), rows=len(batch))
+        errors = []
+        for row_number, values in batch:
+            try:
+                cursor.execute(insert_sql, values)
+            except MySQLError as row_error:
+                errors.append((row_number, str(row_error)))  # MySQL rolls back just the failed statement
+        conn.commit()
+        return errors
+    finally:
+        cursor.close()
 
-    except MySQLError as e:
-        print(f"Error executing {query_type} query '{sql_query}': {e}")
-        if conn:
+@app.route("/employees/import", methods=["POST"])
+def bulk_import_employees():
+    """
+    Bulk-loads employees from CSV (header row with the form's field names) or JSON Lines.
+    Send the file as multipart field "file" or as the raw request body; pick the format with ?format=csv|jsonl
+    (otherwise inferred from the file name or Content-Type). Memory stays bounded by BULK_IMPORT_BATCH_SIZE.
+    """
+    upload = request.files.get("file")
+    stream = upload.stream if upload else request.stream
+    file_format = (request.args.get("format") or "").lower()
+    if not file_format:
+        source_name = (upload.filename if upload else "") or ""
+        content_type = (upload.mimetype if upload else request.mimetype) or ""
+        file_format = "jsonl" if source_name.endswith((".jsonl", ".ndjson")) or "json" in content_type else "csv"
+    if file_format not in ("csv", "jsonl"):
+        return jsonify({"response_text": "Unsupported import format. Use csv or jsonl.", "type": "FORM_ERROR"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"response_text": "Database connection failed.", "type": "EXECUTION_ERROR"}), 500
+
+    started = time.perf_counter()
+    rows_read = rows_inserted = batches = 0
+    errors, error_count = [], 0
+    batch = []
+
+    def record_error(row_number, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < BULK_IMPORT_MAX_ERRORS:
+            errors.append({"row": row_number, "error": message})
+
+    def flush():
+        nonlocal rows_inserted, batches
+        failed = insert_employee_batch(conn, batch)
+        for row_number, message in failed:
+            record_error(row_number, message)
+        rows_inserted += len(batch) - len(failed)
+        batches += 1
+        batch.clear()
+
+    try:
+        for row_number, record in iter_import_records(stream, file_format):
+            rows_read += 1
+            if isinstance(record, ValueError):
+                record_error(row_number, str(record))
+                continue
             try:
-                conn.rollback()
-            except MySQLError as rb_err:
-                print(f"Error during rollback: {rb_err}")
-        return {"error": str(e), "query_attempted": sql_query}
-    except ValueError as ve:
-         return {"error": str(ve), "query_attempted": sql_query}
+                batch.append((row_number, employee_import_row(record)))
+            except ValueError as ve:
+                record_error(row_number, str(ve))
+                continue
+            if len(batch) >= BULK_IMPORT_BATCH_SIZE:
+                flush()
+        if batch:
+            flush()
+    except (MySQLError, UnicodeDecodeError, csv.Error) as e:
+        log_event(logging.ERROR, "bulk_import.aborted", rows_read=rows_read, error=str(e))
+        record_error(rows_read, f"Import aborted: {e}")
     finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
+        conn.close()
+        if rows_inserted:
+            result_cache.invalidate_tables({"employees"})
+            recent_writes.note(clean_session_id(request.headers.get("X-Session-Id")), {"employees"})
+
+    elapsed = time.perf_counter() - started
+    log_event(logging.INFO, "bulk_import.completed", rows_read=rows_read, rows_inserted=rows_inserted, batches=batches, seconds=round(elapsed, 3))
+    return jsonify({
+        "response_text": f"Imported {rows_inserted} of {rows_read} employee record(s).",
+        "type": "IMPORT_RESULT",
+        "rows_read": rows_read,
+        "rows_inserted": rows_inserted,
+        "rows_failed": error_count,
+        "errors": errors,
+        "errors_truncated": error_count > len(errors),
+        "batches": batches,
+        "elapsed_seconds": round(elapsed, 3),
+        "rows_per_second": round(rows_inserted / elapsed, 1) if elapsed > 0 else None,
+    }), 200 if rows_inserted or not rows_read else 400
 
 @app.route("/")
 def home():
     return render_template("index.html")
 
+def collect_stats() -> dict:
+    # Per-process numbers: each worker owns its own pool, so size DB_POOL_SIZE per worker.
+    return {
+        "db_pool": db_pool.stats(),
+        "db_replicas": {**replica_set.stats(), "read_your_writes": recent_writes.stats()},
+        "pending_actions": len(pending_actions),
+        "page_tokens": page_tokens.stats(),
+        "sql_cache": sql_cache.stats(),
+        "result_cache": result_cache.stats(),
+        "schema_catalog": schema_catalog.stats(),
+        "query_guard": query_guard.stats(),
+        "query_log": query_log.stats(),
+        "local_intents": dict(intent_stats),
+        "conversations": conversations.stats(),
+        "summary_tables": {"active": len(active_summary_tables()), **summary_stats},
+        "pipeline": {"llm": llm_stage.stats(), "db": db_stage.stats(), **pipeline_stats},
+        "single_flight": {"llm": llm_flight.stats(), "select": select_flight.stats()},
+    }
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Required by /admin/stats and /metrics; unset = both endpoints are disabled
+if not ADMIN_TOKEN:
+    log_event(logging.WARNING, "admin.token_missing", detail="ADMIN_TOKEN is not set: /admin/stats and /metrics answer 403.")
+
+def admin_only(view):
+    """
+    Stats name replica hosts and carry error strings, so they require ADMIN_TOKEN (as a Bearer token or X-Admin-Token).
+    Fails closed when ADMIN_TOKEN is unset: behind a same-host reverse proxy every client looks like localhost.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        supplied = request.headers.get("X-Admin-Token") or request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not ADMIN_TOKEN or not secrets.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route("/admin/stats")
+@admin_only
+def admin_stats():
+    return jsonify(collect_stats())
+
+def _stats_gauges(stats: dict, prefix: str = "hr_chat") -> list[str]:
+    """Flattens the numeric leaves of collect_stats() into untyped Prometheus samples."""
+    lines = []
+    for key, value in stats.items():
+        name = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(key))}"
+        if isinstance(value, dict):
+            lines += _stats_gauges(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{name} {value:g}")
+    return lines
+
+@app.route("/metrics")
+@admin_only
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += _stats_gauges(collect_stats())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/chat/page", methods=["POST"])
+def page_handler():
+    data = request.get_json(silent=True) or {}
+    page_state = page_tokens.pop(data.get("page_token"))
+    if not page_state:
+        return jsonify({"error": "These results have expired. Please ask the question again."}), 400
+
+    with session_context(clean_session_id(data.get("session_id"), request.headers.get("X-Session-Id"))):
+        page = execute_select_page(page_state["sql"], tuple(page_state["params"] or ()), page_state["page_size"], page_state["plan"], page_state["position"],
+                                   max_rows=page_state.get("max_rows"), rows_served=page_state.get("rows_served", 0))
+    if "error" in page:
+        return jsonify({"response_text": f"Database error: {page['error']}", "type": "EXECUTION_ERROR"}), 500
+    return jsonify(apply_result_format({
+        "type": "DATA_PAGE",
+        "data": page["data"],
+        "columns": page.get("columns"),
+        "has_more": page["has_more"],
+        "next_page_token": page.get("next_page_token"),
+        "truncated": page.get("truncated", False),
+        "notice": truncation_notice(page_state["max_rows"]) if page.get("truncated") else None,
+    }, requested_result_format(data)))
+
+@app.route("/chat/stream", methods=["POST"])
+def stream_handler():
+    """
+    Streams every remaining row behind a next-page token as NDJSON: one JSON object per line,
+    or one array of values per line (in the table's column order) for the compact and columnar formats.
+    """
+    data = request.get_json(silent=True) or {}
+    as_arrays = requested_result_format(data) != "rows"
+    session_id = clean_session_id(data.get("session_id"), request.headers.get("X-Session-Id"))
+    page_state = page_tokens.pop(data.get("page_token"))
+    if not page_state:
+        return jsonify({"error": "These results have expired. Please ask the question again."}), 400
+    max_rows = page_state.get("max_rows")
+    remaining_rows = max_rows - page_state.get("rows_served", 0) if max_rows else None
+    # With a row cap, one row past it is read so the stream can say the result was truncated.
+    remaining_sql = build_page_sql(page_state["sql"], page_state["plan"], remaining_rows, page_state["position"])
+
+    def generate_ndjson():
+        # The stream runs after this view returns, so read-your-writes is decided here rather than from the request context.
+        rows = iter_select_rows(remaining_sql, tuple(page_state["params"] or ()), read_only=not recent_writes.session_is_sticky(session_id))
+        try:
+            for streamed, row in enumerate(rows):
+                if remaining_rows is not None and streamed >= remaining_rows:
+                    yield dumps_json({"__notice__": truncation_notice(max_rows), "__truncated__": True}) + b"\n"
+                    break
+                yield dumps_json(list(row.values()) if as_arrays else row) + b"\n"
+        except MySQLError as e:
+            log_event(logging.ERROR, "query.stream_failed", sql=remaining_sql, error=str(e))
+            yield dumps_json({"__error__": str(e)}) + b"\n"
+        finally:
+            rows.close()
+
+    return Response(generate_ndjson(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
 @app.route("/chat", methods=["POST"])
 def chat_handler():
-    data = request.get_json()
+    # The pipeline runs on the shared background loop, so the LLM/DB stage limits hold across all worker threads.
+    # For a non-blocking server, serve `asgi_app` instead (see the ASGI entry point below).
+    body, status = background_loop.run(process_chat(request.get_json(), request.headers.get("X-Session-Id")))
+    return Response(body, status=status, mimetype="application/json")
+
+async def process_chat(data: dict, session_header: str = None) -> tuple[bytes, int]:
+    """
+    Async /chat pipeline shared by the WSGI view and the ASGI entry point. Returns (JSON body, HTTP status).
+    The body is serialized here, inside the request context, so json_serialization shows up in the stage breakdown.
+    The client session id comes from the payload's "session_id" or the X-Session-Id header.
+    """
+    context = RequestContext(session_id=clean_session_id(data.get("session_id") if isinstance(data, dict) else None, session_header))
+    current_request.set(context)  # Each call runs in its own task, so this does not leak between requests
+    try:
+        payload, status = await _process_chat(data or {})
+    except StageTimeout as e:
+        log_event(logging.WARNING, "chat.timeout", stage=e.stage, error=str(e))
+        # Writes only time out while queued (see run_db_write), so a retry cannot apply one twice.
+        detail = f"the {e.stage} step timed out" if e.started else f"the {e.stage} step was too busy to start it"
+        payload, status = {"response_text": f"Sorry, that took too long ({detail}). Please try again.", "type": "ERROR"}, 504
+    if payload.get("type") == "DATA_RESULT" and context.session_id:
+        previous = conversations.get(context.session_id) if payload.get("refinement") else None
+        conversations.remember(context.session_id, data.get("message"), payload, previous=previous)
+    payload = apply_result_format(payload, requested_result_format(data))
+    with stage_timer("json_serialization"):
+        body = dumps_json(payload)
+    elapsed = time.perf_counter() - context.started
+    response_type = payload.get("type", "UNKNOWN")
+    responses_total.inc(type=response_type, status=status)
+    request_seconds.observe(elapsed, type=response_type)
+    log_event(logging.INFO, "chat.completed", type=response_type, status=status, duration_ms=round(elapsed * 1000, 2),
+              stages_ms={stage: round(seconds * 1000, 2) for stage, seconds in context.stages.items()})
+    return body, status
+
+async def _process_chat(data: dict) -> tuple[dict, int]:
     user_message = data.get("message")
     is_confirmed_execution = data.get("confirmed_execution", False)
     form_data_for_add = data.get("add_employee_form_data")
 
     if form_data_for_add:
         try:
-            required_fields = ["first_name", "last_name", "email", "hire_date", "salary"]
-            for field in required_fields:
-                if not form_data_for_add.get(field): # Check if field exists and is not empty
-                    return jsonify({"response_text": f"Missing required field: {field}", "type": "FORM_ERROR"}), 400
-
-            columns = []
-            values_placeholders = []
-            values_data = []
-            field_to_column = {
-                "first_name": "first_name", "last_name": "last_name", "email": "email",
-                "phone_number": "phone_number", "hire_date": "hire_date", "job_id": "job_id",
-                "salary": "salary", "commission_pct": "commission_pct",
-                "manager_id": "manager_id", "department_id": "department_id"
-            }
+            missing_field = missing_employee_field(form_data_for_add)
+            if missing_field:
+                return {"response_text": f"Missing required field: {missing_field}", "type": "FORM_ERROR"}, 400
 
-            for field, db_col in field_to_column.items():
-                value = form_data_for_add.get(field)
-                if value is not None and value != '': # Process if value exists and is not an empty string
-                    columns.append(db_col)
-                    values_placeholders.append("%s")
-                    
-                    if db_col in ["salary", "commission_pct"]:
-                        values_data.append(decimal.Decimal(value))
-                    elif db_col in ["manager_id", "department_id"]:
-                        values_data.append(int(value))
-                    else:
-                        values_data.append(value)
-            
+            columns, values_data = employee_columns_and_values(form_data_for_add)
             if not columns:
-                 return jsonify({"response_text": "No valid data provided for new employee.", "type": "FORM_ERROR"}), 400
+                 return {"response_text": "No valid data provided for new employee.", "type": "FORM_ERROR"}, 400
 
-            sql_query_insert = f"INSERT INTO employees ({', '.join(columns)}) VALUES ({', '.join(values_placeholders)})"
-            execution_result = execute_query(sql_query_insert, "INSERT", tuple(values_data))
+            sql_query_insert = f"INSERT INTO employees ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+            execution_result = await run_db_write(execute_query, sql_query_insert, "INSERT", tuple(values_data))
 
             if "error" in execution_result:
-                 return jsonify({
+                 return {
                     "response_text": f"Database error on insert: {execution_result['error']}",
                     "type": "EXECUTION_ERROR",
                     "query_attempted": sql_query_insert # Be cautious showing full query with data
-                }), 500
+                }, 500
             
-            return jsonify({
+            return {
                 "response_text": execution_result.get("message", "New employee added."),
                 "type": "ACTION_SUCCESS",
                 "rows_affected": execution_result.get("rows_affected"),
                 "new_employee_id": execution_result.get("new_employee_id"),
                 "query_executed": "INSERT statement from form data"
-            })
+            }, 200
 
         except ValueError as ve:
-            return jsonify({"response_text": f"Invalid data format: {ve}", "type": "FORM_ERROR"}), 400
+            return {"response_text": f"Invalid data format: {ve}", "type": "FORM_ERROR"}, 400
+        except StageTimeout:
+            raise
         except Exception as ex_form:
-             print(f"Error processing add employee form data: {ex_form}")
-             return jsonify({"response_text": "Error processing new employee data.", "type": "FORM_ERROR"}), 500
+             log_event(logging.ERROR, "chat.form_failed", error=str(ex_form))
+             return {"response_text": "Error processing new employee data.", "type": "FORM_ERROR"}, 500
 
     if not user_message or not isinstance(user_message, str) or not user_message.strip():
-        return jsonify({"error": "Message must be a non-empty string"}), 400
+        return {"error": "Message must be a non-empty string"}, 400
 
-    print(f"\nReceived message: {user_message}, Confirmed: {is_confirmed_execution}")
-    schema_desc = get_database_schema_description()
+    if is_confirmed_execution:
+        # The statement was generated and stored when confirmation was requested,
+        # so the confirm step runs it directly without asking the model again.
+        pending_action = pending_actions.pop(data.get("confirmation_token"))
+        if not pending_action:
+            expired = "This confirmation has expired or was already used. Please ask again."
+            return {"error": expired, "response_text": expired, "type": "ERROR"}, 400
+        log_event(logging.INFO, "chat.confirmation", user_message=pending_action["user_message"])
+        return await execute_and_respond(pending_action["sql"], pending_action["query_type"])
+
+    log_event(logging.INFO, "chat.message", user_message=user_message)
+    refined_answer = refine_previous_result(user_message)
+    if refined_answer is not None:
+        return refined_answer
+    local_answer = await answer_locally(user_message)
+    if local_answer is not None:
+        return local_answer
+
+    if schema_catalog.is_stale():
+        await run_db(schema_catalog.refresh)
+    model_message = with_follow_up_context(user_message)
+    schema_desc = get_database_schema_description(model_message)
     allow_writes_for_this_request = True
 
-    generated_command, command_type, pre_fill_data = generate_sql_with_gemini(user_message, schema_desc, allow_writes=allow_writes_for_this_request)
+    generated_command, command_type, pre_fill_data = await generate_sql_cached(model_message, schema_desc, allow_writes=allow_writes_for_this_request)
 
     if generated_command is None or command_type is None:
-        return jsonify({"response_text": "Sorry, I encountered an error trying to understand that.", "type": "ERROR"}), 500
+        return {"response_text": "Sorry, I encountered an error trying to understand that.", "type": "ERROR"}, 500
 
     if command_type == "LOAD_ADD_EMPLOYEE_FORM":
-        return jsonify({
+        return {
             "response_text": "Okay, let's add a new employee. Please fill out the form.",
             "type": "LOAD_COMPONENT",
             "component_name": "add_employee_form",
             "pre_fill_data": pre_fill_data if pre_fill_data else {}
-        })
+        }, 200
 
     if command_type == "CANNOT_ANSWER":
-        return jsonify({"response_text": "I'm sorry, I can't answer that or it's too ambiguous. Can you rephrase?", "type": "CLARIFICATION"})
+        return {"response_text": "I'm sorry, I can't answer that or it's too ambiguous. Can you rephrase?", "type": "CLARIFICATION"}, 200
     if command_type == "GENERAL_CHAT":
-        if "hello" in user_message.lower() or "hi" in user_message.lower():
-             return jsonify({"response_text": "Hello! How can I help you with HR data today?", "type": "CHAT"})
-        elif "bye" in user_message.lower() or "thanks" in user_message.lower():
-             return jsonify({"response_text": "You're welcome! Goodbye.", "type": "CHAT"})
-        return jsonify({"response_text": "I can help with questions about employee data. What would you like to know?", "type": "CHAT"})
+        return general_chat_response(user_message), 200
 
     sql_query = generated_command
-    if command_type in ALLOWED_WRITE_OPERATIONS and not is_confirmed_execution:
+    if command_type in ALLOWED_WRITE_OPERATIONS:
+        confirmation_token = pending_actions.put({"sql": sql_query, "query_type": command_type, "user_message": user_message})
         confirmation_message = f"I understand you want to perform a {command_type.lower()} operation. The generated query is: `{sql_query}`. Are you sure you want to proceed?"
-        return jsonify({
+        return {
             "response_text": confirmation_message,
             "type": "CONFIRMATION_REQUIRED",
             "query_to_confirm": sql_query,
-            "query_type_to_confirm": command_type
-        })
+            "query_type_to_confirm": command_type,
+            "confirmation_token": confirmation_token,
+            "expires_in": int(PENDING_ACTION_TTL)
+        }, 200
 
-    if command_type == "SELECT" or (command_type in ALLOWED_WRITE_OPERATIONS and is_confirmed_execution):
-        sql_to_execute = data.get("confirmed_sql_query", sql_query)
-        query_type_to_execute = data.get("confirmed_query_type", command_type)
+    if command_type == "SELECT":
+        return await execute_and_respond(sql_query, command_type, guard_cost=True)
+    else:
+        return {"response_text": "An unexpected state occurred.", "type": "ERROR"}, 500
 
-        if not sql_to_execute or not query_type_to_execute:
-            return jsonify({"error": "Missing confirmed query for execution."}), 400
-        
-        print(f"Proceeding with {query_type_to_execute} execution: {sql_to_execute}")
-        execution_result = execute_query(sql_to_execute, query_type_to_execute) # No params for LLM generated DML for now
-
-        if "error" in execution_result:
-            return jsonify({
-                "response_text": f"Database error: {execution_result['error']}",
-                "type": "EXECUTION_ERROR",
-                "query_attempted": execution_result.get("query_attempted", sql_to_execute)
-            }), 500
-        else:
-            if query_type_to_execute == "SELECT":
-                 return jsonify({
-                    "response_text": "Here's the data I found:",
-                    "type": "DATA_RESULT",
-                    "data": execution_result.get("data"),
-                    "query_executed": sql_to_execute
-                })
-            else: # INSERT, UPDATE
-                return jsonify({
-                    "response_text": execution_result.get("message", "Operation completed."),
-                    "type": "ACTION_SUCCESS",
-                    "rows_affected": execution_result.get("rows_affected"),
-                    "new_employee_id": execution_result.get("new_employee_id"), # If applicable
-                    "query_executed": sql_to_execute
-                })
+async def execute_and_respond(sql_to_execute: str, query_type_to_execute: str, params: tuple = None, guard_cost: bool = False) -> tuple[dict, int]:
+    """
+    Runs a SELECT or an already-confirmed write and builds the /chat response for it.
+    With `guard_cost` (model-generated SELECTs), the query is scored with EXPLAIN first and its rows are capped.
+    Identical SELECTs already running are coalesced onto one execution.
+    """
+    log_event(logging.INFO, "chat.execute", query_type=query_type_to_execute, sql=sql_to_execute)
+    guard = None
+    if query_type_to_execute == "SELECT" and guard_cost and QUERY_GUARD_ENABLED:
+        guard = await run_db(query_guard.assess, sql_to_execute, params)
+        if guard["action"] == "reject":
+            full_scans = f", scanning all of {', '.join(guard['full_scans'])}" if guard["full_scans"] else ""
+            return {
+                "response_text": (f"That query is too expensive to run: it would examine about {guard['estimated_rows']:,} rows{full_scans} "
+                                  f"(the limit is {QUERY_MAX_EXAMINED_ROWS:,}). Try narrowing it, for example to one department, employee or date range."),
+                "type": "QUERY_REJECTED",
+                "guard": guard,
+                "query_attempted": render_sql_for_display(sql_to_execute, params)
+            }, 200
+    if query_type_to_execute == "SELECT":
+        max_rows = QUERY_MAX_ROWS if guard else None
+        # Sessions pinned to the primary after a write must not share a replica read.
+        # Next-page tokens are signed and reusable, so waiters can take the leader's page as is.
+        route = "primary" if reads_use_primary() else "replica"
+        execution_result = await select_flight.run(
+            f"{QueryResultCache.make_key(sql_to_execute, params)}:{max_rows}:{route}",
+            lambda: run_db(execute_select_page, sql_to_execute, params, max_rows=max_rows))
+    else:
+        execution_result = await run_db_write(execute_query, sql_to_execute, query_type_to_execute, params) # No params for LLM generated DML for now
+    sql_to_execute = render_sql_for_display(sql_to_execute, params)
+
+    if "error" in execution_result:
+        return {
+            "response_text": f"Database error: {execution_result['error']}",
+            "type": "EXECUTION_ERROR",
+            "query_attempted": execution_result.get("query_attempted", sql_to_execute)
+        }, 500
     else:
-        return jsonify({"response_text": "An unexpected state occurred.", "type": "ERROR"}), 500
+        if query_type_to_execute == "SELECT":
+             notices = []
+             if guard and guard["action"] == "cap":
+                 notices.append(f"This query would examine about {guard['estimated_rows']:,} rows, so at most {QUERY_MAX_ROWS:,} rows are read.")
+             if execution_result.get("truncated"):
+                 notices.append(truncation_notice(QUERY_MAX_ROWS))
+             return {
+                "response_text": "Here's the data I found:",
+                "type": "DATA_RESULT",
+                "data": execution_result.get("data"),
+                "columns": execution_result.get("columns"),
+                "has_more": execution_result.get("has_more", False),
+                "next_page_token": execution_result.get("next_page_token"),
+                "truncated": execution_result.get("truncated", False),
+                "guard": guard,
+                "notice": " ".join(notices) or None,
+                "query_executed": sql_to_execute
+            }, 200
+        else: # INSERT, UPDATE
+            return {
+                "response_text": execution_result.get("message", "Operation completed."),
+                "type": "ACTION_SUCCESS",
+                "rows_affected": execution_result.get("rows_affected"),
+                "new_employee_id": execution_result.get("new_employee_id"), # If applicable
+                "query_executed": sql_to_execute
+            }, 200
+
+# --- ASGI Entry Point ---
+# Serve with an ASGI server (e.g. `uvicorn app:asgi_app`) to keep hundreds of chats in flight on one event loop
+# without a thread each. /chat runs natively and is cancelled when the client disconnects;
+# every other route is delegated to the Flask app through asgiref.
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+flask_asgi_app = WsgiToAsgi(app) if WsgiToAsgi else None
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http" and scope["path"] == "/chat" and scope["method"] == "POST":
+        headers = {name: value.decode("latin-1") for name, value in scope.get("headers") or []}
+        await _asgi_chat(receive, send, headers.get(b"accept-encoding", ""), headers.get(b"x-session-id"))
+        return
+    if flask_asgi_app is None:
+        await _asgi_send_json(send, {"error": "Install asgiref to serve routes other than /chat over ASGI."}, 501)
+        return
+    await flask_asgi_app(scope, receive, send)
+
+async def _asgi_chat(receive, send, accept_encoding: str = "", session_header: str = None):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(body or b"null")
+    except ValueError:
+        await _asgi_send_json(send, {"error": "Request body must be JSON."}, 400)
+        return
+
+    chat_task = asyncio.ensure_future(process_chat(data, session_header))
+    disconnect_task = asyncio.ensure_future(_wait_for_disconnect(receive))
+    done, _ = await asyncio.wait({chat_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    if chat_task not in done:
+        # Frees the LLM/DB stage slots for clients that are still waiting.
+        chat_task.cancel()
+        pipeline_stats["cancelled_on_disconnect"] += 1
+        log_event(logging.INFO, "chat.cancelled_on_disconnect")
+        return
+    disconnect_task.cancel()
+    try:
+        body, status = chat_task.result()
+    except Exception as e:
+        log_event(logging.ERROR, "chat.unhandled_error", error=str(e))
+        await _asgi_send_json(send, {"response_text": "An unexpected error occurred.", "type": "ERROR"}, 500, accept_encoding)
+        return
+    await _asgi_send_body(send, body, status, accept_encoding)
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def _asgi_send_json(send, payload: dict, status: int, accept_encoding: str = ""):
+    await _asgi_send_body(send, dumps_json(payload), status, accept_encoding)
+
+async def _asgi_send_body(send, body: bytes, status: int, accept_encoding: str = ""):
+    body, encoding = compress_body(body, accept_encoding)
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"vary", b"Accept-Encoding")]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode()))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    await send({"type": "http.response.body", "body": body})
 
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
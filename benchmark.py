@@ -0,0 +1,638 @@
+"""
+Latency/throughput benchmark for /chat that needs neither a Gemini key nor a MySQL server.
+
+The real request path in app.py is exercised end to end; only the two external services are replaced:
+  * Gemini -> FakeGeminiModel: canned SQL per question, with configurable latency.
+  * MySQL  -> a SQLite file behind the app's own DBConnectionPool, seeded with a generated HR dataset.
+
+A mixed workload (LLM SELECTs, template SELECTs, confirmed writes, form inserts, chit-chat) is replayed at the
+requested concurrency, and p50/p95/p99 latency and requests/sec are reported per request kind and per stage.
+
+    python benchmark.py --employees 5000 --requests 2000 --concurrency 32 --llm-latency 0.4
+    python benchmark.py --transport asgi --concurrency 200 --json
+"""
+import argparse
+import asyncio
+import datetime
+import decimal
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector.errors as mysql_errors
+
+# --- Gemini Stand-in ---
+QUESTION_PATTERN = re.compile(r'question/command:\s*"(.*)"\s*\n\s*Analyze', re.DOTALL)
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str, prompt: str):
+        self.text = text
+        self.parts = [text] if text else []
+        self.prompt_feedback = None
+        # Rough token counts (4 chars/token) so usage accounting has something to report.
+        self.usage_metadata = type("UsageMetadata", (), {
+            "prompt_token_count": len(prompt) // 4,
+            "candidates_token_count": len(text) // 4,
+            "total_token_count": (len(prompt) + len(text)) // 4,
+        })()
+
+
+class FakeGeminiModel:
+    """
+    Drop-in for genai.GenerativeModel. Answers each question with the canned text registered for it
+    (default "CANNOT_ANSWER") after latency + uniform(0, jitter) seconds.
+    """
+    def __init__(self, latency: float = 0.3, jitter: float = 0.1, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.responses = {}
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def register(self, question: str, response_text: str):
+        self.responses[question] = response_text
+
+    def _answer(self, prompt: str) -> tuple[float, FakeGeminiResponse]:
+        match = QUESTION_PATTERN.search(prompt)
+        question = match.group(1) if match else ""
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+        return delay, FakeGeminiResponse(self.responses.get(question, "CANNOT_ANSWER"), prompt)
+
+    def generate_content(self, prompt: str) -> FakeGeminiResponse:
+        delay, response = self._answer(prompt)
+        time.sleep(delay)
+        return response
+
+    async def generate_content_async(self, prompt: str) -> FakeGeminiResponse:
+        delay, response = self._answer(prompt)
+        await asyncio.sleep(delay)
+        return response
+
+
+# --- MySQL Stand-in (SQLite) ---
+UNBOUNDED_LIMIT_PATTERN = re.compile(r"\bLIMIT\s+18446744073709551615\b", re.IGNORECASE)
+DATE_ARITHMETIC_PATTERN = re.compile(
+    r"\b(DATE_SUB|DATE_ADD)\(\s*([^,]+?)\s*,\s*INTERVAL\s+(\d+)\s+(DAY|WEEK|MONTH|YEAR)S?\s*\)", re.IGNORECASE)
+CURDATE_PATTERN = re.compile(r"\bCURDATE\(\)", re.IGNORECASE)
+DROP_INDEX_PATTERN = re.compile(r"^\s*DROP\s+INDEX\s+(\w+)\s+ON\s+\w+", re.IGNORECASE)
+
+sqlite3.register_adapter(decimal.Decimal, float)
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" "))
+
+
+def translate_mysql(sql: str, has_params: bool) -> str:
+    """Rewrites the MySQL dialect the app and the canned SQL use into SQLite."""
+    if has_params:
+        sql = sql.replace("%s", "?").replace("%%", "%")
+    sql = UNBOUNDED_LIMIT_PATTERN.sub("LIMIT -1", sql)
+    sql = CURDATE_PATTERN.sub("DATE('now')", sql)
+    sql = DROP_INDEX_PATTERN.sub(r"DROP INDEX \1", sql)
+
+    def date_arithmetic(match):
+        sign = "-" if match.group(1).upper() == "DATE_SUB" else "+"
+        amount, unit = int(match.group(3)), match.group(4).lower()
+        if unit == "week":
+            amount, unit = amount * 7, "day"
+        return f"DATE({match.group(2)}, '{sign}{amount} {unit}')"
+    return DATE_ARITHMETIC_PATTERN.sub(date_arithmetic, sql)
+
+
+def _date_part(bounds: tuple):
+    return lambda value: int(str(value)[slice(*bounds)]) if value else None
+
+
+def _mysql_error(e: sqlite3.Error) -> mysql_errors.Error:
+    message = str(e)
+    if isinstance(e, sqlite3.IntegrityError):
+        return mysql_errors.IntegrityError(msg=message, errno=1062)
+    if "no such table" in message:
+        return mysql_errors.ProgrammingError(msg=message, errno=1146)
+    if "no such column" in message:
+        return mysql_errors.ProgrammingError(msg=message, errno=1054)
+    if "syntax error" in message:
+        return mysql_errors.ProgrammingError(msg=message, errno=1064)
+    return mysql_errors.DatabaseError(msg=message)
+
+
+class SQLiteCursor:
+    """The subset of the mysql.connector cursor API app.py uses (dictionary and unbuffered cursors included)."""
+    def __init__(self, raw_conn: sqlite3.Connection, dictionary: bool = False):
+        self._cursor = raw_conn.cursor()
+        self._dictionary = dictionary
+        self.rowcount = -1
+        self.lastrowid = None
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def column_names(self) -> tuple:
+        return tuple(column[0] for column in self._cursor.description or ())
+
+    @property
+    def with_rows(self) -> bool:
+        return self._cursor.description is not None
+
+    def execute(self, operation: str, params=None):
+        try:
+            self._cursor.execute(translate_mysql(operation, params is not None), tuple(params or ()))
+        except sqlite3.Error as e:
+            raise _mysql_error(e) from e
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+
+    def executemany(self, operation: str, seq_params):
+        try:
+            self._cursor.executemany(translate_mysql(operation, True), [tuple(params) for params in seq_params])
+        except sqlite3.Error as e:
+            raise _mysql_error(e) from e
+        self.rowcount = self._cursor.rowcount
+
+    def _convert(self, row):
+        if row is None or not self._dictionary:
+            return row if row is None else tuple(row)
+        return dict(zip(self.column_names, row))
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    def fetchmany(self, size: int = 1) -> list:
+        return [self._convert(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self) -> list:
+        return [self._convert(row) for row in self._cursor.fetchall()]
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """One SQLite connection per pooled MySQL connection, so pool sizing behaves as it would against MySQL."""
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA busy_timeout = 30000")
+        for name, args, func in [
+            ("NOW", 0, lambda: datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            ("YEAR", 1, _date_part((0, 4))), ("MONTH", 1, _date_part((5, 7))), ("DAY", 1, _date_part((8, 10))),
+            ("CONCAT", -1, lambda *parts: None if None in parts else "".join(str(p) for p in parts)),
+            ("CONCAT_WS", -1, lambda sep, *parts: str(sep).join(str(p) for p in parts if p is not None)),
+            ("DATEDIFF", 2, lambda a, b: (datetime.date.fromisoformat(str(a)[:10]) - datetime.date.fromisoformat(str(b)[:10])).days),
+            ("CRC32", 1, lambda value: zlib.crc32(str(value).encode())),
+            ("DATABASE", 0, lambda: "main"),
+        ]:
+            self._conn.create_function(name, args, func, deterministic=name not in ("NOW",))
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._conn.in_transaction
+
+    def is_connected(self) -> bool:
+        return True
+
+    def ping(self, reconnect: bool = False, attempts: int = 1, delay: int = 0):
+        self._conn.execute("SELECT 1")
+
+    def cursor(self, dictionary: bool = False, buffered: bool = None, **kwargs) -> SQLiteCursor:
+        return SQLiteCursor(self._conn, dictionary=dictionary)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def cmd_reset_connection(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+# --- Seeded HR Dataset ---
+SCHEMA_DDL = """
+CREATE TABLE departments (department_id INTEGER PRIMARY KEY, department_name TEXT NOT NULL UNIQUE, location TEXT);
+CREATE TABLE employees (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, first_name TEXT NOT NULL, last_name TEXT NOT NULL, email TEXT UNIQUE,
+    phone_number TEXT, hire_date TEXT, job_id TEXT, salary NUMERIC, commission_pct NUMERIC, manager_id INTEGER,
+    department_id INTEGER, insertion_date TEXT DEFAULT CURRENT_TIMESTAMP, last_payment_date TEXT);
+CREATE TABLE payments (
+    payment_id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id INTEGER NOT NULL, payment_date TEXT NOT NULL,
+    amount NUMERIC NOT NULL, payment_type TEXT DEFAULT 'Salary', notes TEXT);
+CREATE TABLE leave_requests (
+    leave_id INTEGER PRIMARY KEY AUTOINCREMENT, employee_id INTEGER NOT NULL, leave_type TEXT NOT NULL DEFAULT 'Vacation',
+    start_date TEXT NOT NULL, end_date TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'Pending', reason TEXT,
+    requested_date TEXT DEFAULT CURRENT_TIMESTAMP, approved_by INTEGER);
+CREATE INDEX idx_employees_department ON employees (department_id);
+CREATE INDEX idx_payments_employee ON payments (employee_id);
+CREATE INDEX idx_leave_requests_employee ON leave_requests (employee_id);
+"""
+DEPARTMENT_NAMES = ["Engineering", "Sales", "Marketing", "Finance", "Human Resources", "Operations",
+                    "Customer Support", "Legal", "Research", "Procurement", "Logistics", "Design"]
+LOCATIONS = ["New York", "London", "Berlin", "Tunis", "Toronto", "Singapore"]
+FIRST_NAMES = ["Ana", "Ben", "Chloe", "David", "Emma", "Farid", "Grace", "Hugo", "Ines", "Jon", "Karim", "Lea",
+               "Mona", "Nils", "Olga", "Paul", "Rania", "Sami", "Tara", "Yusuf"]
+LAST_NAMES = ["Smith", "Jones", "Brown", "Garcia", "Miller", "Ben Ali", "Schmidt", "Dubois", "Rossi", "Khan",
+              "Nguyen", "Silva", "Haddad", "Novak", "Jensen"]
+JOB_IDS = ["IT_PROG", "SA_REP", "SA_MAN", "FI_ACCOUNT", "HR_REP", "MK_MAN", "ST_CLERK", "AD_ASST"]
+LEAVE_TYPES = ["Vacation", "Sick", "Personal", "Parental"]
+LEAVE_STATUSES = ["Pending", "Approved", "Rejected"]
+
+
+def seed_database(path: str, employees: int, departments: int, payments_per_employee: int,
+                  leaves_per_employee: int, seed: int) -> dict:
+    """Creates and fills the HR tables; returns the dataset facts the workload generator needs."""
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA_DDL)
+
+    department_rows = [(10 * (i + 1), DEPARTMENT_NAMES[i] if i < len(DEPARTMENT_NAMES) else f"Department {i + 1}",
+                        rng.choice(LOCATIONS)) for i in range(departments)]
+    conn.executemany("INSERT INTO departments VALUES (?, ?, ?)", department_rows)
+
+    employee_rows = []
+    for employee_id in range(1, employees + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        employee_rows.append((
+            employee_id, first, last, f"{first}.{last}.{employee_id}@example.com".lower().replace(" ", ""),
+            f"+1-555-{rng.randint(1000, 9999)}", (today - datetime.timedelta(days=rng.randint(30, 3650))).isoformat(),
+            rng.choice(JOB_IDS), round(rng.uniform(2500, 15000), 2), rng.choice([None, None, 0.05, 0.1]),
+            rng.randint(1, employee_id - 1) if employee_id > 1 and rng.random() < 0.9 else None,
+            rng.choice(department_rows)[0],
+        ))
+    conn.executemany("INSERT INTO employees (id, first_name, last_name, email, phone_number, hire_date, job_id, "
+                     "salary, commission_pct, manager_id, department_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     employee_rows)
+
+    def payment_rows():
+        for row in employee_rows:
+            employee_id, salary = row[0], row[7]
+            for month in range(payments_per_employee):
+                paid_on = (today.replace(day=1) - datetime.timedelta(days=30 * month)).replace(day=25)
+                yield employee_id, paid_on.isoformat(), salary, "Salary", None
+                if rng.random() < 0.05:
+                    yield employee_id, paid_on.isoformat(), round(salary * 0.1, 2), "Bonus", "Performance bonus"
+    conn.executemany("INSERT INTO payments (employee_id, payment_date, amount, payment_type, notes) "
+                     "VALUES (?, ?, ?, ?, ?)", payment_rows())
+
+    def leave_rows():
+        for employee_id in range(1, employees + 1):
+            for _ in range(rng.randint(0, 2 * leaves_per_employee)):
+                start = today + datetime.timedelta(days=rng.randint(-365, 60))
+                yield (employee_id, rng.choice(LEAVE_TYPES), start.isoformat(),
+                       (start + datetime.timedelta(days=rng.randint(0, 10))).isoformat(), rng.choice(LEAVE_STATUSES))
+    conn.executemany("INSERT INTO leave_requests (employee_id, leave_type, start_date, end_date, status) "
+                     "VALUES (?, ?, ?, ?, ?)", leave_rows())
+    conn.commit()
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ("departments", "employees", "payments", "leave_requests")}
+    conn.close()
+    return {"departments": [(row[0], row[1]) for row in department_rows], "employees": employees, "row_counts": counts}
+
+
+# --- Workload ---
+DEFAULT_MIX = "llm_select=45,template_select=15,write=10,form=10,chat=20"
+
+
+def plan_workload(total: int, mix: dict, dataset: dict, model: FakeGeminiModel, seed: int) -> list:
+    """
+    A reproducible list of operations. Each is (kind, payload); "write" operations are a write request
+    followed by its confirmation, which the driver sends with the returned token.
+    Canned SQL for every LLM-bound question is registered on the fake model.
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    departments = dataset["departments"]
+    employees = dataset["employees"]
+
+    def llm_select():
+        department_id, department_name = rng.choice(departments)
+        employee_id = rng.randint(1, employees)
+        year = datetime.date.today().year - rng.randint(0, 5)
+        top_n = rng.choice([5, 10, 20])
+        question, sql = rng.choice([
+            (f"What is the average salary in the {department_name} department?",
+             "SELECT AVG(e.salary) AS average_salary FROM employees e JOIN departments d "
+             f"ON e.department_id = d.department_id WHERE d.department_name = '{department_name}'"),
+            (f"Show the top {top_n} highest paid employees",
+             f"SELECT id, first_name, last_name, salary FROM employees ORDER BY salary DESC LIMIT {top_n}"),
+            (f"What is the total amount paid to employee {employee_id}?",
+             f"SELECT SUM(amount) AS total_paid FROM payments WHERE employee_id = {employee_id}"),
+            (f"List everyone hired since {year}",
+             f"SELECT id, first_name, last_name, hire_date FROM employees WHERE hire_date >= '{year}-01-01'"),
+            ("How many leave requests are there per status?",
+             "SELECT status, COUNT(*) AS requests FROM leave_requests GROUP BY status"),
+            (f"Headcount and payroll for department id {department_id}",
+             "SELECT COUNT(*) AS headcount, SUM(salary) AS monthly_payroll FROM employees "
+             f"WHERE department_id = {department_id}"),
+        ])
+        model.register(question, sql)
+        return {"message": question}
+
+    def template_select():
+        return {"message": rng.choice([
+            f"List employees in {rng.choice(departments)[1]}",
+            f"Show {rng.choice(['pending', 'approved', 'rejected'])} leave requests",
+            f"Show payments for employee {rng.randint(1, employees)}",
+        ])}
+
+    def write():
+        employee_id = rng.randint(1, employees)
+        salary = rng.randint(30, 150) * 100
+        question = f"Set the salary of employee {employee_id} to {salary}"
+        model.register(question, f"UPDATE employees SET salary = {salary} WHERE id = {employee_id}")
+        return {"message": question}
+
+    def form(index):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        return {"add_employee_form_data": {
+            "first_name": first, "last_name": last,
+            "email": f"bench.{seed}.{index}.{rng.randint(0, 10**9)}@example.com",
+            "hire_date": datetime.date.today().isoformat(), "salary": str(rng.randint(3000, 9000)),
+            "job_id": rng.choice(JOB_IDS), "department_id": str(rng.choice(departments)[0]),
+        }}
+
+    def chat():
+        question = rng.choice(["Hello!", "Good morning", "Thanks a lot", "Bye", "Tell me a joke", "How are you today?"])
+        model.register(question, "GENERAL_CHAT")
+        return {"message": question}
+
+    builders = {"llm_select": llm_select, "template_select": template_select, "write": write, "chat": chat}
+    operations = []
+    for index in range(total):
+        kind = rng.choices(kinds, weights)[0]
+        operations.append((kind, form(index) if kind == "form" else builders[kind]()))
+    return operations
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("llm_select", "template_select", "write", "form", "chat"):
+            raise argparse.ArgumentTypeError(f"Unknown workload kind: {kind!r}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+# --- Measurement ---
+class StageTimings:
+    """Thread-safe latency samples per stage name."""
+    def __init__(self):
+        self._samples = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, ok: bool = True):
+        with self._lock:
+            self._samples[stage].append(seconds)
+            if not ok:
+                self._errors[stage] += 1
+
+    def request_count(self) -> int:
+        return sum(len(samples) for stage, samples in self._samples.items() if not stage.startswith("stage:"))
+
+    def report(self, wall_seconds: float) -> dict:
+        report = {}
+        for stage, samples in sorted(self._samples.items()):
+            ordered = sorted(samples)
+            quantiles = statistics.quantiles(ordered, n=100, method="inclusive") if len(ordered) > 1 else ordered * 99
+            report[stage] = {
+                "count": len(ordered), "errors": self._errors[stage],
+                "p50_ms": round(quantiles[49] * 1000, 2), "p95_ms": round(quantiles[94] * 1000, 2),
+                "p99_ms": round(quantiles[98] * 1000, 2), "max_ms": round(ordered[-1] * 1000, 2),
+                "req_per_s": round(len(ordered) / wall_seconds, 1) if wall_seconds else None,
+            }
+        return report
+
+
+def instrument_stages(app_module, timings: StageTimings):
+    """Wraps the LLM call and the DB stage so their share of each request is timed separately."""
+    generate = app_module.generate_sql_with_gemini_async
+    run_db = app_module.run_db
+
+    async def timed_generate(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await generate(*args, **kwargs)
+        finally:
+            timings.record("stage:llm", time.perf_counter() - started)
+
+    async def timed_run_db(func, *args, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = await run_db(func, *args, **kwargs)
+            ok = not (isinstance(result, dict) and "error" in result)
+            return result
+        finally:
+            timings.record(f"stage:db:{getattr(func, '__name__', 'call')}", time.perf_counter() - started, ok)
+
+    app_module.generate_sql_with_gemini_async = timed_generate
+    app_module.run_db = timed_run_db
+
+
+EXPECTED_TYPES = {
+    "llm_select": {"DATA_RESULT"}, "template_select": {"DATA_RESULT"}, "write": {"CONFIRMATION_REQUIRED"},
+    "write_confirm": {"ACTION_SUCCESS"}, "form": {"ACTION_SUCCESS"}, "chat": {"CHAT"},
+}
+
+
+# --- Drivers ---
+def run_wsgi(app_module, operations: list, concurrency: int, timings: StageTimings):
+    local = threading.local()
+
+    def post(payload: dict) -> dict:
+        if not hasattr(local, "client"):
+            local.client = app_module.app.test_client()
+        return local.client.post("/chat", json=payload).get_json() or {}
+
+    def run_operation(operation):
+        kind, payload = operation
+        timed_request(kind, payload, post, timings, confirm=lambda p: timed_request("write_confirm", p, post, timings))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_operation, operations))
+
+
+def timed_request(kind: str, payload: dict, post, timings: StageTimings, confirm=None):
+    started = time.perf_counter()
+    try:
+        response = post(payload)
+    except Exception as e:
+        print(f"{kind} request failed: {e}", file=sys.stderr)
+        response = {}
+    timings.record(kind, time.perf_counter() - started, response.get("type") in EXPECTED_TYPES[kind])
+    if confirm and response.get("confirmation_token"):
+        return confirm({"message": payload["message"], "confirmed_execution": True,
+                        "confirmation_token": response["confirmation_token"]})
+    return response
+
+
+async def run_asgi(app_module, operations: list, concurrency: int, timings: StageTimings):
+    queue = asyncio.Queue()
+    for operation in operations:
+        queue.put_nowait(operation)
+
+    async def post(payload: dict) -> dict:
+        body = json.dumps(payload).encode()
+        sent, response = asyncio.Event(), {}
+        delivered = False
+
+        async def receive():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await sent.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                response.update(json.loads(message["body"] or b"{}"))
+                sent.set()
+        scope = {"type": "http", "method": "POST", "path": "/chat", "headers": [(b"content-type", b"application/json")]}
+        await app_module.asgi_app(scope, receive, send)
+        return response
+
+    async def timed(kind, payload):
+        started = time.perf_counter()
+        try:
+            response = await post(payload)
+        except Exception as e:
+            print(f"{kind} request failed: {e}", file=sys.stderr)
+            response = {}
+        timings.record(kind, time.perf_counter() - started, response.get("type") in EXPECTED_TYPES[kind])
+        return response
+
+    async def worker():
+        while not queue.empty():
+            kind, payload = queue.get_nowait()
+            response = await timed(kind, payload)
+            if kind == "write" and response.get("confirmation_token"):
+                await timed("write_confirm", {"message": payload["message"], "confirmed_execution": True,
+                                              "confirmation_token": response["confirmation_token"]})
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+# --- Entry Point ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, default=2000)
+    parser.add_argument("--departments", type=int, default=12)
+    parser.add_argument("--payments-per-employee", type=int, default=12)
+    parser.add_argument("--leaves-per-employee", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=1000, help="Operations to replay (a write counts once)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Default: {DEFAULT_MIX}")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds per fake Gemini call")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="Extra uniform random seconds per call")
+    parser.add_argument("--db-pool-size", type=int, default=None, help="Overrides DB_POOL_SIZE")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the SQL generation and SELECT result caches")
+    parser.add_argument("--transport", choices=["wsgi", "asgi"], default="wsgi",
+                        help="wsgi: Flask test client on threads; asgi: app.asgi_app on one event loop")
+    parser.add_argument("--result-format", choices=["rows", "compact", "columnar"], default="rows",
+                        help="DATA_RESULT layout requested by every chat call")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database", help="SQLite file to use (default: a temporary file)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's INFO logs (every request sampled)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    if args.db_pool_size:
+        os.environ["DB_POOL_SIZE"] = str(args.db_pool_size)
+    if args.no_cache:
+        os.environ["SQL_CACHE_SIZE"] = "0"
+        os.environ["RESULT_CACHE_MAX_BYTES"] = "0"
+    os.environ.pop("SQL_CACHE_PATH", None)
+    os.environ.setdefault("ADMIN_TOKEN", "benchmark")  # The report reads /admin/stats
+    if args.verbose:
+        os.environ.setdefault("LOG_SAMPLE_RATE", "1")
+    else:
+        os.environ["LOG_LEVEL"] = "WARNING"
+
+    workdir = tempfile.mkdtemp(prefix="hr-benchmark-")
+    database_path = args.database or os.path.join(workdir, "hr.sqlite3")
+    os.environ.setdefault("QUERY_LOG_PATH", os.path.join(workdir, "query_log.sqlite3"))
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    seed_started = time.perf_counter()
+    dataset = seed_database(database_path, args.employees, args.departments, args.payments_per_employee,
+                            args.leaves_per_employee, args.seed)
+    seed_seconds = time.perf_counter() - seed_started
+
+    import app as app_module
+    model = FakeGeminiModel(args.llm_latency, args.llm_jitter, seed=args.seed)
+    app_module.model = model
+    app_module.db_pool = app_module.DBConnectionPool(
+        pool_size=app_module.DB_POOL_SIZE, timeout=app_module.DB_POOL_TIMEOUT, recycle=app_module.DB_POOL_RECYCLE,
+        ping_after=app_module.DB_POOL_PING_AFTER, reset_on_return=app_module.DB_POOL_RESET_ON_RETURN,
+        connect_factory=lambda: SQLiteConnection(database_path))
+    timings = StageTimings()
+    instrument_stages(app_module, timings)
+    operations = plan_workload(args.requests, args.mix, dataset, model, args.seed)
+    if args.result_format != "rows":
+        operations = [(kind, {**payload, "result_format": args.result_format}) for kind, payload in operations]
+
+    started = time.perf_counter()
+    if args.transport == "asgi":
+        asyncio.run(run_asgi(app_module, operations, args.concurrency, timings))
+    else:
+        run_wsgi(app_module, operations, args.concurrency, timings)
+    wall_seconds = time.perf_counter() - started
+    app_stats = app_module.app.test_client().get("/admin/stats", headers={"X-Admin-Token": app_module.ADMIN_TOKEN}).get_json()
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("json", "verbose")},
+        "dataset": {**dataset["row_counts"], "seed_seconds": round(seed_seconds, 2)},
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_req_per_s": round(timings.request_count() / wall_seconds, 1),
+        "llm_calls": model.calls,
+        "stages": timings.report(wall_seconds),
+        "app": {name: app_stats.get(name) for name in ("sql_cache", "result_cache", "db_pool", "local_intents", "pipeline", "single_flight")},
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
+    return report
+
+
+def print_report(report: dict):
+    config = report["config"]
+    print(f"Dataset: {report['dataset']}")
+    print(f"{config['requests']} operations, concurrency {config['concurrency']}, transport {config['transport']}, "
+          f"LLM latency {config['llm_latency']}s+{config['llm_jitter']}s, {report['llm_calls']} LLM calls, "
+          f"{report['wall_seconds']}s wall")
+    print(f"\n{'stage':<40}{'count':>7}{'errors':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>9}")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<40}{row['count']:>7}{row['errors']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{row['max_ms']:>10}{row['req_per_s']:>9}")
+    print(f"\nOverall: {report['throughput_req_per_s']} req/s")
+    for name, stats in report["app"].items():
+        print(f"{name}: {json.dumps(stats, default=str)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,24 @@ document.addEventListener('DOMContentLoaded', () => {
 
     let pendingConfirmation = null;
     let currentFormComponent = null;
+    // Ask for table results as column names plus row arrays instead of one object per row.
+    const RESULT_FORMAT = 'compact';
+    // Identifies this tab to the server, so reads right after our own writes see them (read-your-writes).
+    const SESSION_ID = getSessionId();
+    const API_HEADERS = { 'Content-Type': 'application/json', 'X-Session-Id': SESSION_ID };
+
+    function getSessionId() {
+        try {
+            let sessionId = sessionStorage.getItem('hrChatSessionId');
+            if (!sessionId) {
+                sessionId = window.crypto && crypto.randomUUID ? crypto.randomUUID() : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+                sessionStorage.setItem('hrChatSessionId', sessionId);
+            }
+            return sessionId;
+        } catch (error) { // Storage can be disabled; a per-page id still works
+            return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+        }
+    }
 
     if (chatbotToggleButton) {
         chatbotToggleButton.addEventListener('click', () => {
@@ -59,8 +77,8 @@ document.addEventListener('DOMContentLoaded', () => {
         try {
             const response = await fetch('/chat', { // This path is relative to the domain
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(payload),
+                headers: API_HEADERS,
+                body: JSON.stringify({ result_format: RESULT_FORMAT, ...payload }),
             });
             displayThinkingIndicator(false);
             if (!response.ok) {
@@ -105,8 +123,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 break;
             case "CONFIRMATION_REQUIRED":
                 pendingConfirmation = {
-                    query_to_confirm: data.query_to_confirm,
-                    query_type_to_confirm: data.query_type_to_confirm,
+                    confirmation_token: data.confirmation_token,
                     original_user_message: originalUserMessage
                 };
                 const confirmMsgElement = addMessage(data.response_text, 'bot', 'confirmation');
@@ -114,7 +131,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 break;
             case "DATA_RESULT":
                 addMessage(data.response_text, 'bot', 'info');
-                displayDataTableOnPage(data.data, data.query_executed, originalUserMessage);
+                displayDataTableOnPage(data.data, data.query_executed, originalUserMessage, data.next_page_token, data.notice);
                 break;
             case "ACTION_SUCCESS":
                 addMessage(data.response_text, 'bot', 'success');
@@ -134,6 +151,10 @@ document.addEventListener('DOMContentLoaded', () => {
                     dataDisplayArea.style.opacity = 1;
                  }
                 break;
+            case "QUERY_REJECTED":
+                addMessage(data.response_text, 'bot', 'error');
+                if (data.query_attempted) addMessage(`Attempted Query: ${data.query_attempted}`, 'bot', 'info');
+                break;
             case "CLARIFICATION":
             case "CHAT":
                 addMessage(data.response_text, 'bot', 'info');
@@ -157,11 +178,11 @@ document.addEventListener('DOMContentLoaded', () => {
             }
             buttonsDiv.remove();
             try {
+                // The server kept the generated statement; the token is all it needs to run it.
                 const data = await callChatAPI({
                     message: pendingConfirmation.original_user_message,
                     confirmed_execution: true,
-                    confirmed_sql_query: pendingConfirmation.query_to_confirm,
-                    confirmed_query_type: pendingConfirmation.query_type_to_confirm
+                    confirmation_token: pendingConfirmation.confirmation_token
                 });
                 processApiResponse(data, pendingConfirmation.original_user_message);
             } catch (error) { /* Handled by callChatAPI */ }
@@ -278,12 +299,13 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function displayDataTableOnPage(data, queryExecuted, userQuery) {
+    function displayDataTableOnPage(data, queryExecuted, userQuery, nextPageToken = null, notice = null) {
         if (!dataDisplayArea) return;
         dataDisplayArea.innerHTML = '';
         dataDisplayArea.style.opacity = 0;
 
-        if (!data || data.length === 0) {
+        const { columns, rows } = tableFromResult(data);
+        if (rows.length === 0) {
             const noDataMessage = document.createElement('p');
             noDataMessage.textContent = "No data found for your query.";
             noDataMessage.style.textAlign = 'center';
@@ -299,6 +321,7 @@ document.addEventListener('DOMContentLoaded', () => {
         title.classList.add('table-title');
         title.textContent = `Query Results: "${userQuery}"`;
         dataDisplayArea.appendChild(title);
+        if (notice) showTableNotice(notice);
 
         const tableContainer = document.createElement('div');
         tableContainer.classList.add('data-table-container');
@@ -306,9 +329,10 @@ document.addEventListener('DOMContentLoaded', () => {
         const table = document.createElement('table');
         table.classList.add('styled-table');
 
+        // Later pages are matched to these columns, so every row lines up with the header.
         const thead = document.createElement('thead');
         const headerRow = document.createElement('tr');
-        Object.keys(data[0]).forEach(key => {
+        columns.forEach(key => {
             const th = document.createElement('th');
             th.textContent = key.replace(/_/g, ' ').replace(/\b\w/g, l => l.toUpperCase());
             headerRow.appendChild(th);
@@ -317,23 +341,163 @@ document.addEventListener('DOMContentLoaded', () => {
         table.appendChild(thead);
 
         const tbody = document.createElement('tbody');
-        data.forEach(rowData => {
-            const tr = document.createElement('tr');
-            Object.values(rowData).forEach(value => {
-                const td = document.createElement('td');
-                td.textContent = value !== null ? String(value) : 'N/A';
-                tr.appendChild(td);
-            });
-            tbody.appendChild(tr);
-        });
+        appendTableRows(tbody, columns, rows);
         table.appendChild(tbody);
         tableContainer.appendChild(table);
+
+        const rowCount = document.createElement('p');
+        rowCount.classList.add('table-row-count');
+        tableContainer.appendChild(rowCount);
+        const updateRowCount = (hasMore) => {
+            rowCount.textContent = `Showing ${tbody.rows.length} row(s)${hasMore ? ' so far' : ''}.`;
+        };
+        updateRowCount(Boolean(nextPageToken));
+        if (nextPageToken) renderPaginationControls(tableContainer, tbody, columns, nextPageToken, updateRowCount);
+
         dataDisplayArea.appendChild(tableContainer);
         if (queryExecuted) addExecutedQueryToPage(queryExecuted, userQuery, tableContainer);
         
         setTimeout(() => dataDisplayArea.style.opacity = 1, 50);
     }
 
+    // Server-side limits (row cap, cost guard) explain themselves above the table.
+    function showTableNotice(text) {
+        if (!dataDisplayArea || !text) return;
+        let noticeElement = dataDisplayArea.querySelector('.table-notice');
+        if (!noticeElement) {
+            noticeElement = document.createElement('p');
+            noticeElement.classList.add('table-notice');
+            const title = dataDisplayArea.querySelector('.table-title');
+            dataDisplayArea.insertBefore(noticeElement, title ? title.nextSibling : dataDisplayArea.firstChild);
+        }
+        noticeElement.textContent = text;
+    }
+
+    // Accepts every server layout: a list of row objects, {columns, rows} (compact) or {columns, values} (columnar).
+    function tableFromResult(data) {
+        if (!data) return { columns: [], rows: [] };
+        if (Array.isArray(data)) {
+            return { columns: data.length ? Object.keys(data[0]) : [], rows: data };
+        }
+        const columns = data.columns || [];
+        if (data.values) {
+            const rowCount = data.values.length ? data.values[0].length : 0;
+            const rows = Array.from({ length: rowCount }, (_, i) => data.values.map(values => values[i]));
+            return { columns, rows };
+        }
+        return { columns, rows: data.rows || [] };
+    }
+
+    // Rows are value arrays in column order, or objects keyed by column name.
+    function appendTableRows(tbody, columns, rows) {
+        const fragment = document.createDocumentFragment();
+        rows.forEach(rowData => {
+            const tr = document.createElement('tr');
+            columns.forEach((column, index) => {
+                const value = Array.isArray(rowData) ? rowData[index] : rowData[column];
+                const td = document.createElement('td');
+                td.textContent = value !== null && value !== undefined ? String(value) : 'N/A';
+                tr.appendChild(td);
+            });
+            fragment.appendChild(tr);
+        });
+        tbody.appendChild(fragment);
+    }
+
+    function renderPaginationControls(tableContainer, tbody, columns, firstPageToken, updateRowCount) {
+        let pageToken = firstPageToken;
+        const pager = document.createElement('div');
+        pager.classList.add('table-pager');
+        const loadMoreButton = document.createElement('button');
+        loadMoreButton.textContent = 'Load more';
+        const loadAllButton = document.createElement('button');
+        loadAllButton.classList.add('load-all');
+        loadAllButton.textContent = 'Load all';
+        pager.appendChild(loadMoreButton);
+        pager.appendChild(loadAllButton);
+        tableContainer.appendChild(pager);
+
+        const setBusy = (busy) => {
+            loadMoreButton.disabled = busy;
+            loadAllButton.disabled = busy;
+        };
+        const finish = () => {
+            pager.remove();
+            updateRowCount(false);
+        };
+
+        // Fetches the next page (keyset/offset cursor kept server-side behind the token).
+        loadMoreButton.onclick = async () => {
+            setBusy(true);
+            try {
+                const response = await fetch('/chat/page', {
+                    method: 'POST',
+                    headers: API_HEADERS,
+                    body: JSON.stringify({ page_token: pageToken, result_format: RESULT_FORMAT }),
+                });
+                const page = await response.json();
+                if (!response.ok) throw new Error(page.error || page.response_text || `Server error: ${response.status}`);
+                appendTableRows(tbody, columns, tableFromResult(page.data).rows);
+                if (page.notice) showTableNotice(page.notice);
+                pageToken = page.next_page_token;
+                if (!page.has_more || !pageToken) return finish();
+                updateRowCount(true);
+            } catch (error) {
+                console.error("Pagination error:", error);
+                addMessage(`Could not load more rows: ${error.message}`, 'bot', 'error');
+                pager.remove();
+            }
+            setBusy(false);
+        };
+
+        // Streams every remaining row as NDJSON and renders them as each chunk arrives.
+        loadAllButton.onclick = async () => {
+            setBusy(true);
+            try {
+                const response = await fetch('/chat/stream', {
+                    method: 'POST',
+                    headers: API_HEADERS,
+                    body: JSON.stringify({ page_token: pageToken, result_format: RESULT_FORMAT }),
+                });
+                if (!response.ok || !response.body) {
+                    const errorData = await response.json().catch(() => ({}));
+                    throw new Error(errorData.error || `Server error: ${response.status}`);
+                }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffered = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    buffered += decoder.decode(value || new Uint8Array(), { stream: !done });
+                    const lines = buffered.split('\n');
+                    buffered = done ? '' : lines.pop();
+                    const rows = [];
+                    for (const line of lines) {
+                        if (!line.trim()) continue;
+                        const row = JSON.parse(line);
+                        if (row.__error__) throw new Error(row.__error__);
+                        if (row.__notice__) {
+                            showTableNotice(row.__notice__);
+                            continue;
+                        }
+                        rows.push(row);
+                    }
+                    if (rows.length) {
+                        appendTableRows(tbody, columns, rows);
+                        updateRowCount(!done);
+                    }
+                    if (done) break;
+                }
+                finish();
+            } catch (error) {
+                console.error("Streaming error:", error);
+                addMessage(`Could not load all rows: ${error.message}`, 'bot', 'error');
+                pager.remove();
+                updateRowCount(false);
+            }
+        };
+    }
+
     function addExecutedQueryToPage(query, userQuery, parentElement = dataDisplayArea) {
         if (!parentElement) return;
         if (parentElement !== dataDisplayArea && !parentElement.classList.contains('data-table-container')) {
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ["QUERY_LOG_PATH"] = ""
+os.environ.pop("SQL_CACHE_PATH", None)
+
+import app as app_module  # noqa: E402
+import benchmark  # noqa: E402
+
+
+@pytest.fixture
+def hr_app(tmp_path, monkeypatch):
+    """app.py on a freshly seeded SQLite stand-in for MySQL, with the fake Gemini model and empty caches."""
+    database_path = str(tmp_path / "hr.sqlite3")
+    benchmark.seed_database(database_path, employees=50, departments=4, payments_per_employee=12, leaves_per_employee=1, seed=7)
+    monkeypatch.setattr(app_module, "db_pool", app_module.DBConnectionPool(
+        pool_size=2, timeout=5, recycle=3600, ping_after=3600, reset_on_return=True,
+        connect_factory=lambda: benchmark.SQLiteConnection(database_path)))
+    monkeypatch.setattr(app_module, "model", benchmark.FakeGeminiModel(latency=0, jitter=0))
+    monkeypatch.setattr(app_module, "result_cache", app_module.QueryResultCache(max_bytes=0, max_entry_bytes=0, ttl=0))
+    monkeypatch.setattr(app_module, "sql_cache", app_module.SQLGenerationCache(max_entries=0, ttl=0, path=None))
+    return app_module
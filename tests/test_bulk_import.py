@@ -0,0 +1,58 @@
+import io
+
+
+def existing_email(app_module):
+    return app_module.execute_query("SELECT email FROM employees WHERE id = 1", "SELECT")["data"][0]["email"]
+
+
+def employee_count(app_module):
+    return app_module.execute_query("SELECT COUNT(*) AS n FROM employees", "SELECT")["data"][0]["n"]
+
+
+def test_csv_import_reports_bad_rows_and_keeps_the_rest_of_the_batch(hr_app, monkeypatch):
+    monkeypatch.setattr(hr_app, "BULK_IMPORT_BATCH_SIZE", 3)
+    csv_body = "\n".join([
+        "first_name,last_name,email,hire_date,salary,department_id",
+        "Ada,One,ada.one@example.com,2024-01-02,5000,1",
+        "Bob,Two,bob.two@example.com,2024-01-02,,1",  # missing salary: rejected before the batch
+        "Cy,Three,cy.three@example.com,2024-01-02,4200.50,2",
+        f"Di,Four,{existing_email(hr_app)},2024-01-02,3900,2",  # duplicate email: fails the batch, found on retry
+        "Ed,Five,ed.five@example.com,2024-01-02,not-a-number,3",  # bad number: rejected before the batch
+        "Flo,Six,flo.six@example.com,2024-01-02,6100,3",
+    ])
+    before = employee_count(hr_app)
+
+    response = hr_app.app.test_client().post("/employees/import?format=csv", data=csv_body.encode())
+
+    body = response.get_json()
+    assert response.status_code == 200
+    assert (body["rows_read"], body["rows_inserted"], body["rows_failed"], body["batches"]) == (6, 3, 3, 2)
+    assert [error["row"] for error in sorted(body["errors"], key=lambda error: error["row"])] == [2, 4, 5]
+    assert "salary" in next(error["error"] for error in body["errors"] if error["row"] == 2)
+    assert employee_count(hr_app) == before + 3
+    emails = {row["email"] for row in hr_app.execute_query(
+        "SELECT email FROM employees WHERE email LIKE '%@example.com' AND last_name IN ('One', 'Three', 'Six')", "SELECT")["data"]}
+    assert emails == {"ada.one@example.com", "cy.three@example.com", "flo.six@example.com"}
+
+
+def test_jsonl_import_skips_lines_that_are_not_objects(hr_app):
+    jsonl_body = "\n".join([
+        '{"first_name": "Gus", "last_name": "Seven", "email": "gus.seven@example.com", "hire_date": "2024-02-01", "salary": 4000}',
+        "{not json",
+        '["a", "list"]',
+        "",
+        '{"first_name": "Hal", "last_name": "Eight", "email": "hal.eight@example.com", "hire_date": "2024-02-01", "salary": 4100}',
+    ])
+
+    response = hr_app.app.test_client().post("/employees/import", data=io.BytesIO(jsonl_body.encode()), content_type="application/x-ndjson")
+
+    body = response.get_json()
+    assert response.status_code == 200
+    assert (body["rows_read"], body["rows_inserted"], body["rows_failed"]) == (4, 2, 2)
+    assert [error["row"] for error in body["errors"]] == [2, 3]
+
+
+def test_import_with_no_valid_rows_is_a_client_error(hr_app):
+    response = hr_app.app.test_client().post("/employees/import?format=csv", data=b"first_name,last_name\nNo,Email\n")
+    assert response.status_code == 400
+    assert response.get_json()["rows_inserted"] == 0
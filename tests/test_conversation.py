@@ -0,0 +1,52 @@
+import pytest
+
+PAYMENTS_SQL = ("SELECT p.payment_id, p.amount, p.payment_type, d.department_name FROM payments p "
+                "JOIN employees e ON p.employee_id = e.id JOIN departments d ON e.department_id = d.department_id "
+                "WHERE p.payment_id <= 100")  # One page, so the result is complete and can be refined
+EMPLOYEES_PER_DEPARTMENT_SQL = ("SELECT d.department_name, COUNT(*) AS count FROM employees e "
+                                "JOIN departments d ON e.department_id = d.department_id GROUP BY d.department_name")
+
+
+@pytest.fixture
+def chat(hr_app):
+    hr_app.model.register("list payments with their department", PAYMENTS_SQL)
+    client = hr_app.app.test_client()
+
+    def ask(message, session_id="session-1"):
+        return client.post("/chat", json={"message": message}, headers={"X-Session-Id": session_id}).get_json()
+    return ask
+
+
+def employees_per_department(hr_app):
+    rows = hr_app.execute_query(EMPLOYEES_PER_DEPARTMENT_SQL, "SELECT")["data"]
+    return {row["department_name"]: row["count"] for row in rows}
+
+
+def test_refinement_is_answered_from_the_previous_result(hr_app, chat):
+    first = chat("list payments with their department")
+    calls = hr_app.model.calls
+    refined = chat("sort them by amount descending")
+    assert refined["type"] == "DATA_RESULT" and refined["refinement"] == ["sorted by amount desc"]
+    assert [row["amount"] for row in refined["data"]] == sorted((row["amount"] for row in first["data"]), reverse=True)
+    assert hr_app.model.calls == calls
+
+
+@pytest.mark.parametrize("question", ["now count employees by department", "and how many employees per department"])
+def test_question_naming_another_table_is_not_answered_from_payments(hr_app, chat, question):
+    hr_app.model.register(question, EMPLOYEES_PER_DEPARTMENT_SQL)
+    chat("list payments with their department")
+    answer = chat(question)
+    assert "refinement" not in answer
+    assert {row["department_name"]: row["count"] for row in answer["data"]} == employees_per_department(hr_app)
+
+
+@pytest.mark.parametrize("question", ["now list the employees in Sales", "now count people by department"])
+def test_entity_nouns_are_not_filler(hr_app, chat, question):
+    chat("list payments with their department")
+    assert "refinement" not in chat(question)
+
+
+def test_follow_up_after_a_write_goes_back_to_the_database(hr_app, chat):
+    chat("list payments with their department")
+    hr_app.execute_query("UPDATE payments SET amount = 1 WHERE payment_id = 1", "UPDATE")
+    assert "refinement" not in chat("sort them by amount")
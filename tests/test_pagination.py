@@ -0,0 +1,59 @@
+def fetch_all_pages(app_module, sql_query, page_size):
+    page = app_module.execute_select_page(sql_query, page_size=page_size)
+    rows = list(page["data"])
+    while page.get("next_page_token"):
+        state = app_module.page_tokens.pop(page["next_page_token"])
+        page = app_module.execute_select_page(state["sql"], state["params"], state["page_size"], state["plan"], state["position"])
+        rows += page["data"]
+    return rows
+
+
+def count_rows(app_module, sql_query):
+    return app_module.execute_query(f"SELECT COUNT(*) AS n FROM ({sql_query}) AS counted", "SELECT")["data"][0]["n"]
+
+
+def test_one_to_many_join_pages_every_row(hr_app):
+    sql_query = ("SELECT e.id, e.first_name, p.payment_id, p.amount "
+                 "FROM employees e JOIN payments p ON p.employee_id = e.id")
+    assert hr_app.plan_pagination(sql_query) == {"mode": "offset", "order_by": "`e`.`id`, `p`.`payment_id`"}
+    rows = fetch_all_pages(hr_app, sql_query, page_size=7)
+    assert len(rows) == count_rows(hr_app, sql_query)
+    assert len({row["payment_id"] for row in rows}) == len(rows)
+
+
+def test_many_to_one_join_keeps_keyset(hr_app):
+    sql_query = ("SELECT e.id, e.first_name, d.department_name "
+                 "FROM employees e JOIN departments d ON e.department_id = d.department_id")
+    assert hr_app.plan_pagination(sql_query) == {"mode": "keyset", "key": "id"}
+    rows = fetch_all_pages(hr_app, sql_query, page_size=7)
+    assert sorted(row["id"] for row in rows) == list(range(1, 51))
+
+
+def test_comma_join_uses_offset(hr_app):
+    plan = hr_app.plan_pagination("SELECT e.id, p.amount FROM employees e, payments p WHERE p.employee_id = e.id")
+    assert plan == {"mode": "offset", "order_by": "`e`.`id`, `p`.`payment_id`"}
+
+
+def test_offset_pages_get_a_deterministic_order(hr_app):
+    grouped = "SELECT department_id, COUNT(*) AS n FROM employees GROUP BY department_id"
+    assert hr_app.plan_pagination(grouped)["order_by"] == "department_id"
+    distinct = "SELECT DISTINCT department_id, hire_date FROM employees"
+    assert hr_app.build_page_sql(distinct, hr_app.plan_pagination(distinct), 10).endswith("ORDER BY 1, 2 LIMIT 11 OFFSET 0")
+    ordered = "SELECT id, salary FROM employees ORDER BY salary DESC"
+    assert hr_app.build_page_sql(ordered, hr_app.plan_pagination(ordered), 10).endswith("ORDER BY salary DESC, `employees`.`id` LIMIT 11 OFFSET 0")
+    assert hr_app.plan_pagination("SELECT * FROM (SELECT id FROM employees) t ORDER BY id")["order_by"] is None
+
+
+def test_page_tokens_are_accepted_by_any_worker_with_the_shared_secret(hr_app):
+    other_worker = hr_app.SignedTokens(ttl=60, secret="shared")
+    token = hr_app.SignedTokens(ttl=60, secret="shared").put({"sql": "SELECT 1", "params": [1]})
+    assert other_worker.pop(token) == {"sql": "SELECT 1", "params": [1]}
+    assert hr_app.SignedTokens(ttl=60, secret="other").pop(token) is None
+
+
+def test_tampered_or_expired_page_tokens_are_rejected(hr_app):
+    tokens = hr_app.SignedTokens(ttl=60, secret="shared")
+    signature = tokens.put({"sql": "SELECT 1"}).split(".")[1]
+    forged = hr_app.SignedTokens(ttl=60, secret="guess").put({"sql": "DELETE FROM employees"}).split(".")[0]
+    assert tokens.pop(f"{forged}.{signature}") is None
+    assert hr_app.SignedTokens(ttl=-1, secret="shared").pop(hr_app.SignedTokens(ttl=-1, secret="shared").put({})) is None
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import pytest
+
+
+def test_started_writes_outlive_the_stage_timeout(hr_app):
+    stage = hr_app.StageLimiter("database", max_concurrency=1, timeout=0.05)
+
+    async def slow_write():
+        await asyncio.sleep(0.15)
+        return "committed"
+
+    async def scenario():
+        first = asyncio.ensure_future(stage.run(slow_write, queue_only=True))
+        await asyncio.sleep(0.01)
+        with pytest.raises(hr_app.StageTimeout) as queued:
+            await stage.run(slow_write, queue_only=True)
+        return await first, queued.value
+
+    result, timeout = asyncio.run(scenario())
+    assert result == "committed"
+    assert timeout.started is False
+    assert stage.stats()["in_flight"] == stage.stats()["queued"] == 0
+
+
+def test_reads_still_time_out_while_running(hr_app):
+    stage = hr_app.StageLimiter("database", max_concurrency=1, timeout=0.05)
+    with pytest.raises(hr_app.StageTimeout) as timeout:
+        asyncio.run(stage.run(lambda: asyncio.sleep(0.15)))
+    assert timeout.value.started is True
+
+
+def test_confirmed_write_is_not_cut_off_by_db_timeout(hr_app, monkeypatch):
+    monkeypatch.setattr(hr_app, "db_stage", hr_app.StageLimiter("database", max_concurrency=1, timeout=0.05))
+    execute_query = hr_app.execute_query
+
+    def slow_execute_query(*args, **kwargs):
+        time.sleep(0.15)
+        return execute_query(*args, **kwargs)
+
+    monkeypatch.setattr(hr_app, "execute_query", slow_execute_query)
+    payload, status = asyncio.run(hr_app.execute_and_respond("UPDATE employees SET salary = 1000 WHERE id = 1", "UPDATE"))
+    assert status == 200, payload
+    assert hr_app.execute_query("SELECT salary FROM employees WHERE id = 1", "SELECT")["data"][0]["salary"] == 1000
+
+
+def test_coalesced_select_hands_every_caller_a_working_page_token(hr_app, monkeypatch):
+    flight = hr_app.SingleFlight("select")
+    monkeypatch.setattr(hr_app, "select_flight", flight)
+    execute_select_page = hr_app.execute_select_page
+
+    def slow_execute_select_page(*args, **kwargs):
+        time.sleep(0.1)
+        return execute_select_page(*args, **kwargs)
+
+    monkeypatch.setattr(hr_app, "execute_select_page", slow_execute_select_page)
+    sql_query = "SELECT payment_id, amount FROM payments"
+
+    async def two_callers():
+        return await asyncio.gather(hr_app.execute_and_respond(sql_query, "SELECT"), hr_app.execute_and_respond(sql_query, "SELECT"))
+
+    (leader, _), (waiter, _) = asyncio.run(two_callers())
+    assert flight.stats()["leaders"] == flight.stats()["waiters"] == 1
+    assert leader["has_more"] and waiter["has_more"]
+
+    client = hr_app.app.test_client()
+    for result in (leader, waiter):
+        response = client.post("/chat/page", json={"page_token": result["next_page_token"]})
+        assert response.status_code == 200
+        assert response.get_json()["data"][0]["payment_id"] == result["data"][-1]["payment_id"] + 1
+
+
+def test_last_caller_cancelling_stops_the_shared_run(hr_app):
+    flight = hr_app.SingleFlight("select")
+    run_started, run_cancelled = asyncio.Event(), asyncio.Event()
+
+    async def slow_query():
+        run_started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            run_cancelled.set()
+            raise
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.run("key", slow_query))
+        second = asyncio.ensure_future(flight.run("key", slow_query))
+        await run_started.wait()
+        first.cancel()
+        await asyncio.sleep(0)
+        assert not run_cancelled.is_set() and flight.stats()["in_flight"] == 1  # The second caller still waits
+        second.cancel()
+        await asyncio.wait_for(run_cancelled.wait(), 1)
+        await asyncio.gather(first, second, return_exceptions=True)
+        assert flight.stats()["in_flight"] == 0
+        assert await flight.run("key", lambda: asyncio.sleep(0, result="fresh")) == "fresh"
+
+    asyncio.run(scenario())
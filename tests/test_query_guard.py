@@ -0,0 +1,32 @@
+def guard_with_plan(app_module, monkeypatch, plan_rows):
+    guard = app_module.QueryCostGuard(max_examined_rows=1000, decision_ttl=0)
+    monkeypatch.setattr(guard, "_explain", lambda sql_query, params=None: plan_rows)
+    return guard
+
+
+def test_over_budget_single_scan_without_ordering_is_capped(hr_app, monkeypatch):
+    guard = guard_with_plan(hr_app, monkeypatch, [{"id": 1, "table": "p", "type": "ALL", "rows": 50000, "filtered": 100}])
+    decision = guard.assess("SELECT p.amount FROM payments p")
+    assert decision == {"action": "cap", "estimated_rows": 50000, "full_scans": ["p"]}
+
+
+def test_over_budget_cross_join_of_full_scans_is_rejected(hr_app, monkeypatch):
+    guard = guard_with_plan(hr_app, monkeypatch, [
+        {"id": 1, "table": "p", "type": "ALL", "rows": 50000, "filtered": 100},
+        {"id": 1, "table": "e", "type": "ALL", "rows": 500, "filtered": 100},
+    ])
+    decision = guard.assess("SELECT p.amount, e.first_name FROM payments p, employees e")
+    assert decision["action"] == "reject"
+    assert decision["full_scans"] == ["e", "p"]
+
+
+def test_over_budget_ordered_query_is_rejected(hr_app, monkeypatch):
+    guard = guard_with_plan(hr_app, monkeypatch, [{"id": 1, "table": "p", "type": "ALL", "rows": 50000, "filtered": 100}])
+    assert guard.assess("SELECT p.amount FROM payments p ORDER BY p.amount")["action"] == "reject"
+
+
+def test_stream_statements_get_their_own_execution_time_limit(hr_app, monkeypatch):
+    monkeypatch.setattr(hr_app, "QUERY_MAX_EXECUTION_MS", 10000)
+    assert hr_app.with_execution_time_limit("SELECT id FROM employees") == "SELECT /*+ MAX_EXECUTION_TIME(10000) */ id FROM employees"
+    assert hr_app.with_execution_time_limit("SELECT id FROM employees", limit_ms=0) == "SELECT id FROM employees"
+    assert hr_app.with_execution_time_limit("SELECT id FROM employees", True, 60000).startswith("SET STATEMENT max_statement_time=60 FOR")
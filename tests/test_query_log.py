@@ -0,0 +1,14 @@
+def test_writes_are_logged_without_their_values(hr_app, tmp_path):
+    query_log = hr_app.QueryLog(path=str(tmp_path / "query_log.sqlite3"), flush_interval=3600)
+    query_log.record("UPDATE employees SET email = 'ada@example.com', salary = %s WHERE id = 7", (5200,), "UPDATE", 0.002, rows=1)
+    query_log.record("SELECT first_name FROM employees WHERE department_id = %s", (3,), "SELECT", 0.001, rows=12)
+
+    entries = {entry["query_type"]: entry for entry in query_log.load()}
+
+    update = entries["UPDATE"]
+    assert update["sample_params"] is None
+    assert "ada@example.com" not in update["sample_sql"] and "7" not in update["sample_sql"]
+    assert hr_app.index_candidates(update["sample_sql"]) == []  # "id" is the primary key: nothing to propose
+    select = entries["SELECT"]
+    assert (select["sample_sql"], select["sample_params"]) == ("SELECT first_name FROM employees WHERE department_id = %s", [3])
+
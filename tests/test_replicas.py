@@ -0,0 +1,69 @@
+import shutil
+import time
+
+import pytest
+
+import benchmark
+
+SALARY_SQL = "SELECT salary FROM employees WHERE id = 1"
+WRITE_SQL = "UPDATE employees SET salary = 1234 WHERE id = 1"
+
+
+@pytest.fixture
+def replicated_app(hr_app, monkeypatch, tmp_path):
+    """hr_app plus one healthy replica: a snapshot of the seeded database that never receives later writes."""
+    replica_path = str(tmp_path / "replica.sqlite3")
+    shutil.copyfile(tmp_path / "hr.sqlite3", replica_path)  # The primary seeded by hr_app
+    replicas = hr_app.ReplicaSet(["replica-1"], max_lag=5, check_interval=3600, pool_factory=lambda host: hr_app.DBConnectionPool(
+        pool_size=2, timeout=5, recycle=3600, ping_after=3600, reset_on_return=True,
+        connect_factory=lambda: benchmark.SQLiteConnection(replica_path)))
+    replicas._mark(replicas.replicas[0], healthy=True, lag=0.0, error=None)  # SQLite has no SHOW REPLICA STATUS
+    monkeypatch.setattr(hr_app, "replica_set", replicas)
+    monkeypatch.setattr(hr_app, "recent_writes", hr_app.RecentWrites(window=60))
+    return hr_app
+
+
+def salary_for(app_module, session_id):
+    with app_module.session_context(session_id):
+        return app_module.execute_query(SALARY_SQL, "SELECT")["data"][0]["salary"]
+
+
+def test_session_reads_from_the_primary_after_its_write(replicated_app):
+    app_module = replicated_app
+    stale_salary = salary_for(app_module, "writer")
+    assert app_module.replica_set.stats()["reads"] == 1
+
+    with app_module.session_context("writer"):
+        assert "error" not in app_module.execute_query(WRITE_SQL, "UPDATE")
+
+    assert salary_for(app_module, "writer") == 1234  # Pinned to the primary
+    assert salary_for(app_module, "reader") == stale_salary  # Other sessions still use the (lagging) replica
+    assert app_module.replica_set.stats()["reads"] == 2
+
+
+def test_session_returns_to_replicas_after_the_window(replicated_app, monkeypatch):
+    app_module = replicated_app
+    monkeypatch.setattr(app_module, "recent_writes", app_module.RecentWrites(window=0.05))
+    with app_module.session_context("writer"):
+        app_module.execute_query(WRITE_SQL, "UPDATE")
+    assert salary_for(app_module, "writer") == 1234
+    time.sleep(0.06)
+    assert salary_for(app_module, "writer") != 1234
+    assert app_module.replica_set.stats()["reads"] == 1
+
+
+def test_replica_reads_of_recently_written_tables_are_not_cached(replicated_app, monkeypatch):
+    app_module = replicated_app
+    monkeypatch.setattr(app_module, "result_cache", app_module.QueryResultCache(max_bytes=1 << 20, max_entry_bytes=1 << 20, ttl=60))
+    with app_module.session_context("writer"):
+        app_module.execute_query(WRITE_SQL, "UPDATE")
+
+    assert salary_for(app_module, "reader") != 1234
+    assert app_module.result_cache.get(app_module.QueryResultCache.make_key(SALARY_SQL, None)) is None
+    assert salary_for(app_module, "writer") == 1234  # The primary's answer is fresh, so it may be cached
+    assert salary_for(app_module, "reader") == 1234
+
+    departments_sql = "SELECT department_name FROM departments"
+    with app_module.session_context("reader"):
+        app_module.execute_query(departments_sql, "SELECT")
+    assert app_module.result_cache.get(app_module.QueryResultCache.make_key(departments_sql, None)) is not None
@@ -0,0 +1,63 @@
+import pytest
+
+
+@pytest.fixture
+def summarized_app(hr_app, monkeypatch):
+    """hr_app with (empty) summary tables in the database, so plan_summary_maintenance has something to maintain."""
+    monkeypatch.setattr(hr_app, "summary_tables_seen", {})
+    conn = hr_app.get_db_connection()
+    cursor = conn.cursor()
+    for summary in hr_app.SUMMARY_TABLE_DDL:
+        cursor.execute(f"CREATE TABLE {summary} (department_id INTEGER)")
+    conn.commit()
+    yield hr_app, cursor
+    cursor.close()
+    conn.close()
+
+
+def test_insert_into_a_source_table_uses_the_new_id_range(summarized_app):
+    app_module, cursor = summarized_app
+    plan = app_module.plan_summary_maintenance(
+        "INSERT INTO payments (employee_id, payment_date, amount) VALUES (%s, %s, %s)", "INSERT", (1, "2024-05-31", 100), cursor)
+    assert plan == {"table": "payments", "summaries": ["payroll_summary"], "strategy": "id_range"}
+
+
+def test_update_with_where_captures_the_matched_rows(summarized_app):
+    app_module, cursor = summarized_app
+    plan = app_module.plan_summary_maintenance(
+        "UPDATE payments p SET amount = ROUND(%s, 2) WHERE p.employee_id = %s AND p.payment_type = 'Bonus'", "UPDATE", (250, 7), cursor)
+    assert plan["strategy"] == "capture"
+    assert plan["select_sql"] == "SELECT payment_id FROM payments p WHERE p.employee_id = %s AND p.payment_type = 'Bonus'"
+    assert plan["select_params"] == (7,)
+    cursor.execute(plan["select_sql"], plan["select_params"])
+    assert len(cursor.fetchall()) >= 1
+
+
+@pytest.mark.parametrize("sql_query", [
+    "UPDATE leave_requests SET status = 'Approved'",
+    "UPDATE employees SET department_id = 2",
+    "UPDATE employees e JOIN (SELECT id FROM employees ORDER BY id ASC LIMIT 3) AS t ON e.id = t.id SET e.department_id = 1",
+    "UPDATE employees e JOIN payments p ON p.employee_id = e.id SET amount = amount * 2 WHERE e.id = 1",
+])
+def test_whole_table_and_multi_table_updates_rebuild(summarized_app, sql_query):
+    app_module, cursor = summarized_app
+    plan = app_module.plan_summary_maintenance(sql_query, "UPDATE", None, cursor)
+    assert plan["strategy"] == "rebuild"
+    assert plan["summaries"] == list(app_module.SUMMARY_SOURCES[plan["table"]])
+
+
+@pytest.mark.parametrize("sql_query", [
+    "UPDATE employees SET salary = salary * 1.05 WHERE id = 3",
+    "UPDATE employees SET salary = salary * 1.05",
+    "UPDATE employees e JOIN (SELECT id FROM employees ORDER BY id ASC LIMIT 3) AS temp_ids ON e.id = temp_ids.id "
+    "SET e.hire_date = '2024-01-01', `e`.`job_id` = 'IT_PROG'",
+])
+def test_employee_updates_that_keep_departments_skip_the_summaries(summarized_app, sql_query):
+    app_module, cursor = summarized_app
+    assert app_module.plan_summary_maintenance(sql_query, "UPDATE", None, cursor) is None
+
+
+def test_writes_to_a_summary_table_are_refused(summarized_app):
+    app_module, cursor = summarized_app
+    with pytest.raises(ValueError):
+        app_module.plan_summary_maintenance("UPDATE payroll_summary SET total_amount = 0", "UPDATE", None, cursor)